@@ -0,0 +1,613 @@
+"""
+In-process stand-in for the AWS APIs used by the scripts: STS sessions, GuardDuty, SecurityHub,
+AWS Config, IAM, S3, EC2/Account regions and Organizations.
+
+State is kept in memory for a synthetic fleet of accounts. Every call sleeps for the configured
+latency, list calls are paginated with the configured page size and member, invitation and
+standards transitions only become visible after the configured eventual-consistency delays.
+Calls are counted per (service, operation) for the benchmark report.
+"""
+
+import threading
+import time
+
+from collections import Counter
+from botocore.exceptions import ClientError
+
+# Maximum number of accounts accepted by a single member API call, as enforced by the real APIs
+MEMBER_API_LIMIT = 50
+
+
+def client_error(operation_name, code, message, status):
+    return ClientError({
+        'Error': {'Code': code, 'Message': message},
+        'ResponseMetadata': {'HTTPStatusCode': status}
+    }, operation_name)
+
+
+class History(object):
+    """
+    Value whose changes become visible at a given time, used to model eventual consistency
+    """
+
+    def __init__(self):
+        self._changes = []
+
+    def set(self, value, visible_at):
+        self._changes.append((visible_at, value))
+        self._changes.sort(key=lambda change: change[0])
+
+    def get(self, now):
+        value = None
+        for visible_at, changed_value in self._changes:
+            if visible_at > now:
+                break
+            value = changed_value
+        return value
+
+
+class FakeAWS(object):
+    """
+    State and API handlers of the fake backend
+    """
+
+    def __init__(self, latency=0.0, page_size=50, consistency_delay=0.0, standards_delay=0.0, regions=None):
+        """
+        :param latency: Seconds every API call takes
+        :param page_size: Number of items in a page of the paginated list calls
+        :param consistency_delay: Seconds before member and invitation changes are visible
+        :param standards_delay: Seconds a standards subscription stays PENDING before READY
+        :param regions: list of AWS Regions enabled in every account
+        """
+        self.latency = latency
+        self.page_size = page_size
+        self.consistency_delay = consistency_delay
+        self.standards_delay = standards_delay
+        self.regions = regions or ['us-east-1']
+        self.calls = Counter()
+        self._lock = threading.RLock()
+        self._next_id = 0
+
+        self.organization = dict()
+        self.detectors = dict()
+        self.members = dict()
+        self.invitations = dict()
+        self.hubs = set()
+        self.standards = dict()
+        self.masters = dict()
+        self.recorders = dict()
+        self.channels = set()
+        self.service_linked_roles = set()
+        self.buckets = set()
+        self.admin_accounts = dict()
+        self.auto_enable = dict()
+        self.aggregators = dict()
+
+    def add_accounts(self, accounts):
+        """
+        :param accounts: dict of AwsAccountId:Email added to the organization
+        """
+        with self._lock:
+            self.organization.update(accounts)
+
+    def reset_calls(self):
+        with self._lock:
+            self.calls = Counter()
+
+    def _id(self, prefix):
+        self._next_id += 1
+        return '{}{:012x}'.format(prefix, self._next_id)
+
+    def call(self, service_name, operation_name, account, region, kwargs):
+        with self._lock:
+            self.calls[(service_name, operation_name)] += 1
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        handler = getattr(self, '{}_{}'.format(service_name.replace('-', '_'), operation_name), None)
+        if handler is None:
+            raise NotImplementedError('{}.{} is not implemented by the fake backend'.format(service_name, operation_name))
+
+        with self._lock:
+            return handler(account, region, time.time(), **kwargs)
+
+    def _page(self, items, key, kwargs):
+        start = int(kwargs.get('NextToken') or 0)
+        page_size = min(kwargs.get('MaxResults') or self.page_size, self.page_size)
+        response = {key: items[start:start + page_size]}
+        if start + page_size < len(items):
+            response['NextToken'] = str(start + page_size)
+        return response
+
+    def _check_limit(self, operation_name, account_ids):
+        if len(account_ids) > MEMBER_API_LIMIT:
+            raise client_error(operation_name, 'BadRequestException', 'At most {} accounts can be sent'.format(MEMBER_API_LIMIT), 400)
+
+    # Members, shared by GuardDuty and SecurityHub
+
+    def _members(self, service_name, account, region):
+        return self.members.setdefault((service_name, account, region), dict())
+
+    def _member_list(self, service_name, account, region, now, status_key, only_associated=False):
+        members = []
+        for member_account, history in sorted(self._members(service_name, account, region).items()):
+            status = history.get(now)
+            if status is None:
+                continue
+            if only_associated and status not in ('Enabled', 'Associated'):
+                continue
+            members.append({
+                'AccountId': member_account,
+                'MasterId': account,
+                'Email': self.organization.get(member_account, ''),
+                status_key: status
+            })
+        return members
+
+    def _create_members(self, service_name, operation_name, account, region, now, account_details):
+        self._check_limit(operation_name, account_details)
+        members = self._members(service_name, account, region)
+        # The delegated administrator adds the accounts of the organization without invitations
+        administrator = self.admin_accounts.get((service_name, region)) == account
+        for detail in account_details:
+            history = members.setdefault(detail['AccountId'], History())
+            if history.get(float('inf')) is None:
+                if administrator and detail['AccountId'] in self.organization:
+                    history.set('Enabled', now + self.consistency_delay)
+                    self.masters[(service_name, detail['AccountId'], region)] = account
+                else:
+                    history.set('Created', now + self.consistency_delay)
+        return {'UnprocessedAccounts': []}
+
+    def _invite_members(self, service_name, operation_name, account, region, now, account_ids):
+        self._check_limit(operation_name, account_ids)
+        members = self._members(service_name, account, region)
+        unprocessed = []
+        for member_account in account_ids:
+            if member_account not in members or members[member_account].get(float('inf')) is None:
+                unprocessed.append({'AccountId': member_account, 'Result': 'The request is rejected because the account is not a member'})
+                continue
+            members[member_account].set('Invited', now + self.consistency_delay)
+            invitations = self.invitations.setdefault((service_name, member_account, region), History())
+            invitations.set({'AccountId': account, 'InvitationId': self._id('inv'), 'RelationshipStatus': 'Invited'}, now + self.consistency_delay)
+        return {'UnprocessedAccounts': unprocessed}
+
+    def _get_members(self, service_name, operation_name, account, region, now, account_ids, status_key):
+        self._check_limit(operation_name, account_ids)
+        found = dict((member['AccountId'], member) for member in self._member_list(service_name, account, region, now, status_key))
+        return {
+            'Members': [found[member_account] for member_account in account_ids if member_account in found],
+            'UnprocessedAccounts': [
+                {'AccountId': member_account, 'Result': 'The request is rejected because the account is not a member'}
+                for member_account in account_ids if member_account not in found
+            ]
+        }
+
+    def _set_members(self, service_name, operation_name, account, region, now, account_ids, status):
+        self._check_limit(operation_name, account_ids)
+        members = self._members(service_name, account, region)
+        unprocessed = []
+        for member_account in account_ids:
+            if member_account not in members or members[member_account].get(float('inf')) is None:
+                unprocessed.append({'AccountId': member_account, 'Result': 'The request is rejected because the account is not a member'})
+                continue
+            members[member_account].set(status, now + self.consistency_delay)
+            if status in ('Removed', None):
+                self.masters.pop((service_name, member_account, region), None)
+        return {'UnprocessedAccounts': unprocessed}
+
+    def _list_invitations(self, service_name, account, region, now, kwargs):
+        history = self.invitations.get((service_name, account, region))
+        invitation = history.get(now) if history else None
+        return self._page([invitation] if invitation else [], 'Invitations', kwargs)
+
+    def _accept_invitation(self, service_name, operation_name, account, region, now, invitation_id, master_id):
+        history = self.invitations.get((service_name, account, region))
+        invitation = history.get(now) if history else None
+        if not invitation or invitation['InvitationId'] != invitation_id or invitation['AccountId'] != master_id:
+            raise client_error(operation_name, 'BadRequestException', 'The invitation does not exist', 400)
+
+        history.set(None, now)
+        self._members(service_name, master_id, region)[account].set('Enabled', now + self.consistency_delay)
+        self.masters[(service_name, account, region)] = master_id
+        return {}
+
+    # Delegated administrator of the organization, shared by GuardDuty and SecurityHub
+
+    def _list_organization_admin_accounts(self, service_name, region, id_key, kwargs):
+        admin_account = self.admin_accounts.get((service_name, region))
+        admin_accounts = [{id_key: admin_account, 'AdminStatus': 'ENABLED'}] if admin_account else []
+        return self._page(admin_accounts, 'AdminAccounts', kwargs)
+
+    def _enable_organization_admin_account(self, service_name, operation_name, region, admin_account_id):
+        if admin_account_id != self.admin_accounts.get((service_name, region), admin_account_id):
+            raise client_error(operation_name, 'BadRequestException', 'The organization already has a delegated administrator', 400)
+        self.admin_accounts[(service_name, region)] = admin_account_id
+        return {}
+
+    def _disable_organization_admin_account(self, service_name, operation_name, region, admin_account_id):
+        if self.admin_accounts.get((service_name, region)) != admin_account_id:
+            raise client_error(operation_name, 'BadRequestException', 'The account is not the delegated administrator', 400)
+        del self.admin_accounts[(service_name, region)]
+        self.auto_enable.pop((service_name, region), None)
+        return {}
+
+    def _update_organization_configuration(self, service_name, operation_name, account, region, auto_enable):
+        if self.admin_accounts.get((service_name, region)) != account:
+            raise client_error(operation_name, 'BadRequestException', 'The request is rejected because the account is not the delegated administrator', 400)
+        self.auto_enable[(service_name, region)] = auto_enable
+        return {}
+
+    # GuardDuty
+
+    def guardduty_list_detectors(self, account, region, now, **kwargs):
+        detector_id = self.detectors.get((account, region))
+        return {'DetectorIds': [detector_id] if detector_id else []}
+
+    def guardduty_create_detector(self, account, region, now, **kwargs):
+        if (account, region) in self.detectors:
+            raise client_error('CreateDetector', 'BadRequestException', 'The request is rejected because a detector already exists', 400)
+        self.detectors[(account, region)] = self._id('det')
+        return {'DetectorId': self.detectors[(account, region)]}
+
+    def guardduty_delete_detector(self, account, region, now, DetectorId, **kwargs):
+        self.detectors.pop((account, region), None)
+        self.members.pop(('guardduty', account, region), None)
+        return {}
+
+    def guardduty_create_members(self, account, region, now, DetectorId, AccountDetails, **kwargs):
+        return self._create_members('guardduty', 'CreateMembers', account, region, now, AccountDetails)
+
+    def guardduty_invite_members(self, account, region, now, DetectorId, AccountIds, **kwargs):
+        return self._invite_members('guardduty', 'InviteMembers', account, region, now, AccountIds)
+
+    def guardduty_get_members(self, account, region, now, DetectorId, AccountIds, **kwargs):
+        return self._get_members('guardduty', 'GetMembers', account, region, now, AccountIds, 'RelationshipStatus')
+
+    def guardduty_list_members(self, account, region, now, DetectorId, OnlyAssociated='true', **kwargs):
+        members = self._member_list('guardduty', account, region, now, 'RelationshipStatus', OnlyAssociated == 'true')
+        return self._page(members, 'Members', kwargs)
+
+    def guardduty_disassociate_members(self, account, region, now, DetectorId, AccountIds, **kwargs):
+        return self._set_members('guardduty', 'DisassociateMembers', account, region, now, AccountIds, 'Removed')
+
+    def guardduty_delete_members(self, account, region, now, DetectorId, AccountIds, **kwargs):
+        return self._set_members('guardduty', 'DeleteMembers', account, region, now, AccountIds, None)
+
+    def guardduty_start_monitoring_members(self, account, region, now, DetectorId, AccountIds, **kwargs):
+        return self._set_members('guardduty', 'StartMonitoringMembers', account, region, now, AccountIds, 'Enabled')
+
+    def guardduty_list_invitations(self, account, region, now, **kwargs):
+        return self._list_invitations('guardduty', account, region, now, kwargs)
+
+    def guardduty_accept_invitation(self, account, region, now, DetectorId, InvitationId, MasterId=None, AdministratorId=None, **kwargs):
+        return self._accept_invitation('guardduty', 'AcceptInvitation', account, region, now, InvitationId, MasterId or AdministratorId)
+
+    def guardduty_list_organization_admin_accounts(self, account, region, now, **kwargs):
+        return self._list_organization_admin_accounts('guardduty', region, 'AdminAccountId', kwargs)
+
+    def guardduty_enable_organization_admin_account(self, account, region, now, AdminAccountId, **kwargs):
+        return self._enable_organization_admin_account('guardduty', 'EnableOrganizationAdminAccount', region, AdminAccountId)
+
+    def guardduty_disable_organization_admin_account(self, account, region, now, AdminAccountId, **kwargs):
+        return self._disable_organization_admin_account('guardduty', 'DisableOrganizationAdminAccount', region, AdminAccountId)
+
+    def guardduty_update_organization_configuration(self, account, region, now, DetectorId, AutoEnable=False, **kwargs):
+        return self._update_organization_configuration('guardduty', 'UpdateOrganizationConfiguration', account, region, AutoEnable)
+
+    # SecurityHub
+
+    def _check_hub(self, operation_name, account, region):
+        if (account, region) not in self.hubs:
+            raise client_error(operation_name, 'InvalidAccessException', 'Account {} is not subscribed to AWS Security Hub'.format(account), 401)
+
+    def securityhub_enable_security_hub(self, account, region, now, **kwargs):
+        if (account, region) in self.hubs:
+            raise client_error('EnableSecurityHub', 'ResourceConflictException', 'Account {} is already subscribed to Security Hub'.format(account), 409)
+        self.hubs.add((account, region))
+        return {}
+
+    def securityhub_describe_hub(self, account, region, now, **kwargs):
+        self._check_hub('DescribeHub', account, region)
+        return {'HubArn': 'arn:aws:securityhub:{}:{}:hub/default'.format(region, account)}
+
+    def securityhub_disable_security_hub(self, account, region, now, **kwargs):
+        self._check_hub('DisableSecurityHub', account, region)
+        self.hubs.discard((account, region))
+        self.standards.pop((account, region), None)
+        return {}
+
+    def securityhub_batch_enable_standards(self, account, region, now, StandardsSubscriptionRequests, **kwargs):
+        self._check_hub('BatchEnableStandards', account, region)
+        standards = self.standards.setdefault((account, region), dict())
+        for request in StandardsSubscriptionRequests:
+            if request['StandardsArn'] not in standards:
+                standards[request['StandardsArn']] = History()
+                standards[request['StandardsArn']].set('PENDING', now)
+                standards[request['StandardsArn']].set('READY', now + self.standards_delay)
+        return {'StandardsSubscriptions': []}
+
+    def securityhub_get_enabled_standards(self, account, region, now, **kwargs):
+        self._check_hub('GetEnabledStandards', account, region)
+        subscriptions = [
+            {
+                'StandardsArn': standards_arn,
+                'StandardsSubscriptionArn': 'arn:aws:securityhub:{}:{}:subscription/{}'.format(region, account, standards_arn.split(':')[-1].split('/', 1)[1]),
+                'StandardsStatus': history.get(now)
+            }
+            for standards_arn, history in sorted(self.standards.get((account, region), dict()).items())
+        ]
+        return self._page(subscriptions, 'StandardsSubscriptions', kwargs)
+
+    def securityhub_batch_disable_standards(self, account, region, now, StandardsSubscriptionArns, **kwargs):
+        self._check_hub('BatchDisableStandards', account, region)
+        standards = self.standards.get((account, region), dict())
+        for subscription_arn in StandardsSubscriptionArns:
+            for standards_arn in list(standards.keys()):
+                if standards_arn.endswith(subscription_arn.split('subscription/')[-1]):
+                    del standards[standards_arn]
+        return {'StandardsSubscriptions': []}
+
+    def securityhub_create_members(self, account, region, now, AccountDetails, **kwargs):
+        self._check_hub('CreateMembers', account, region)
+        return self._create_members('securityhub', 'CreateMembers', account, region, now, AccountDetails)
+
+    def securityhub_invite_members(self, account, region, now, AccountIds, **kwargs):
+        self._check_hub('InviteMembers', account, region)
+        return self._invite_members('securityhub', 'InviteMembers', account, region, now, AccountIds)
+
+    def securityhub_get_members(self, account, region, now, AccountIds, **kwargs):
+        self._check_hub('GetMembers', account, region)
+        return self._get_members('securityhub', 'GetMembers', account, region, now, AccountIds, 'MemberStatus')
+
+    def securityhub_list_members(self, account, region, now, OnlyAssociated=True, **kwargs):
+        self._check_hub('ListMembers', account, region)
+        members = self._member_list('securityhub', account, region, now, 'MemberStatus', OnlyAssociated)
+        return self._page(members, 'Members', kwargs)
+
+    def securityhub_disassociate_members(self, account, region, now, AccountIds, **kwargs):
+        return self._set_members('securityhub', 'DisassociateMembers', account, region, now, AccountIds, 'Removed')
+
+    def securityhub_delete_members(self, account, region, now, AccountIds, **kwargs):
+        return self._set_members('securityhub', 'DeleteMembers', account, region, now, AccountIds, None)
+
+    def securityhub_list_invitations(self, account, region, now, **kwargs):
+        return self._list_invitations('securityhub', account, region, now, kwargs)
+
+    def securityhub_accept_invitation(self, account, region, now, InvitationId, MasterId, **kwargs):
+        self._check_hub('AcceptInvitation', account, region)
+        return self._accept_invitation('securityhub', 'AcceptInvitation', account, region, now, InvitationId, MasterId)
+
+    def securityhub_get_master_account(self, account, region, now, **kwargs):
+        master_id = self.masters.get(('securityhub', account, region))
+        if master_id is None:
+            return {}
+        return {'Master': {'AccountId': master_id, 'MemberStatus': 'Enabled'}}
+
+    def securityhub_disassociate_from_master_account(self, account, region, now, **kwargs):
+        master_id = self.masters.pop(('securityhub', account, region), None)
+        if master_id is not None:
+            self._members('securityhub', master_id, region)[account].set('Removed', now + self.consistency_delay)
+        return {}
+
+    def securityhub_list_organization_admin_accounts(self, account, region, now, **kwargs):
+        return self._list_organization_admin_accounts('securityhub', region, 'AccountId', kwargs)
+
+    def securityhub_enable_organization_admin_account(self, account, region, now, AdminAccountId, **kwargs):
+        return self._enable_organization_admin_account('securityhub', 'EnableOrganizationAdminAccount', region, AdminAccountId)
+
+    def securityhub_disable_organization_admin_account(self, account, region, now, AdminAccountId, **kwargs):
+        return self._disable_organization_admin_account('securityhub', 'DisableOrganizationAdminAccount', region, AdminAccountId)
+
+    def securityhub_update_organization_configuration(self, account, region, now, AutoEnable=False, **kwargs):
+        self._check_hub('UpdateOrganizationConfiguration', account, region)
+        return self._update_organization_configuration('securityhub', 'UpdateOrganizationConfiguration', account, region, AutoEnable)
+
+    def securityhub_list_finding_aggregators(self, account, region, now, **kwargs):
+        self._check_hub('ListFindingAggregators', account, region)
+        arn = self.aggregators.get((account, region))
+        return self._page([{'FindingAggregatorArn': arn}] if arn else [], 'FindingAggregators', kwargs)
+
+    def securityhub_create_finding_aggregator(self, account, region, now, RegionLinkingMode, **kwargs):
+        self._check_hub('CreateFindingAggregator', account, region)
+        if (account, region) in self.aggregators:
+            raise client_error('CreateFindingAggregator', 'InvalidInputException', 'A finding aggregator already exists', 400)
+        arn = 'arn:aws:securityhub:{}:{}:finding-aggregator/{}'.format(region, account, self._id('agg'))
+        self.aggregators[(account, region)] = arn
+        return {'FindingAggregatorArn': arn, 'FindingAggregationRegion': region, 'RegionLinkingMode': RegionLinkingMode}
+
+    def securityhub_delete_finding_aggregator(self, account, region, now, FindingAggregatorArn, **kwargs):
+        if self.aggregators.get((account, region)) != FindingAggregatorArn:
+            raise client_error('DeleteFindingAggregator', 'ResourceNotFoundException', 'The finding aggregator does not exist', 404)
+        del self.aggregators[(account, region)]
+        return {}
+
+    # AWS Config
+
+    def config_describe_configuration_recorders(self, account, region, now, **kwargs):
+        recorder = self.recorders.get((account, region))
+        return {'ConfigurationRecorders': [{'name': recorder['name']}] if recorder else []}
+
+    def config_put_configuration_recorder(self, account, region, now, ConfigurationRecorder, **kwargs):
+        self.recorders.setdefault((account, region), {'name': ConfigurationRecorder['name'], 'recording': False})
+        return {}
+
+    def config_describe_configuration_recorder_status(self, account, region, now, **kwargs):
+        recorder = self.recorders.get((account, region))
+        return {'ConfigurationRecordersStatus': [dict(recorder)] if recorder else []}
+
+    def config_describe_delivery_channels(self, account, region, now, **kwargs):
+        return {'DeliveryChannels': [{'name': 'config-s3-delivery'}] if (account, region) in self.channels else []}
+
+    def config_put_delivery_channel(self, account, region, now, DeliveryChannel, **kwargs):
+        self.channels.add((account, region))
+        return {}
+
+    def config_start_configuration_recorder(self, account, region, now, ConfigurationRecorderName, **kwargs):
+        if (account, region) not in self.channels:
+            raise client_error('StartConfigurationRecorder', 'NoAvailableDeliveryChannelException', 'Delivery channel is not available to start configuration recorder', 400)
+        self.recorders[(account, region)]['recording'] = True
+        return {}
+
+    # IAM and S3
+
+    def iam_create_service_linked_role(self, account, region, now, AWSServiceName, **kwargs):
+        if account in self.service_linked_roles:
+            raise client_error('CreateServiceLinkedRole', 'InvalidInput', 'Service role name AWSServiceRoleForConfig has been taken in this account', 400)
+        self.service_linked_roles.add(account)
+        return {}
+
+    def s3_list_objects(self, account, region, now, Bucket, **kwargs):
+        if Bucket not in self.buckets:
+            raise client_error('ListObjects', 'NoSuchBucket', 'The specified bucket does not exist', 404)
+        return {'Contents': []}
+
+    def s3_create_bucket(self, account, region, now, Bucket, **kwargs):
+        self.buckets.add(Bucket)
+        return {}
+
+    def s3_put_bucket_policy(self, account, region, now, Bucket, Policy, **kwargs):
+        return {}
+
+    # Regions and Organizations
+
+    def account_list_regions(self, account, region, now, **kwargs):
+        return self._page([{'RegionName': name, 'RegionOptStatus': 'ENABLED_BY_DEFAULT'} for name in self.regions], 'Regions', kwargs)
+
+    def ec2_describe_regions(self, account, region, now, **kwargs):
+        return {'Regions': [{'RegionName': name} for name in self.regions]}
+
+    def organizations_list_accounts(self, account, region, now, **kwargs):
+        accounts = [
+            {'Id': member_account, 'Email': email, 'Status': 'ACTIVE'}
+            for member_account, email in sorted(self.organization.items())
+        ]
+        return self._page(accounts, 'Accounts', kwargs)
+
+
+class FakeEvents(object):
+    """
+    Accepts the botocore event handlers registered by the scripts, the fake clients never emit events
+    """
+
+    def register(self, event_name, handler, *args, **kwargs):
+        pass
+
+    def register_first(self, event_name, handler, *args, **kwargs):
+        pass
+
+
+class FakeServiceModel(object):
+    def __init__(self, service_name):
+        self.service_name = service_name
+
+
+class FakeMeta(object):
+    def __init__(self, service_name, region_name):
+        self.service_model = FakeServiceModel(service_name)
+        self.region_name = region_name
+        self.events = FakeEvents()
+
+
+class FakePaginator(object):
+    def __init__(self, method):
+        self._method = method
+
+    def paginate(self, **kwargs):
+        while True:
+            page = self._method(**kwargs)
+            yield page
+            if not page.get('NextToken'):
+                return
+            kwargs = dict(kwargs, NextToken=page['NextToken'])
+
+
+class FakeClient(object):
+    """
+    Client of a service in an account and region, operations are dispatched to the backend
+    """
+
+    def __init__(self, backend, service_name, account, region_name):
+        self._backend = backend
+        self._account = account
+        self.meta = FakeMeta(service_name, region_name)
+
+    def get_paginator(self, operation_name):
+        return FakePaginator(getattr(self, operation_name))
+
+    def __getattr__(self, operation_name):
+        if operation_name.startswith('_'):
+            raise AttributeError(operation_name)
+
+        def operation(**kwargs):
+            return self._backend.call(self.meta.service_model.service_name, operation_name, self._account, self.meta.region_name, kwargs)
+
+        operation.__name__ = operation_name
+        return operation
+
+
+class FakeSession(object):
+    """
+    Session of an account, stands for the boto3 Session returned by the credential broker
+    """
+
+    def __init__(self, account, region_name='us-east-1'):
+        self.account = account
+        self.region_name = region_name
+
+
+class FakeCredentialBroker(object):
+    """
+    Stands for utils.CredentialBroker, every account can be assumed
+    """
+
+    def __init__(self, backend, role_session_name):
+        self._backend = backend
+        self.role_session_name = role_session_name
+        self._sessions = dict()
+        self._lock = threading.Lock()
+
+    def get_partition(self):
+        return 'aws'
+
+    def get_session(self, aws_account_number, role_name, region_name=None):
+        with self._lock:
+            if aws_account_number not in self._sessions:
+                self._backend.calls[('sts', 'assume_role')] += 1
+                self._sessions[aws_account_number] = FakeSession(aws_account_number)
+            return self._sessions[aws_account_number]
+
+    def prewarm(self, aws_account_numbers, role_name, workers=10, region_name=None):
+        for account in aws_account_numbers:
+            self.get_session(account, role_name, region_name)
+        return dict()
+
+
+def install(utils_module, backend, caller_account):
+    """
+    Points the client and credential helpers of the utils module at the fake backend
+    :param utils_module: freshly imported utils module
+    :param backend: FakeAWS
+    :param caller_account: AWS Account Number of the default session
+    """
+    brokers = dict()
+    clients = dict()
+    lock = threading.Lock()
+
+    def get_client(session, service_name, region_name=None):
+        account = session.account if isinstance(session, FakeSession) else caller_account
+        key = (account, service_name, region_name or 'us-east-1')
+        with lock:
+            if key not in clients:
+                clients[key] = FakeClient(backend, service_name, account, region_name or 'us-east-1')
+            return clients[key]
+
+    def get_credential_broker(role_session_name):
+        with lock:
+            if role_session_name not in brokers:
+                brokers[role_session_name] = FakeCredentialBroker(backend, role_session_name)
+            return brokers[role_session_name]
+
+    utils_module.get_client = get_client
+    utils_module.get_credential_broker = get_credential_broker
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+"""
+Copyright 2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this
+software and associated documentation files (the "Software"), to deal in the Software
+without restriction, including without limitation the rights to use, copy, modify,
+merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+This script runs the enable and disable scripts, and the organization scripts, against the
+in-process fake AWS backend of fakeaws.py for synthetic fleets of accounts and regions, and reports the wall time, the API
+calls per operation and the peak memory of each run.
+"""
+
+import argparse
+import builtins
+import contextlib
+import json
+import os
+import runpy
+import shlex
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fakeaws
+
+MASTER_ACCOUNT = '100000000000'
+ROLE_NAME = 'AWSCloudFormationStackSetExecutionRole'
+
+# Script, the arguments it always runs with and its default extra arguments, replaced by --args,
+# in the order the scenarios run. The organization scripts run in the master account of the
+# organization and take no accounts file, {master_region} is the first region of the fleet
+SCENARIOS = [
+    ('enableguardduty', 'enableguardduty.py', ['--linking'], ['--batch', '--workers', '10']),
+    ('enablesecurityhub', 'enablesecurityhub.py', [], ['--asyncio']),
+    ('disableguardduty', 'disableguardduty.py', [], []),
+    ('disablesecurityhub', 'disablesecurityhub.py', [], ['--bulk']),
+    ('enableguarddutyfororg', 'organization/enableguarddutyfororg.py', [], []),
+    ('enablesecurityhubfororg', 'organization/enablesecurityhubfororg.py', ['--master_region', '{master_region}'], []),
+    ('disableguarddutyfororg', 'organization/disableguarddutyfororg.py', [], []),
+    ('disablesecurityhubfororg', 'organization/disablesecurityhubfororg.py', ['--master_region', '{master_region}'], []),
+]
+
+# Modules of the repository imported again for every run, so that no state leaks between runs
+REPO_MODULES = ['utils', 'enableguardduty', 'enablesecurityhub', 'disableguardduty', 'disablesecurityhub']
+
+
+def write_accounts(path, count):
+    """
+    Writes the accounts file of a synthetic fleet
+    :return: dict of AwsAccountId:Email
+    """
+
+    aws_account_dict = dict(
+        ('{:012d}'.format(200000000000 + index), 'member{}@example.com'.format(index))
+        for index in range(count)
+    )
+
+    with open(path, 'w') as output_file:
+        for account, email in aws_account_dict.items():
+            output_file.write('{},{}\n'.format(account, email))
+
+    return aws_account_dict
+
+
+def run_script(backend, script, arguments, verbose):
+    """
+    Runs a script as __main__ against the backend
+    :return: dict with the wall time, peak memory, API calls and exit status of the run
+    """
+
+    for module in REPO_MODULES:
+        sys.modules.pop(module, None)
+
+    import utils
+    fakeaws.install(utils, backend, MASTER_ACCOUNT)
+    backend.reset_calls()
+
+    saved_argv, saved_input = sys.argv, builtins.input
+    sys.argv = [script] + arguments
+    builtins.input = lambda *args: 'yes'
+
+    status = 0
+    output = sys.stdout if verbose else open(os.devnull, 'w')
+    tracemalloc.start()
+    start_time = time.time()
+    try:
+        with contextlib.redirect_stdout(output):
+            runpy.run_path(os.path.join(ROOT_DIR, script), run_name='__main__')
+    except SystemExit as e:
+        status = e.code or 0
+    except Exception as e:
+        print("Error running {}: {}".format(script, repr(e)))
+        status = 1
+    finally:
+        elapsed = time.time() - start_time
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        sys.argv, builtins.input = saved_argv, saved_input
+        if not verbose:
+            output.close()
+
+    calls = dict(('{}.{}'.format(service, operation), count) for (service, operation), count in sorted(backend.calls.items()))
+
+    return {
+        'wall_time': elapsed,
+        'peak_memory': peak,
+        'api_calls': sum(calls.values()),
+        'calls': calls,
+        'status': status
+    }
+
+
+def print_results(results):
+    print("---------------------------------------------------------------")
+    print("Benchmark Results")
+    print("---------------------------------------------------------------")
+    print("{:<24} {:>8} {:>8} {:>10} {:>10} {:>10}".format('Script', 'Accounts', 'Regions', 'Wall (s)', 'API calls', 'Peak (MB)'))
+    for result in results:
+        print("{:<24} {:>8} {:>8} {:>10.2f} {:>10} {:>10.1f}{}".format(
+            result['scenario'],
+            result['accounts'],
+            result['regions'],
+            result['wall_time'],
+            result['api_calls'],
+            result['peak_memory'] / 1024.0 / 1024.0,
+            '' if result['status'] == 0 else '  (exit status {})'.format(result['status'])
+        ))
+    print("---------------------------------------------------------------")
+
+    for result in results:
+        print("{} with {} accounts x {} regions:".format(result['scenario'], result['accounts'], result['regions']))
+        for operation, count in sorted(result['calls'].items(), key=lambda item: -item[1]):
+            print("\t{:<50} {:>8}".format(operation, count))
+    print("---------------------------------------------------------------")
+
+
+if __name__ == '__main__':
+
+    # Setup command line arguments
+    parser = argparse.ArgumentParser(description='Benchmark the scripts against a local fake AWS backend')
+    parser.add_argument('--accounts', type=str, default='10,100', help="comma separated list of fleet sizes. Defaults to 10,100")
+    parser.add_argument('--regions', type=int, default=2, help="number of regions of the fleet. Defaults to 2")
+    parser.add_argument('--scenarios', type=str, default=','.join(scenario[0] for scenario in SCENARIOS), help="comma separated list of scripts to run, in order. Defaults to all of them")
+    parser.add_argument('--latency', type=float, default=0.01, help="seconds every API call takes. Defaults to 0.01")
+    parser.add_argument('--page_size', type=int, default=50, help="number of items in a page of the list calls. Defaults to 50")
+    parser.add_argument('--consistency_delay', type=float, default=0.0, help="seconds before member and invitation changes are visible. Defaults to 0")
+    parser.add_argument('--standards_delay', type=float, default=0.0, help="seconds a standards subscription stays PENDING. Defaults to 0")
+    parser.add_argument('--args', action='append', default=[], help="extra arguments of a script replacing its defaults, i.e. --args 'enableguardduty=--workers 20'. Can be repeated. Defaults to the batched, asyncio and bulk modes of the enable and disable scripts")
+    parser.add_argument('--output', type=str, help="path of a JSON file to write the results to")
+    parser.add_argument('-v', '--verbose', action="store_true", help="show the output of the scripts")
+    args = parser.parse_args()
+
+    scenarios = dict((scenario[0], scenario) for scenario in SCENARIOS)
+    selected = [str(item) for item in args.scenarios.split(',')]
+    for name in selected:
+        if name not in scenarios:
+            raise ValueError("Unknown scenario {}".format(name))
+
+    extra_arguments = dict()
+    for item in args.args:
+        name, _, arguments = item.partition('=')
+        if name not in scenarios:
+            raise ValueError("Unknown scenario {}".format(name))
+        extra_arguments[name] = shlex.split(arguments)
+
+    regions = ['region-{}'.format(index) for index in range(args.regions)]
+    results = []
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        for count in [int(item) for item in args.accounts.split(',')]:
+            # Every fleet size starts from an empty backend, the scenarios then run on the same state
+            backend = fakeaws.FakeAWS(args.latency, args.page_size, args.consistency_delay, args.standards_delay, regions)
+            accounts_path = os.path.join(work_dir, 'accounts-{}.csv'.format(count))
+            aws_account_dict = write_accounts(accounts_path, count)
+            backend.add_accounts(aws_account_dict)
+
+            for name in selected:
+                scenario, script, arguments, default_arguments = scenarios[name]
+                arguments = [
+                    '--master_account', MASTER_ACCOUNT,
+                    '--enabled_regions', ','.join(regions)
+                ] + [argument.format(master_region=regions[0]) for argument in arguments] + extra_arguments.get(name, default_arguments)
+                if not script.startswith('organization/'):
+                    arguments += ['--assume_role', ROLE_NAME, accounts_path]
+
+                print("Running {} with {} accounts x {} regions".format(scenario, count, len(regions)))
+                result = run_script(backend, script, arguments, args.verbose)
+                result.update({'scenario': scenario, 'accounts': count, 'regions': len(regions)})
+                results.append(result)
+
+    print_results(results)
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+        print("Results written to {}".format(args.output))
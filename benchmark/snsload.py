@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+"""
+Copyright 2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this
+software and associated documentation files (the "Software"), to deal in the Software
+without restriction, including without limitation the rights to use, copy, modify,
+merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+This script stands in for SNS in front of snsreceiver.py. It posts Notification messages in the
+SNS HTTP(S) format, each carrying the EventBridge event of data/findiings_sample.json with a new
+finding id, over concurrent keep-alive connections and reports the delivered events per second.
+With --key the messages are signed with the private key of the certificate that the receiver
+trusts with --test_cert, --generate_cert writes such a self-signed certificate and key.
+"""
+
+import argparse
+import asyncio
+import base64
+import copy
+import datetime
+import json
+import os
+import ssl
+import time
+import uuid
+
+try:
+    from cryptography import x509
+    from cryptography.x509.oid import NameOID
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import padding, rsa
+except ImportError:
+    x509 = None
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TOPIC_ARN = 'arn:aws:sns:us-east-1:123456789012:SecurityHubFindings'
+SIGNING_CERT_URL = 'https://sns.us-east-1.amazonaws.com/SimpleNotificationService-local.pem'
+
+
+def generate_cert(cert_path, key_path):
+    """
+    Writes a self-signed certificate and its private key in PEM format
+    """
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'sns.us-east-1.amazonaws.com')])
+    now = datetime.datetime.utcnow()
+    cert = x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(key.public_key()) \
+        .serial_number(x509.random_serial_number()).not_valid_before(now) \
+        .not_valid_after(now + datetime.timedelta(days=365)).sign(key, hashes.SHA256())
+
+    with open(cert_path, 'wb') as cert_file:
+        cert_file.write(cert.public_bytes(serialization.Encoding.PEM))
+    with open(key_path, 'wb') as key_file:
+        key_file.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL, serialization.NoEncryption()))
+
+
+def build_message(event, key, signature_version):
+    """
+    :return: SNS Notification body of the event, signed with the private key if one is given
+    """
+
+    event = copy.deepcopy(event)
+    event['id'] = str(uuid.uuid4())
+    for finding in event.get('detail', {}).get('findings', []):
+        finding['Id'] = '{}/{}'.format(finding.get('Id', 'finding'), event['id'])
+
+    message = {
+        'Type': 'Notification',
+        'MessageId': str(uuid.uuid4()),
+        'TopicArn': TOPIC_ARN,
+        'Message': json.dumps(event),
+        'Timestamp': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z',
+        'SignatureVersion': signature_version,
+        'SigningCertURL': SIGNING_CERT_URL,
+        'UnsubscribeURL': 'https://sns.us-east-1.amazonaws.com/?Action=Unsubscribe',
+    }
+    if key is not None:
+        string_to_sign = ''.join(
+            '{}\n{}\n'.format(field, message[field]) for field in ('Message', 'MessageId', 'Timestamp', 'TopicArn', 'Type')
+        ).encode('utf-8')
+        algorithm = hashes.SHA256() if signature_version == '2' else hashes.SHA1()
+        message['Signature'] = base64.b64encode(key.sign(string_to_sign, padding.PKCS1v15(), algorithm)).decode('ascii')
+
+    return json.dumps(message).encode('utf-8')
+
+
+async def post_messages(host, port, ssl_context, bodies, statuses):
+    """
+    Posts the bodies one after the other over a single keep-alive connection
+    """
+
+    reader, writer = await asyncio.open_connection(host, port, ssl=ssl_context)
+    try:
+        for body in bodies:
+            writer.write(
+                'POST / HTTP/1.1\r\nHost: {}\r\nContent-Type: text/plain; charset=UTF-8\r\n'
+                'x-amz-sns-message-type: Notification\r\nx-amz-sns-topic-arn: {}\r\nContent-Length: {}\r\n\r\n'.format(
+                    host, TOPIC_ARN, len(body)
+                ).encode('latin-1') + body
+            )
+            await writer.drain()
+
+            status = int((await reader.readline()).split(b' ')[1])
+            length = 0
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b''):
+                    break
+                if line.lower().startswith(b'content-length:'):
+                    length = int(line.split(b':')[1])
+            await reader.readexactly(length)
+            statuses[status] = statuses.get(status, 0) + 1
+    finally:
+        writer.close()
+
+
+async def main(args):
+    with open(os.path.join(ROOT_DIR, 'data', 'findiings_sample.json')) as sample_file:
+        event = json.load(sample_file)
+
+    key = None
+    if args.key:
+        with open(args.key, 'rb') as key_file:
+            key = serialization.load_pem_private_key(key_file.read(), password=None)
+
+    # Messages are built and signed before the clock starts, only the delivery is measured
+    bodies = [build_message(event, key, args.signature_version) for _ in range(args.messages)]
+
+    ssl_context = None
+    if args.https:
+        ssl_context = ssl.create_default_context()
+        ssl_context.check_hostname = False
+        ssl_context.verify_mode = ssl.CERT_NONE
+
+    statuses = dict()
+    start_time = time.time()
+    await asyncio.gather(*[
+        post_messages(args.host, args.port, ssl_context, bodies[index::args.connections], statuses)
+        for index in range(args.connections)
+    ])
+    elapsed = time.time() - start_time
+
+    print("Posted {} messages over {} connections in {:.2f}s, {:.0f} messages/s".format(
+        len(bodies), args.connections, elapsed, len(bodies) / elapsed
+    ))
+    print("Responses: {}".format(', '.join('{} {}'.format(count, status) for status, count in sorted(statuses.items()))))
+
+
+if __name__ == '__main__':
+
+    # Setup command line arguments
+    parser = argparse.ArgumentParser(description='Post SNS-format finding notifications to snsreceiver.py')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help="address of the receiver. Defaults to 127.0.0.1")
+    parser.add_argument('--port', type=int, default=8080, help="port of the receiver. Defaults to 8080")
+    parser.add_argument('--https', action="store_true", help="connect to the receiver over HTTPS, its certificate is not verified")
+    parser.add_argument('--messages', type=int, default=10000, help="number of messages to post. Defaults to 10000")
+    parser.add_argument('--connections', type=int, default=20, help="number of concurrent keep-alive connections. Defaults to 20")
+    parser.add_argument('--key', type=str, help="path of the PEM private key to sign the messages with. If not specified, the messages are unsigned and the receiver needs --no_verify")
+    parser.add_argument('--signature_version', type=str, default='1', choices=['1', '2'], help="SignatureVersion of the messages, 1 is SHA1 and 2 is SHA256. Defaults to 1")
+    parser.add_argument('--generate_cert', type=str, nargs=2, metavar=('CERT', 'KEY'), help="write a self-signed certificate and its private key to use with --test_cert and --key, then exit")
+    args = parser.parse_args()
+
+    if (args.key or args.generate_cert) and x509 is None:
+        raise ValueError("Signing the messages requires the cryptography package, install it with pip install cryptography")
+
+    if args.generate_cert:
+        generate_cert(*args.generate_cert)
+        print("Wrote {} and {}".format(*args.generate_cert))
+    else:
+        asyncio.run(main(args))
@@ -8,12 +8,12 @@ import time
 import argparse
 import re
 
-import boto3
 import botocore
 
 import utils
 
-cf = boto3.client('cloudformation') 
+# CloudFormation client, created once the rate limiter is configured
+cf = None
 log = logging.getLogger('deploy.cf.create_or_update') 
 stackset_id = ''
 
@@ -72,7 +72,7 @@ def create_stackset_instances(name, accounts, targets, regions, self_managed_per
                     name))
         elif e.response['Error']['Code'] == 'Throttling':
             raise Exception(
-                "Throttling exception encountered while creating stack instances.")
+                "Throttling exception encountered while creating stack instances, retries exhausted.")
         elif e.response['Error']['Code'] == 'StackSetNotFoundException':
             raise Exception(
                 "No StackSet matching {}. You must create before creating stack instances.".format(
@@ -91,8 +91,16 @@ if __name__ == '__main__':
     parser.add_argument('--enabled_regions', type=str, help="comma separated list of regions to deploy stackset instances. If not specified, all available regions deployed")
     parser.add_argument('--manage_account', type=str, help="AccountId for Management Account")
     parser.add_argument('--ou', type=str, required=True, help="Orgnaization ID")
+    parser.add_argument('--metrics', type=str, help="path of a JSON file to write the per-operation API call metrics and latency histograms to, a summary is printed at the end of the run")
     args = parser.parse_args()
 
+    # Count the calls, retries, throttles and errors and time every API call of the run
+    utils.configure_api_metrics()
+
+    # Throttled CloudFormation calls slow down the client and are retried by botocore before surfacing
+    utils.configure_rate_limiter()
+    cf = utils.get_client(None, 'cloudformation')
+
     self_managed_permission = args.self
     parameter_data = []
 
@@ -126,5 +134,4 @@ if __name__ == '__main__':
     if operation_id != '':
         print('Start to create instances for stackset {}'.format(args.name))
 
-        
-
+    utils.print_api_metrics(args.metrics)
@@ -7,7 +7,6 @@ import json
 import sys
 import argparse
 
-import boto3
 import botocore
 
 import utils
@@ -29,8 +28,12 @@ if __name__ == '__main__':
     parser.add_argument('--template', type=str, required=True, help='Path to Cloudformation template file')
     parser.add_argument('--parameters', type=str, help='Path to parameters json file')
     parser.add_argument('--enabled_regions', type=str, help="comma separated list of regions to deploy stack. If not specified, will only deploy to us-east-1")
+    parser.add_argument('--metrics', type=str, help="path of a JSON file to write the per-operation API call metrics and latency histograms to, a summary is printed at the end of the run")
     args = parser.parse_args()
-    
+
+    # Count the calls, retries, throttles and errors and time every API call of the run
+    utils.configure_api_metrics()
+
     # Update or create stack
     template_data = utils.parse_template(args.template)
     if args.parameters != None:
@@ -54,7 +57,7 @@ if __name__ == '__main__':
         regions = args.enabled_regions
 
     for region in regions.split(','):
-        cf = boto3.client('cloudformation', region_name=region)
+        cf = utils.get_client(None, 'cloudformation', region)
         try:
             if utils.stack_exists(args.name, region):
                 print('Updating {} in region {}'.format(args.name, region))
@@ -77,4 +80,6 @@ if __name__ == '__main__':
                 cf.describe_stacks(StackName=stack_result['StackId']),
                 indent=2,
                 default=json_serial
-            ))
\ No newline at end of file
+            ))
+
+    utils.print_api_metrics(args.metrics)
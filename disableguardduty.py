@@ -18,13 +18,17 @@ It removes each account as a Member in the GuardDuty Master account.
 import boto3
 import re
 import argparse
+import utils
 
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from botocore.exceptions import ClientError
 
 
 cloudformation_exec_role = 'AWSCloudFormationStackSetExecutionRole'
 
+ROLE_SESSION_NAME = 'EnableGuardDuty'
+
 def list_detectors(client, aws_region):
     """
     Lists the detectors in a given Account/Region
@@ -44,55 +48,105 @@ def list_detectors(client, aws_region):
     return detector_dict
 
 def list_members(client, detector_id):
+    """
+    Lists all the members of a detector, page by page
+    :param client: GuardDuty client
+    :param detector_id: DetectorId of the master account
+    :return: dict of AwsAccountId:RelationshipStatus
+    """
 
     member_dict = dict()
 
-    response = client.list_members(
-        DetectorId=detector_id,
-        OnlyAssociated='false'
-    )
-
-    for member in response['Members']:
-        member_dict.update({member['AccountId']:member['RelationshipStatus']})
+    for response in client.get_paginator('list_members').paginate(DetectorId=detector_id, OnlyAssociated='false'):
+        for member in response['Members']:
+            member_dict.update({member['AccountId']:member['RelationshipStatus']})
 
     return member_dict
 
-def assume_role(aws_account_number, role_name):
+def remove_members(master_session, aws_region, account_ids, master_account, delete_master, workers):
     """
-    Assumes the provided role in each account and returns a GuardDuty client
-    :param aws_account_number: AWS Account Number
-    :param role_name: Role to assume in target account
-    :param aws_region: AWS Region for the Client call, not required for IAM calls
-    :return: GuardDuty client in the specified AWS Account and Region
+    Disassociates and deletes the members of the master account in a region
+    The member API calls are chunked to the API maximum of 50 accounts and the chunks are sent concurrently
+    :param account_ids: list of AWS Account Numbers to remove, ignored with delete_master where all members are removed
+    :param delete_master: Remove all the members and delete the detector of the master account
+    :param workers: Number of chunks sent at the same time
+    :return: dict of AwsAccountId:Result for the accounts that could not be removed
     """
 
-    # Beginning the assume role process for account
-    sts_client = boto3.client('sts')
-    
-    # Get the current partition
-    partition = sts_client.get_caller_identity()['Arn'].split(":")[1]
-    
-    response = sts_client.assume_role(
-        RoleArn='arn:{}:iam::{}:role/{}'.format(
-            partition,
-            aws_account_number,
-            role_name
-        ),
-        RoleSessionName='EnableGuardDuty'
-    )
-    
-    # Storing STS credentials
-    session = boto3.Session(
-        aws_access_key_id=response['Credentials']['AccessKeyId'],
-        aws_secret_access_key=response['Credentials']['SecretAccessKey'],
-        aws_session_token=response['Credentials']['SessionToken']
-    )
+    gd_client = utils.get_client(master_session, 'guardduty', aws_region)
+
+    detector_dict = list_detectors(gd_client, aws_region)
+
+    detector_id = detector_dict[aws_region]
+
+    if detector_id == '':
+        print('No detector found for {account} in {region}'.format(
+            account=master_account,
+            region=aws_region
+        ))
+        return dict()
+
+    print('GuardDuty is active in {region}'.format(region=aws_region))
+
+    unprocessed = dict()
+    member_dict = list_members(gd_client, detector_id)
+
+    if member_dict:
+        print('There are members in {region}'.format(region=aws_region))
+        if delete_master:
+            account_ids = list(member_dict.keys())
+        else:
+            # Accounts that are not members would come back unprocessed and be retried for nothing
+            account_ids = [account for account in account_ids if account in member_dict]
+
+        for operation in (gd_client.disassociate_members, gd_client.delete_members):
+            unprocessed.update(utils.call_in_chunks(
+                operation, account_ids,
+                lambda chunk: {'AccountIds': chunk, 'DetectorId': detector_id},
+                workers=workers
+            ))
+
+        print('Deleting members for {account} in {region}'.format(
+            account=master_account,
+            region=aws_region
+        ))
+
+    if delete_master:
+        gd_client.delete_detector(
+            DetectorId=detector_id
+        )
+
+    return unprocessed
+
+def delete_member_detector(session, account, aws_region):
+    """
+    Deletes the detector of a member account in a region, if any
+    """
+
+    gd_client = utils.get_client(session, 'guardduty', aws_region)
+
+    detector_dict = list_detectors(gd_client, aws_region)
+
+    detector_id = detector_dict[aws_region]
 
-    print("Assumed session for {}.".format(
-        aws_account_number
-    ))
+    if detector_id != '':
+        print('GuardDuty is active in {region}'.format(region=aws_region))
 
-    return session
+        gd_client.delete_detector(
+            DetectorId=detector_id
+        )
+
+        print('Deleted {detector} for {account} in {region}.'.format(
+            detector=detector_id,
+            account=account,
+            region=aws_region
+        ))
+
+    else:
+        print('No detector found for {account} in {region}'.format(
+            account=account,
+            region=aws_region
+        ))
 
 if __name__ == '__main__':
     
@@ -103,11 +157,29 @@ if __name__ == '__main__':
     parser.add_argument('--assume_role', type=str, required=True, help="Role Name to assume in each account")
     parser.add_argument('--delete_master', action='store_true', default=False, help="Delete the master Gd Detector")
     parser.add_argument('--enabled_regions', type=str, help="comma separated list of regions to remove GuardDuty. If not specified, all available regions disabled")
+    parser.add_argument('--workers', type=int, default=10, help="number of regions, member API chunks and member detectors processed concurrently. Defaults to 10")
+    parser.add_argument('--metrics', type=str, help="path of a JSON file to write the per-operation API call metrics and latency histograms to, a summary is printed at the end of the run")
+    parser.add_argument('--event_log', type=str, help="path of a JSON lines file the structured events of the run (account, region, phase, outcome, duration, error) are appended to")
+    parser.add_argument('--event_console', action="store_true", help="print a human-readable line for every structured event")
     args = parser.parse_args()
     
     # Validate master accountId
     if not re.match(r'[0-9]{12}',args.master_account):
         raise ValueError("Master AccountId is not valid")
+
+    if args.workers < 1:
+        raise ValueError("--workers must be at least 1")
+
+    if args.event_log or args.event_console:
+        utils.open_event_log(args.event_log, args.event_console)
+
+    # Count the calls, retries, throttles and errors and time every API call of the run
+    utils.configure_api_metrics()
+
+    # Size the connection pools so that every worker can hold a connection
+    utils.configure_client_pool(max_pool_connections=max(10, args.workers))
+    # Parallel calls hit the GuardDuty request limits, pace them per operation, region and account
+    utils.configure_rate_limiter()
     
     
     # Generate dict with account & email information
@@ -136,113 +208,81 @@ if __name__ == '__main__':
         print("Disabling members in all available GuardDuty regions {}".format(guardduty_regions))
     
     failed_master_regions = []
-    master_session = assume_role(args.master_account, args.assume_role)
+    master_session = utils.assume_role(args.master_account, args.assume_role, ROLE_SESSION_NAME)
             
-    for aws_region in guardduty_regions:
-        try:
-            gd_client = master_session.client('guardduty', region_name=aws_region)
-
-            detector_dict = list_detectors(gd_client, aws_region)
-
-            detector_id = detector_dict[aws_region]
-
-            if detector_id != '':
-                print('GuardDuty is active in {region}'.format(region=aws_region))
+    # Regions are independent, the members of all the regions are removed concurrently
+    results = utils.run_regions(
+        guardduty_regions,
+        lambda aws_region: remove_members(master_session, aws_region, list(aws_account_dict.keys()), args.master_account, args.delete_master, args.workers),
+        args.workers
+    )
 
-            if detector_id != '':
-                member_dict = list_members(gd_client, detector_id)
-            
-                if member_dict:
-                    print('There are members in {region}'.format(region=aws_region))
-                    if args.delete_master:
-                    
-                        response = gd_client.disassociate_members(
-                            AccountIds=list(member_dict.keys()),
-                            DetectorId=detector_id
-                        )
-                    
-                        response = gd_client.delete_members(
-                            DetectorId=detector_id,
-                            AccountIds=list(member_dict.keys())
-                        )
-                    
-                    else:
-                        response = gd_client.disassociate_members(
-                            AccountIds=list(aws_account_dict.keys()),
-                            DetectorId=detector_id
-                        )
-                    
-                        response = gd_client.delete_members(
-                            DetectorId=detector_id,
-                            AccountIds=list(aws_account_dict.keys())
-                        )
-                
-                    print('Deleting members for {account} in {region}'.format(
-                        account=args.master_account,
-                        region=aws_region
-                    ))
-    
-                if args.delete_master:
-                    response = gd_client.delete_detector(
-                        DetectorId=detector_id
-                    )
-            else:
-                print('No detector found for {account} in {region}'.format(
-                    account=args.master_account,
-                    region=aws_region
+    failed_accounts = []
+    for aws_region, result in results.items():
+        utils.log_event('guardduty', args.master_account, aws_region, 'members_removed', 'completed' if result.ok else 'failed',
+                        duration=result.elapsed, error=result.error, unprocessed=len(result.value) if result.ok else None)
+        if result.ok:
+            for account, reason in result.value.items():
+                utils.log_event('guardduty', account, aws_region, 'member_removed', 'failed', error=reason)
+                print('The member account {account} in {region} was not processed: {reason}'.format(
+                    account=account,
+                    region=aws_region,
+                    reason=reason
                 ))
-        except ClientError as err:
-            if err.response['ResponseMetadata']['HTTPStatusCode'] == 403:
-                print("Failed to list detectors in Master account for region: {} due to an authentication error.  Either your credentials are not correctly configured or the region is an OptIn region that is not enabled on the master account.  Skipping {} and attempting to continue".format(aws_region, aws_region))
-                failed_master_regions.append(aws_region) 
-                
+                failed_accounts.append({
+                    account: "Member removal failed in {}: {}".format(aws_region, reason)
+                })
+        elif result.error.response['ResponseMetadata']['HTTPStatusCode'] == 403:
+            print("Failed to list detectors in Master account for region: {} due to an authentication error.  Either your credentials are not correctly configured or the region is an OptIn region that is not enabled on the master account.  Skipping {} and attempting to continue".format(aws_region, aws_region))
+            failed_master_regions.append(aws_region)
+        else:
+            print("Error removing members in {}: {}".format(aws_region, repr(result.error)))
+
     for failed_region in failed_master_regions:
         guardduty_regions.remove(failed_region)
 
-    failed_accounts = []
-    for account_str, account_email in aws_account_dict.items():
-        try:
-            session = assume_role(account_str, args.assume_role)
-            
+    # Assume every account up front, accounts that fail here are reported once instead of once per region
+    failed_assumes = utils.get_credential_broker(ROLE_SESSION_NAME).prewarm(aws_account_dict.keys(), args.assume_role, args.workers)
+    for account_str, e in failed_assumes.items():
+        utils.log_event('guardduty', account_str, None, 'account', 'failed', error=e)
+        print("Error Processing Account {}".format(account_str))
+        failed_accounts.append({
+            account_str: repr(e)
+        })
+
+    def delete_detector(account_str, aws_region):
+        utils.log_event('guardduty', account_str, aws_region, 'started')
+        session = utils.assume_role(account_str, args.assume_role, ROLE_SESSION_NAME)
+        delete_member_detector(session, account_str, aws_region)
+        utils.log_event('guardduty', account_str, aws_region, 'detector_deleted', 'completed')
+
+    # Member detectors are deleted in parallel
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = dict()
+        for account_str in aws_account_dict.keys():
+            if account_str in failed_assumes:
+                continue
             for aws_region in guardduty_regions:
-                gd_client = session.client('guardduty', region_name=aws_region)
-    
-                detector_dict = list_detectors(gd_client, aws_region)
-    
-                detector_id = detector_dict[aws_region]
-    
-                if detector_id != '':
-                    print('GuardDuty is active in {region}'.format(region=aws_region))
-    
-                if detector_id != '':
-                    response = gd_client.delete_detector(
-                        DetectorId=detector_id
-                    )
-                    
-                    print('Deleted {detector} for {account} in {region}.'.format(
-                        detector=detector_id,
-                        account=account_str,
-                        region=aws_region
-                    ))
-                    
-                else:
-                    print('No detector found for {account} in {region}'.format(
-                        account=account_str,
-                        region=aws_region
-                    ))
-        except ClientError as e:
-            print("Error Processing Account {}".format(account_str))
-            failed_accounts.append({
-                account_str: repr(e)
-            })
-    
+                futures[executor.submit(delete_detector, account_str, aws_region)] = (account_str, aws_region)
+
+        for future in as_completed(futures):
+            account_str, aws_region = futures[future]
+            try:
+                future.result()
+            except ClientError as e:
+                utils.log_event('guardduty', account_str, aws_region, 'detector_deleted', 'failed', error=e)
+                print("Error Processing Account {} in {}".format(account_str, aws_region))
+                failed_accounts.append({
+                    account_str: repr(e)
+                })
+
+    utils.print_api_metrics(args.metrics)
+
     if len(failed_accounts) > 0:
         print("---------------------------------------------------------------")
         print("Failed Accounts")
         print("---------------------------------------------------------------")
         for account in failed_accounts:
-            print("{}: \n\t{}".format(
-                account.keys()[0],
-                account[account.keys()[0]]
-            ))
+            for account_id, message in account.items():
+                print("{}: \n\t{}".format(account_id, message))
             print("---------------------------------------------------------------")
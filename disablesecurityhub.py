@@ -23,8 +23,11 @@ import time
 import utils
 
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from botocore.exceptions import ClientError
 
+ROLE_SESSION_NAME = 'EnableSecurityHub'
+
 
 def get_master_members(sh_client, aws_region):
     """
@@ -54,42 +57,106 @@ def get_master_members(sh_client, aws_region):
             
     return member_dict
 
-def assume_role(aws_account_number, role_name):
+
+def run_in_member_accounts(account_ids, role_name, aws_region, action, workers, phase):
     """
-    Assumes the provided role in each account and returns a SecurityHub client
-    :param aws_account_number: AWS Account Number
-    :param role_name: Role to assume in target account
-    :param aws_region: AWS Region for the Client call, not required for IAM calls
-    :return: SecurityHub client in the specified AWS Account and Region
+    Runs an action in the member accounts of a region in parallel
+    :param action: function of (sh_client, account) called with the SecurityHub client of the member account
+    :param workers: Number of member accounts processed at the same time
+    :param phase: Name of the action in the event log
+    :return: list of {AwsAccountId: error} for the accounts where the action failed
     """
 
-    # Beginning the assume role process for account
-    sts_client = boto3.client('sts')
-    
-    # Get the current partition
-    partition = sts_client.get_caller_identity()['Arn'].split(":")[1]
-    
-    response = sts_client.assume_role(
-        RoleArn='arn:{}:iam::{}:role/{}'.format(
-            partition,
-            aws_account_number,
-            role_name
-        ),
-        RoleSessionName='EnableSecurityHub'
-    )
-    
-    # Storing STS credentials
-    session = boto3.Session(
-        aws_access_key_id=response['Credentials']['AccessKeyId'],
-        aws_secret_access_key=response['Credentials']['SecretAccessKey'],
-        aws_session_token=response['Credentials']['SessionToken']
-    )
+    failed_accounts = []
+
+    def run(account):
+        session = utils.assume_role(account, role_name, ROLE_SESSION_NAME)
+        action(utils.get_client(session, 'securityhub', aws_region), account)
+        utils.log_event('securityhub', account, aws_region, phase, 'completed')
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = dict((executor.submit(run, account), account) for account in account_ids)
+        for future in as_completed(futures):
+            account = futures[future]
+            try:
+                future.result()
+            except ClientError as e:
+                utils.log_event('securityhub', account, aws_region, phase, 'failed', error=e)
+                print("Error Processing Account {} in {}".format(account, aws_region))
+                failed_accounts.append({
+                    account: repr(e)
+                })
+
+    return failed_accounts
+
+
+def disable_members_bulk(master_client, aws_region, account_ids, role_name, master_account, workers):
+    """
+    Unlinks and disables the member accounts of a region in bulk
+    The member accounts leave the master account in parallel, the master account disassociates and deletes
+    the members in chunks of up to 50 accounts and the shared membership poller confirms the removal
+    :param master_client: SecurityHub client of the master account in the AWS Region
+    :param account_ids: list of AWS Account Numbers to disable
+    :param role_name: Role to assume in the member accounts
+    :param workers: Number of member accounts processed at the same time
+    :return: list of {AwsAccountId: error} for the accounts that could not be disabled
+    """
 
-    print("Assumed session for {}.".format(
-        aws_account_number
+    member_index = utils.get_member_index(master_client)
+    targets = [account for account in account_ids if account in member_index]
+    print('Removing {count} members from SecurityHub master account {master} in region {region}'.format(
+        count=len(targets),
+        master=master_account,
+        region=aws_region
     ))
 
-    return session
+    def leave_master(sh_client, account):
+        if sh_client.get_master_account().get('Master'):
+            sh_client.disassociate_from_master_account()
+
+    failed_accounts = run_in_member_accounts(targets, role_name, aws_region, leave_master, workers, 'left_master')
+
+    for operation in (master_client.disassociate_members, master_client.delete_members):
+        unprocessed = utils.call_in_chunks(operation, targets, lambda chunk: {'AccountIds': chunk})
+        for account, result in unprocessed.items():
+            print('The member account {account} in {region} was not processed by {operation}: {reason}'.format(
+                account=account,
+                region=aws_region,
+                operation=operation.__name__,
+                reason=result
+            ))
+            failed_accounts.append({
+                account: "{} failed in {}: {}".format(operation.__name__, aws_region, result)
+            })
+
+    # The removal is eventually consistent, the shared poller confirms it with batched get_members calls
+    still_members = set(utils.get_membership_poller(member_index).wait_for_all(targets, lambda status: status is None, 300))
+    for account in targets:
+        if account in still_members:
+            utils.log_event('securityhub', account, aws_region, 'member_removed', 'failed', error="Membership is still present, last status: {}".format(member_index.get(account)))
+            print("Membership of account {} is still present, skipping".format(account))
+            failed_accounts.append({
+                account: "Membership of account {} in {} is still present, last status: {}".format(
+                    account,
+                    aws_region,
+                    member_index.get(account)
+                )
+            })
+        else:
+            utils.log_event('securityhub', account, aws_region, 'member_removed', 'completed')
+            print('Removed Account {monitored} from member list in SecurityHub master account {master} for region {region}'.format(
+                monitored=account,
+                master=master_account,
+                region=aws_region
+            ))
+
+    # Security Hub is only disabled in the accounts that are confirmed not to be members anymore
+    removed = [account for account in account_ids if account not in still_members]
+    failed_accounts.extend(run_in_member_accounts(removed, role_name, aws_region, lambda sh_client, account: sh_client.disable_security_hub(), workers, 'hub_disabled'))
+
+    print('Finished {count} accounts in {region}'.format(count=len(account_ids), region=aws_region))
+
+    return failed_accounts
 
 if __name__ == '__main__':
     
@@ -101,11 +168,31 @@ if __name__ == '__main__':
     parser.add_argument('--delete_master', action='store_true', default=False, help="Disable SecurityHub in Master")
     parser.add_argument('--enabled_regions', type=str, help="comma separated list of regions to remove SecurityHub. If not specified, all available regions disabled")
     parser.add_argument('--disable_standards_only', type=str, required=False,help="comma separated list of standards ARNs to disable (ie. arn:aws:securityhub:::ruleset/cis-aws-foundations-benchmark/v/1.2.0 )")
+    parser.add_argument('--bulk', action='store_true', default=False, help="remove the members region by region with chunked member API calls and parallel member account calls")
+    parser.add_argument('--workers', type=int, default=10, help="number of member accounts processed concurrently with --bulk. Defaults to 10")
+    parser.add_argument('--metrics', type=str, help="path of a JSON file to write the per-operation API call metrics and latency histograms to, a summary is printed at the end of the run")
+    parser.add_argument('--event_log', type=str, help="path of a JSON lines file the structured events of the run (account, region, phase, outcome, duration, error) are appended to")
+    parser.add_argument('--event_console', action="store_true", help="print a human-readable line for every structured event")
     args = parser.parse_args()
     
     # Validate master accountId
     if not re.match(r'[0-9]{12}',args.master_account):
         raise ValueError("Master AccountId is not valid")
+
+    if args.bulk and args.disable_standards_only:
+        raise ValueError("--bulk cannot be combined with --disable_standards_only")
+
+    if args.event_log or args.event_console:
+        utils.open_event_log(args.event_log, args.event_console)
+
+    # Count the calls, retries, throttles and errors and time every API call of the run
+    utils.configure_api_metrics()
+
+    if args.bulk:
+        # Size the connection pools so that every worker can hold a connection
+        utils.configure_client_pool(max_pool_connections=max(10, args.workers))
+        # Parallel calls hit the SecurityHub request limits, pace them per operation, region and account
+        utils.configure_rate_limiter()
     
     
     # Generate dict with account & email information
@@ -143,100 +230,124 @@ if __name__ == '__main__':
             securityhub_regions = session.get_available_regions('securityhub')
             print("Disabling members in all available SecurityHub regions {}".format(securityhub_regions))
     
-    master_session = assume_role(args.master_account, args.assume_role)
+    master_session = utils.assume_role(args.master_account, args.assume_role, ROLE_SESSION_NAME)
     #master_session = boto3.Session()
     master_clients = {}
     members = {}
     for aws_region in securityhub_regions:
-        master_clients[aws_region] = master_session.client('securityhub', region_name=aws_region)
-        members[aws_region] = get_master_members(master_clients[aws_region], aws_region)
+        master_clients[aws_region] = utils.get_client(master_session, 'securityhub', aws_region)
+        if not args.bulk:
+            members[aws_region] = get_master_members(master_clients[aws_region], aws_region)
 
     # Processing accounts to be linked
     failed_accounts = []
-    for account in aws_account_dict.keys():
-        try:
-            session = assume_role(account, args.assume_role)
-            
-            for aws_region in securityhub_regions:
-                print('Beginning {account} in {region}'.format(
-                    account=account,
-                    region=aws_region
+    if args.bulk:
+        # Assume every account up front, accounts that fail here are reported by run_in_member_accounts
+        utils.get_credential_broker(ROLE_SESSION_NAME).prewarm(aws_account_dict.keys(), args.assume_role, args.workers)
+
+        for aws_region in securityhub_regions:
+            try:
+                failed_accounts.extend(disable_members_bulk(
+                    master_clients[aws_region], aws_region, list(aws_account_dict.keys()),
+                    args.assume_role, args.master_account, args.workers
                 ))
+            except ClientError as e:
+                print("Error removing accounts in {}".format(aws_region))
+                for account in aws_account_dict.keys():
+                    failed_accounts.append({
+                        account: repr(e)
+                    })
+
+    else:
+        for account in aws_account_dict.keys():
+            try:
+                session = utils.assume_role(account, args.assume_role, ROLE_SESSION_NAME)
+            
+                for aws_region in securityhub_regions:
+                    print('Beginning {account} in {region}'.format(
+                        account=account,
+                        region=aws_region
+                    ))
+                    utils.log_event('securityhub', account, aws_region, 'started')
                 
-                sh_client = session.client('securityhub', region_name=aws_region)
-                if args.disable_standards_only:
-                    regional_standards_arns = [utils.get_standard_arn_for_region_and_resource(aws_region, standard) for standard in standards_arns]
-                    for standard in regional_standards_arns:
-                        try:
-                            subscription_arn = 'arn:aws:securityhub:{}:{}:subscription/{}'.format(aws_region, account,standard.split(':')[-1].split('/',1)[1])
-                            sh_client.batch_disable_standards(StandardsSubscriptionArns=[subscription_arn])
-                            print("Finished disabling standard {} on account {} for region {}".format(standard,account, aws_region))
-                        except ClientError as e:
-                            print("Error disabling standards for account {}".format(account))
-                            failed_accounts.append({ account : repr(e)})
-                else:
-                    if account in members[aws_region]:
-                    
-                        if sh_client.get_master_account().get('Master'):
+                    sh_client = utils.get_client(session, 'securityhub', aws_region)
+                    if args.disable_standards_only:
+                        regional_standards_arns = [utils.get_standard_arn_for_region_and_resource(aws_region, standard) for standard in standards_arns]
+                        for standard in regional_standards_arns:
                             try:
-                                response = sh_client.disassociate_from_master_account()
-                
+                                subscription_arn = 'arn:aws:securityhub:{}:{}:subscription/{}'.format(aws_region, account,standard.split(':')[-1].split('/',1)[1])
+                                sh_client.batch_disable_standards(StandardsSubscriptionArns=[subscription_arn])
+                                utils.log_event('securityhub', account, aws_region, 'standards_disabled', 'completed', standard=standard)
+                                print("Finished disabling standard {} on account {} for region {}".format(standard,account, aws_region))
                             except ClientError as e:
-                                print("Error Processing Account {}".format(account))
-                                failed_accounts.append({
-                                    account: repr(e)
-                                })
+                                utils.log_event('securityhub', account, aws_region, 'standards_disabled', 'failed', error=e, standard=standard)
+                                print("Error disabling standards for account {}".format(account))
+                                failed_accounts.append({ account : repr(e)})
+                    else:
+                        if account in members[aws_region]:
+                    
+                            if sh_client.get_master_account().get('Master'):
+                                try:
+                                    response = sh_client.disassociate_from_master_account()
+                
+                                except ClientError as e:
+                                    print("Error Processing Account {}".format(account))
+                                    failed_accounts.append({
+                                        account: repr(e)
+                                    })
                         
-                        master_clients[aws_region].disassociate_members(
-                            AccountIds=[account]
-                        )
+                            master_clients[aws_region].disassociate_members(
+                                AccountIds=[account]
+                            )
                         
-                        time.sleep(2)
+                            time.sleep(2)
                         
-                        master_clients[aws_region].delete_members(
-                            AccountIds=[account]
-                        )
+                            master_clients[aws_region].delete_members(
+                                AccountIds=[account]
+                            )
                     
-                        print('Removed Account {monitored} from member list in SecurityHub master account {master} for region {region}'.format(
-                            monitored=account,
-                            master=args.master_account,
-                            region=aws_region
-                        ))
+                            print('Removed Account {monitored} from member list in SecurityHub master account {master} for region {region}'.format(
+                                monitored=account,
+                                master=args.master_account,
+                                region=aws_region
+                            ))
                                     
-                        start_time = int(time.time())
-                        while account in members[aws_region]:
-                            if (int(time.time()) - start_time) > 300:
-                                print("Membership did not show up for account {}, skipping".format(account))
-                                failed_accounts.append({
-                                    account: "Membership did not show up for account {} in {}".format(
-                                        account,
-                                        aws_region
-                                    )
-                                })
-                                break
+                            start_time = int(time.time())
+                            while account in members[aws_region]:
+                                if (int(time.time()) - start_time) > 300:
+                                    print("Membership did not show up for account {}, skipping".format(account))
+                                    failed_accounts.append({
+                                        account: "Membership did not show up for account {} in {}".format(
+                                            account,
+                                            aws_region
+                                        )
+                                    })
+                                    break
                             
-                            time.sleep(5)
-                            members[aws_region] = get_master_members(master_clients[aws_region], aws_region)
+                                time.sleep(5)
+                                members[aws_region] = get_master_members(master_clients[aws_region], aws_region)
 
-                    else:
-                        print('Account {monitored} is not a member of {master} in region {region}'.format(
-                            monitored=account,
-                            master=args.master_account,
-                            region=aws_region
-                        ))
+                        else:
+                            print('Account {monitored} is not a member of {master} in region {region}'.format(
+                                monitored=account,
+                                master=args.master_account,
+                                region=aws_region
+                            ))
                     
-                    sh_client.disable_security_hub()
+                        sh_client.disable_security_hub()
+                        utils.log_event('securityhub', account, aws_region, 'hub_disabled', 'completed')
 
-            # Refresh the member dictionary
-            members[aws_region] = get_master_members(master_clients[aws_region], aws_region)
+                # Refresh the member dictionary
+                members[aws_region] = get_master_members(master_clients[aws_region], aws_region)
                     
-            print('Finished {account} in {region}'.format(account=account, region=aws_region))
+                print('Finished {account} in {region}'.format(account=account, region=aws_region))
                     
-        except ClientError as e:
-            print("Error Processing Account {}".format(account))
-            failed_accounts.append({
-                account: repr(e)
-            })
+            except ClientError as e:
+                utils.log_event('securityhub', account, None, 'account', 'failed', error=e)
+                print("Error Processing Account {}".format(account))
+                failed_accounts.append({
+                    account: repr(e)
+                })
 
     if args.delete_master and len(failed_accounts) == 0 and not args.disable_standards_only:
         for aws_region in securityhub_regions:
@@ -244,13 +355,14 @@ if __name__ == '__main__':
     if args.delete_master and len(failed_accounts) == 0 and  args.disable_standards_only:
         for aws_region in securityhub_regions:
             master_clients[aws_region].batch_disable_standards(StandardsSubscriptionArns = [ args.disable_standards_only])
+
+    utils.print_api_metrics(args.metrics)
+
     if len(failed_accounts) > 0:
         print("---------------------------------------------------------------")
         print("Failed Accounts")
         print("---------------------------------------------------------------")
         for account in failed_accounts:
-            print("{}: \n\t{}".format(
-                account.keys()[0],
-                account[account.keys()[0]]
-            ))
+            for account_id, message in account.items():
+                print("{}: \n\t{}".format(account_id, message))
             print("---------------------------------------------------------------")
@@ -25,76 +25,27 @@ import sys
 import time
 import argparse
 import re
+import threading
+import utils
 
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from botocore.exceptions import ClientError
 
+ROLE_SESSION_NAME = 'EnableGuardDuty'
 
-def assume_role(aws_account_number, role_name):
-    """
-    Assumes the provided role in each account and returns a GuardDuty client
-    :param aws_account_number: AWS Account Number
-    :param role_name: Role to assume in target account
-    :param aws_region: AWS Region for the Client call, not required for IAM calls
-    :return: GuardDuty client in the specified AWS Account and Region
-    """
-
-    # Beginning the assume role process for account
-    sts_client = boto3.client('sts')
-
-    # Get the current partition
-    partition = sts_client.get_caller_identity()['Arn'].split(":")[1]
-
-    response = sts_client.assume_role(
-        RoleArn='arn:{}:iam::{}:role/{}'.format(
-            partition,
-            aws_account_number,
-            role_name
-        ),
-        RoleSessionName='EnableGuardDuty'
-    )
-
-    # Storing STS credentials
-    session = boto3.Session(
-        aws_access_key_id=response['Credentials']['AccessKeyId'],
-        aws_secret_access_key=response['Credentials']['SecretAccessKey'],
-        aws_session_token=response['Credentials']['SessionToken']
-    )
 
-    print("Assumed session for {}.".format(
-        aws_account_number
-    ))
-
-    return session
-
-
-def get_master_members(master_session, aws_region, detector_id):
+def get_member_index(master_session, aws_region, detector_id):
     """
-    Returns a list of current members of the GuardDuty master account
+    Returns the member index of the GuardDuty master account, listed once per region and run
     :param aws_region: AWS Region of the GuardDuty master account
     :param detector_id: DetectorId of the GuardDuty master account in the AWS Region
-    :return: dict of AwsAccountId:RelationshipStatus
+    :return: MemberIndex of AwsAccountId:RelationshipStatus
     """
 
-    member_dict = dict()
-
-    gd_client = master_session.client('guardduty', region_name=aws_region)
-
-    # Need to paginate and iterate over results
-    paginator = gd_client.get_paginator('list_members')
-    operation_parameters = {
-        'DetectorId': detector_id,
-        'OnlyAssociated': 'false'
-    }
-
-    page_iterator = paginator.paginate(**operation_parameters)
-
-    for page in page_iterator:
-        if page['Members']:
-            for member in page['Members']:
-                member_dict.update({member['AccountId']: member['RelationshipStatus']})
+    gd_client = utils.get_client(master_session, 'guardduty', aws_region)
 
-    return member_dict
+    return utils.get_member_index(gd_client, detector_id)
 
 
 def list_detectors(client, aws_region):
@@ -118,6 +69,573 @@ def list_detectors(client, aws_region):
     return detector_dict
 
 
+def enable_member(session, master_session, account, email, aws_region, master_account, master_detector_id, invite_message, linking):
+    """
+    Enables GuardDuty for a single account in a single region
+    Creates the detector if needed and, when linking, creates, invites and accepts the membership
+    :param session: Assumed session of the member account
+    :param master_session: Assumed session of the GuardDuty master account
+    :param account: AWS Account Number of the member account
+    :param email: Email address of the member account
+    :param aws_region: AWS Region
+    :param master_account: AWS Account Number of the GuardDuty master account
+    :param master_detector_id: DetectorId of the GuardDuty master account in the AWS Region
+    :param invite_message: Message sent with the GuardDuty invitation
+    :param linking: Link the member account to the master account
+    :return: DetectorId of the member account in the AWS Region
+    """
+
+    print('Beginning {account} in {region}'.format(
+        account=account,
+        region=aws_region
+    ))
+    utils.log_event('guardduty', account, aws_region, 'started')
+
+    gd_client = utils.get_client(session, 'guardduty', aws_region)
+
+    # get detectors for this region
+    detector_dict = list_detectors(gd_client, aws_region)
+    detector_id = detector_dict[aws_region]
+
+    # If detector does not exist, create it
+    if detector_id:
+        # a detector exists
+        print('Found existing detector {detector} in {region} for {account}'.format(
+            detector=detector_id,
+            region=aws_region,
+            account=account
+        ))
+
+    else:
+        # create a detector
+        detector_str = gd_client.create_detector(Enable=True)['DetectorId']
+        print('Created detector {detector} in {region} for {account}'.format(
+            detector=detector_str,
+            region=aws_region,
+            account=account
+        ))
+
+        detector_id = detector_str
+
+    utils.journal_record('guardduty', account, aws_region, 'detector')
+
+    if linking:
+        member_index = get_member_index(master_session, aws_region, master_detector_id)
+        member_poller = utils.get_membership_poller(member_index)
+
+        # If detector is not a member of the GuardDuty master account, add it
+        if account not in member_index:
+            gd_client = utils.get_client(master_session, 'guardduty', aws_region)
+
+            response = gd_client.create_members(
+                AccountDetails=[
+                    {
+                        'AccountId': account,
+                        'Email': email
+                    }
+                ],
+                DetectorId=master_detector_id
+            )
+            member_index.update([account], 'Created', response)
+
+            print('Added Account {monitored} to member list in GuardDuty master account {master} for region {region}'.format(
+                monitored=account,
+                master=master_account,
+                region=aws_region
+            ))
+
+            if not member_poller.wait_for(account, lambda status: status is not None, 300):
+                print("Membership did not show up for account {}, skipping".format(account))
+
+        else:
+
+            print('Account {monitored} is already a member of {master} in region {region}'.format(
+                monitored=account,
+                master=master_account,
+                region=aws_region
+            ))
+
+        # Check if Verification Was failed before, delete and add it again.
+        if member_index.get(account) == 'EmailVerificationFailed':
+            # Member is enabled and already being monitored
+            print('Account {account} Error: EmailVerificationFailed'.format(account=account))
+            gd_client = utils.get_client(master_session, 'guardduty', aws_region)
+            gd_client.disassociate_members(
+                AccountIds=[
+                    account
+                ],
+                DetectorId=master_detector_id
+            )
+
+            response = gd_client.delete_members(
+                AccountIds=[
+                    account
+                ],
+                DetectorId=master_detector_id
+            )
+            member_index.update([account], None, response)
+
+            print('Deleting members for {account} in {region}'.format(
+                account=account,
+                region=aws_region
+            ))
+
+            response = gd_client.create_members(
+                AccountDetails=[
+                    {
+                        'AccountId': account,
+                        'Email': email
+                    }
+                ],
+                DetectorId=master_detector_id
+            )
+            member_index.update([account], 'Created', response)
+
+            print('Added Account {monitored} to member list in GuardDuty master account {master} for region {region}'.format(
+                monitored=account,
+                master=master_account,
+                region=aws_region
+            ))
+
+            if not member_poller.wait_for(account, lambda status: status is not None, 300):
+                print("Membership did not show up for account {}, skipping".format(account))
+
+        if account not in member_index:
+            print("Account {} could not be joined, skipping".format(account))
+            return detector_id
+
+        if member_index.get(account) == 'Enabled':
+            # Member is enabled and already being monitored
+            print('Account {account} is already enabled'.format(account=account))
+
+        else:
+            master_gd_client = utils.get_client(master_session, 'guardduty', aws_region)
+            gd_client = utils.get_client(session, 'guardduty', aws_region)
+
+            if member_index.get(account) == 'Disabled':
+                # Member was disabled
+                print('Account {account} Error: Disabled'.format(account=account))
+                master_gd_client.start_monitoring_members(
+                    AccountIds=[
+                        account
+                    ],
+                    DetectorId=master_detector_id
+                )
+                member_index.refresh([account])
+                print('Account {account} Re-Enabled'.format(account=account))
+
+            start_time = int(time.time())
+            while member_index.get(account) != 'Enabled':
+                if (int(time.time()) - start_time) > 300:
+                    print("Invitation was not accepted for account {}, skipping".format(account))
+                    break
+
+                if member_index.get(account) == 'Created':
+                    # Member has been created in the GuardDuty master account but not invited yet
+                    master_gd_client = utils.get_client(master_session, 'guardduty', aws_region)
+
+                    response = master_gd_client.invite_members(
+                        AccountIds=[
+                            account
+                        ],
+                        DetectorId=master_detector_id,
+                        Message=invite_message
+                    )
+                    member_index.update([account], 'Invited', response)
+
+                    print('Invited Account {monitored} to GuardDuty master account {master} in region {region}'.format(
+                        monitored=account,
+                        master=master_account,
+                        region=aws_region
+                    ))
+
+                if member_index.get(account) == 'Invited' or member_index.get(account) == 'Resigned':
+                    # member has been invited so accept the invite
+
+                    response = gd_client.list_invitations()
+
+                    invitation_dict = dict()
+
+                    invitation_id = None
+                    for invitation in response['Invitations']:
+                        invitation_id = invitation['InvitationId']
+
+                    if invitation_id is not None:
+                        gd_client.accept_invitation(
+                            DetectorId=detector_id,
+                            InvitationId=invitation_id,
+                            MasterId=str(master_account)
+                        )
+                        print('Accepting Account {monitored} to GuardDuty master account {master} in region {region}'.format(
+                            monitored=account,
+                            master=master_account,
+                            region=aws_region
+                        ))
+
+                # Wait for the member status to move on, the invitation is looked up again if it does not
+                current_status = member_index.get(account)
+                member_poller.wait_for(account, lambda status: status != current_status, 30)
+                if account not in member_index:
+                    print("Membership of account {} disappeared, skipping".format(account))
+                    return detector_id
+
+        if member_index.get(account) == 'Enabled':
+            utils.journal_record('guardduty', account, aws_region, 'linked')
+
+        print('Finished {account} in {region}'.format(account=account, region=aws_region))
+
+    return detector_id
+
+
+def process_accounts_concurrently(aws_account_dict, guardduty_regions, role_name, master_session, master_detector_id_dict, master_account, invite_message, linking, workers, per_region_concurrency, detector_ids=None, only_units=None):
+    """
+    Processes every (account, region) unit on a bounded worker pool
+    Each account is assumed once and shared by all of its regions
+    :param workers: Maximum number of units processed at the same time
+    :param per_region_concurrency: Maximum number of units processed at the same time in a single region
+    :param detector_ids: dict filled with (AwsAccountId, AWS_Region): DetectorId for the units that succeeded
+    :param only_units: collection of (AwsAccountId, AWS_Region) to restrict the run to, all units if None
+    :return: list of {AwsAccountId: error} for the failed accounts
+    """
+
+    failed_accounts = []
+    sessions = dict()
+    session_locks = dict((account, threading.Lock()) for account in aws_account_dict.keys())
+    region_semaphores = dict((aws_region, threading.BoundedSemaphore(per_region_concurrency)) for aws_region in guardduty_regions)
+
+    # Units completed by the run being resumed are skipped
+    phase = 'linked' if linking else 'detector'
+    units = [(account, aws_region) for account in aws_account_dict.keys() for aws_region in guardduty_regions
+             if (only_units is None or (account, aws_region) in only_units)
+             and utils.region_enabled(account, aws_region)
+             and not utils.journal_completed('guardduty', account, aws_region, phase)]
+    if detector_ids is not None:
+        for account in aws_account_dict.keys():
+            for aws_region in guardduty_regions:
+                if utils.journal_completed('guardduty', account, aws_region, phase):
+                    detector_ids[(account, aws_region)] = None
+    selected = len(only_units) if only_units is not None else len(aws_account_dict) * len(guardduty_regions)
+    if len(units) < selected:
+        print("Skipping {} account/region units completed by the previous run or in regions not enabled".format(selected - len(units)))
+
+    # Assume every account up front, accounts that fail here are retried and reported by get_session
+    utils.get_credential_broker(ROLE_SESSION_NAME).prewarm(OrderedDict(units).keys(), role_name, workers)
+
+    def get_session(account):
+        with session_locks[account]:
+            if account not in sessions:
+                try:
+                    sessions[account] = utils.assume_role(account, role_name, ROLE_SESSION_NAME)
+                except ClientError as e:
+                    utils.log_event('guardduty', account, None, 'account', 'failed', error=e)
+                    print("Error Processing Account {}".format(account))
+                    failed_accounts.append({
+                        account: repr(e)
+                    })
+                    sessions[account] = None
+
+            return sessions[account]
+
+    def process_unit(account, aws_region):
+        session = get_session(account)
+        if session is None:
+            return
+
+        with region_semaphores[aws_region]:
+            try:
+                detector_id = enable_member(session, master_session, account, aws_account_dict[account], aws_region,
+                                            master_account, master_detector_id_dict[aws_region], invite_message, linking)
+                if detector_ids is not None:
+                    detector_ids[(account, aws_region)] = detector_id
+            except ClientError as err:
+                utils.journal_record('guardduty', account, aws_region, phase, err)
+                if err.response['ResponseMetadata']['HTTPStatusCode'] == 403:
+                    print("Failed to list detectors in Target account for region: {} due to an authentication error.  Either your credentials are not correctly configured or the region is an OptIn region that is not enabled on the target account.  Skipping {} and attempting to continue".format(aws_region, aws_region))
+                else:
+                    print("Error Processing Account {} in {}".format(account, aws_region))
+                    failed_accounts.append({
+                        account: repr(err)
+                    })
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = dict()
+        for account, aws_region in units:
+            futures[executor.submit(process_unit, account, aws_region)] = (account, aws_region)
+
+        for future in as_completed(futures):
+            account, aws_region = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                utils.journal_record('guardduty', account, aws_region, phase, e)
+                print("Error Processing Account {} in {}".format(account, aws_region))
+                failed_accounts.append({
+                    account: repr(e)
+                })
+
+    return failed_accounts
+
+
+def accept_invitation(session, account, aws_region, master_account):
+    """
+    Accepts the pending GuardDuty invitation in a member account
+    :param session: Assumed session of the member account
+    :param account: AWS Account Number of the member account
+    :param aws_region: AWS Region
+    :param master_account: AWS Account Number of the GuardDuty master account
+    :return: True if an invitation was accepted
+    """
+
+    gd_client = utils.get_client(session, 'guardduty', aws_region)
+    detector_id = list_detectors(gd_client, aws_region)[aws_region]
+
+    response = gd_client.list_invitations()
+
+    invitation_id = None
+    for invitation in response['Invitations']:
+        invitation_id = invitation['InvitationId']
+
+    if invitation_id is None:
+        return False
+
+    gd_client.accept_invitation(
+        DetectorId=detector_id,
+        InvitationId=invitation_id,
+        MasterId=str(master_account)
+    )
+    print('Accepting Account {monitored} to GuardDuty master account {master} in region {region}'.format(
+        monitored=account,
+        master=master_account,
+        region=aws_region
+    ))
+
+    return True
+
+
+def link_members_batched(master_session, aws_region, master_detector_id, account_emails, role_name, master_account, invite_message, workers):
+    """
+    Links the member accounts of a region in phases: members are created, re-enabled and invited
+    in chunks of up to 50 accounts from the master account, then the invitations are accepted from
+    the member accounts in parallel
+    :param master_session: Assumed session of the GuardDuty master account
+    :param aws_region: AWS Region
+    :param master_detector_id: DetectorId of the GuardDuty master account in the AWS Region
+    :param account_emails: dict of AwsAccountId:Email of the accounts to link in this region
+    :param role_name: Role to assume in the member accounts
+    :param master_account: AWS Account Number of the GuardDuty master account
+    :param invite_message: Message sent with the GuardDuty invitation
+    :param workers: Number of member accounts accepting invitations at the same time
+    :return: list of {AwsAccountId: error} for the accounts that could not be linked
+    """
+
+    failed_accounts = []
+    gd_client = utils.get_client(master_session, 'guardduty', aws_region)
+    member_index = get_member_index(master_session, aws_region, master_detector_id)
+
+    def record_unprocessed(operation, unprocessed):
+        for account, result in unprocessed.items():
+            print('The member account {account} in {region} was not processed by {operation}: {reason}'.format(
+                account=account,
+                region=aws_region,
+                operation=operation,
+                reason=result
+            ))
+            failed_accounts.append({
+                account: "{} failed in {}: {}".format(operation, aws_region, result)
+            })
+            account_emails.pop(account, None)
+
+        return unprocessed
+
+    # Members that failed email verification before are deleted and created again
+    verification_failed = [account for account in account_emails if member_index.get(account) == 'EmailVerificationFailed']
+    if verification_failed:
+        print('Deleting {count} members with EmailVerificationFailed in {region}'.format(count=len(verification_failed), region=aws_region))
+        record_unprocessed('disassociate_members', utils.call_in_chunks(
+            gd_client.disassociate_members, verification_failed,
+            lambda chunk: {'AccountIds': chunk, 'DetectorId': master_detector_id}
+        ))
+        to_delete = [account for account in verification_failed if account in account_emails]
+        unprocessed = record_unprocessed('delete_members', utils.call_in_chunks(
+            gd_client.delete_members, to_delete,
+            lambda chunk: {'AccountIds': chunk, 'DetectorId': master_detector_id}
+        ))
+        member_index.update([account for account in to_delete if account not in unprocessed], None)
+
+    to_create = [account for account in account_emails if account not in member_index]
+    if to_create:
+        unprocessed = record_unprocessed('create_members', utils.call_in_chunks(
+            gd_client.create_members, to_create,
+            lambda chunk: {
+                'AccountDetails': [{'AccountId': account, 'Email': account_emails[account]} for account in chunk],
+                'DetectorId': master_detector_id
+            }
+        ))
+        member_index.update([account for account in to_create if account not in unprocessed], 'Created')
+        print('Added {count} accounts to member list in GuardDuty master account {master} for region {region}'.format(
+            count=len(to_create),
+            master=master_account,
+            region=aws_region
+        ))
+
+    to_start = [account for account in account_emails if member_index.get(account) == 'Disabled']
+    if to_start:
+        record_unprocessed('start_monitoring_members', utils.call_in_chunks(
+            gd_client.start_monitoring_members, to_start,
+            lambda chunk: {'AccountIds': chunk, 'DetectorId': master_detector_id}
+        ))
+        member_index.refresh([account for account in to_start if account in account_emails])
+        print('Re-Enabled {count} disabled members in region {region}'.format(count=len(to_start), region=aws_region))
+
+    to_invite = [account for account in account_emails if member_index.get(account) == 'Created']
+    if to_invite:
+        unprocessed = record_unprocessed('invite_members', utils.call_in_chunks(
+            gd_client.invite_members, to_invite,
+            lambda chunk: {'AccountIds': chunk, 'DetectorId': master_detector_id, 'Message': invite_message}
+        ))
+        member_index.update([account for account in to_invite if account not in unprocessed], 'Invited')
+        print('Invited {count} accounts to GuardDuty master account {master} in region {region}'.format(
+            count=len(to_invite),
+            master=master_account,
+            region=aws_region
+        ))
+
+    to_accept = [account for account in account_emails if member_index.get(account) in ('Invited', 'Resigned')]
+
+    def accept(account):
+        session = utils.assume_role(account, role_name, ROLE_SESSION_NAME)
+        return accept_invitation(session, account, aws_region, master_account)
+
+    # Invitations take a while to reach the member accounts, the accounts without one yet are retried with backoff
+    deadline = time.time() + 300
+    delay = 1
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while to_accept:
+            futures = dict((executor.submit(accept, account), account) for account in to_accept)
+            not_received = []
+            for future in as_completed(futures):
+                account = futures[future]
+                try:
+                    if not future.result():
+                        not_received.append(account)
+                except ClientError as e:
+                    print("Error Processing Account {} in {}".format(account, aws_region))
+                    failed_accounts.append({
+                        account: repr(e)
+                    })
+                    account_emails.pop(account, None)
+
+            to_accept = not_received
+            if to_accept and time.time() + delay < deadline:
+                print('Waiting {delay}s for the invitations of {count} accounts in region {region}'.format(delay=delay, count=len(to_accept), region=aws_region))
+                time.sleep(delay)
+                delay = min(delay * 2, 30)
+            else:
+                break
+
+    for account in to_accept:
+        utils.journal_record('guardduty', account, aws_region, 'linked', "Invitation did not show up")
+        print("Invitation did not show up for account {}, skipping".format(account))
+        failed_accounts.append({
+            account: "Invitation did not show up for account {} in {}".format(account, aws_region)
+        })
+        account_emails.pop(account, None)
+
+    # Wait for the accepted invitations to show up as Enabled on the master account
+    member_poller = utils.get_membership_poller(member_index)
+    pending = member_poller.wait_for_all(account_emails.keys(), lambda status: status == 'Enabled', max(deadline - time.time(), 30))
+    for account in pending:
+        utils.journal_record('guardduty', account, aws_region, 'linked', "Membership did not show up, last status: {}".format(member_index.get(account)))
+        print("Membership did not show up for account {}, skipping".format(account))
+        failed_accounts.append({
+            account: "Membership did not show up for account {} in {}, last status: {}".format(
+                account,
+                aws_region,
+                member_index.get(account)
+            )
+        })
+
+    for account in account_emails:
+        if account not in pending:
+            utils.journal_record('guardduty', account, aws_region, 'linked')
+
+    print('Finished linking {count} accounts in {region}'.format(count=len(account_emails) - len(pending), region=aws_region))
+
+    return failed_accounts
+
+
+def build_plan(aws_account_dict, guardduty_regions, role_name, master_session, master_detector_id_dict, master_account, linking, workers):
+    """
+    Diffs the actual state of every (account, region) unit against the desired state without changing anything
+    Detectors are read from the member accounts concurrently, memberships from the member list of the master account
+    :param master_detector_id_dict: dict of AWS_Region: DetectorId of the GuardDuty master account, empty if there is none yet
+    :param workers: Number of units read at the same time
+    :return: tuple of the plan, an OrderedDict of (AwsAccountId, AWS_Region): list of actions,
+             and the list of {AwsAccountId: error} for the units that could not be read
+    """
+
+    failed_accounts = []
+    broker = utils.get_credential_broker(ROLE_SESSION_NAME)
+    failed_assumes = broker.prewarm(aws_account_dict.keys(), role_name, workers)
+    for account, err in failed_assumes.items():
+        print("Error Processing Account {}".format(account))
+        failed_accounts.append({
+            account: repr(err)
+        })
+
+    def probe(account, aws_region):
+        session = broker.get_session(account, role_name)
+        return list_detectors(utils.get_client(session, 'guardduty', aws_region), aws_region)[aws_region]
+
+    units = [(account, aws_region) for account in aws_account_dict.keys() if account not in failed_assumes
+             for aws_region in guardduty_regions if utils.region_enabled(account, aws_region)]
+    snapshot = utils.snapshot_units(units, probe, workers)
+
+    member_indexes = dict()
+    if linking:
+        for aws_region in guardduty_regions:
+            if master_detector_id_dict[aws_region]:
+                member_indexes[aws_region] = get_member_index(master_session, aws_region, master_detector_id_dict[aws_region])
+
+    plan = OrderedDict()
+    for account, aws_region in units:
+        detector_id = snapshot[(account, aws_region)]
+        if isinstance(detector_id, ClientError):
+            if detector_id.response['ResponseMetadata']['HTTPStatusCode'] == 403:
+                print("Failed to list detectors in Target account for region: {} due to an authentication error.  Either your credentials are not correctly configured or the region is an OptIn region that is not enabled on the target account.  Skipping {} and attempting to continue".format(aws_region, aws_region))
+            else:
+                print("Error Processing Account {} in {}".format(account, aws_region))
+                failed_accounts.append({
+                    account: repr(detector_id)
+                })
+            continue
+        elif isinstance(detector_id, Exception):
+            raise detector_id
+
+        actions = []
+        if not detector_id:
+            actions.append('create_detector')
+
+        if linking and account != master_account:
+            status = member_indexes[aws_region].get(account) if aws_region in member_indexes else None
+            if status is None:
+                actions.extend(['create_member', 'invite_member', 'accept_invitation'])
+            elif status == 'EmailVerificationFailed':
+                actions.extend(['delete_member', 'create_member', 'invite_member', 'accept_invitation'])
+            elif status == 'Disabled':
+                actions.append('start_monitoring_member')
+            elif status == 'Created':
+                actions.extend(['invite_member', 'accept_invitation'])
+            elif status in ('Invited', 'Resigned'):
+                actions.append('accept_invitation')
+            elif status != 'Enabled':
+                actions.append('link_member ({})'.format(status))
+
+        plan[(account, aws_region)] = actions
+
+    return plan, failed_accounts
+
+
 if __name__ == '__main__':
 
     # Setup command line arguments
@@ -127,12 +645,59 @@ if __name__ == '__main__':
     parser.add_argument('--assume_role', type=str, required=True, help="Role Name to assume in each account")
     parser.add_argument('--enabled_regions', type=str, help="comma separated list of regions to enable GuardDuty. If not specified, all available regions enabled")
     parser.add_argument('-l', '--linking', action="store_true", help="indicate if linking member accounts to master account")
+    parser.add_argument('--workers', type=int, default=1, help="number of (account, region) units processed concurrently. Defaults to 1, processing accounts one by one")
+    parser.add_argument('--per_region_concurrency', type=int, help="maximum number of units processed concurrently in a single region. Defaults to --workers")
+    parser.add_argument('--batch', action="store_true", help="link member accounts region by region with batched member API calls, requires --linking")
+    parser.add_argument('--journal', type=str, help="path of a SQLite file recording the completed account/region units of the run")
+    parser.add_argument('--resume', action="store_true", help="skip the units completed by the previous run recorded in --journal")
+    parser.add_argument('--region_cache', type=str, help="path of a JSON file caching the regions enabled in each account. When --enabled_regions is omitted, regions not enabled in an account are skipped up front")
+    parser.add_argument('--region_cache_ttl', type=int, default=24, help="number of hours the enabled regions of an account stay cached. Defaults to 24")
+    parser.add_argument('--plan', action="store_true", help="read the actual state of every account and region and print the changes needed, without applying them")
+    parser.add_argument('--apply', action="store_true", help="read the actual state of every account and region and only process the units that need changes")
+    parser.add_argument('--metrics', type=str, help="path of a JSON file to write the per-operation API call metrics and latency histograms to, a summary is printed at the end of the run")
+    parser.add_argument('--event_log', type=str, help="path of a JSON lines file the structured events of the run (account, region, phase, outcome, duration, error) are appended to")
+    parser.add_argument('--event_console', action="store_true", help="print a human-readable line for every structured event")
     args = parser.parse_args()
 
     # Validate master accountId
     if not re.match(r'[0-9]{12}', args.master_account):
         raise ValueError("Master AccountId is not valid")
 
+    if args.workers < 1:
+        raise ValueError("--workers must be at least 1")
+
+    if args.batch and not args.linking:
+        raise ValueError("--batch requires --linking")
+
+    if args.resume and not args.journal:
+        raise ValueError("--resume requires --journal")
+
+    if args.plan and args.apply:
+        raise ValueError("--plan and --apply are mutually exclusive")
+
+    if (args.plan or args.apply) and args.batch:
+        raise ValueError("--plan and --apply cannot be combined with --batch")
+
+    if args.event_log or args.event_console:
+        utils.open_event_log(args.event_log, args.event_console)
+
+    if args.journal:
+        utils.open_journal(args.journal, args.resume)
+
+    per_region_concurrency = args.per_region_concurrency or args.workers
+    if per_region_concurrency < 1:
+        raise ValueError("--per_region_concurrency must be at least 1")
+
+    # Count the calls, retries, throttles and errors and time every API call of the run
+    utils.configure_api_metrics()
+
+    # Size the connection pools so that every worker can hold a connection to the master account
+    utils.configure_client_pool(max_pool_connections=max(10, args.workers))
+
+    if args.workers > 1 or args.batch or args.plan or args.apply:
+        # Parallel calls hit the GuardDuty request limits, pace them per operation, region and account
+        utils.configure_rate_limiter()
+
     # Generate dict with account & email information
     aws_account_dict = OrderedDict()
 
@@ -163,16 +728,24 @@ if __name__ == '__main__':
         guardduty_regions = session.get_available_regions('guardduty')
         print("Enabling members in all available GuardDuty regions {}".format(guardduty_regions))
 
+        if args.region_cache:
+            # Opt-in regions an account did not enable are pruned instead of failing with a 403 each
+            print("Resolving the enabled regions of {} accounts".format(len(aws_account_dict)))
+            broker = utils.get_credential_broker(ROLE_SESSION_NAME)
+            utils.configure_region_resolver(args.region_cache, args.region_cache_ttl * 3600).resolve(
+                aws_account_dict.keys(), lambda account: broker.get_session(account, args.assume_role), max(10, args.workers)
+            )
+
     # Setting the invitationmessage
     gd_invite_message = 'Account {account} invites you to join GuardDuty.'.format(account=args.master_account)
 
     master_detector_id_dict = dict()
     failed_master_regions = []
     # Processing Master account
-    master_session = assume_role(args.master_account, args.assume_role)
+    master_session = utils.assume_role(args.master_account, args.assume_role, ROLE_SESSION_NAME)
     for aws_region in guardduty_regions:
         try:
-            gd_client = master_session.client('guardduty', region_name=aws_region)
+            gd_client = utils.get_client(master_session, 'guardduty', aws_region)
 
             detector_dict = list_detectors(gd_client, aws_region)
 
@@ -186,6 +759,14 @@ if __name__ == '__main__':
 
                 master_detector_id_dict.update({aws_region: detector_dict[aws_region]})
 
+            elif args.plan:
+                print('Plan: create detector in {region} for master account {account}'.format(
+                    region=aws_region,
+                    account=args.master_account
+                ))
+
+                master_detector_id_dict.update({aws_region: ''})
+
             else:
 
                 # create a detector
@@ -205,210 +786,92 @@ if __name__ == '__main__':
     for failed_region in failed_master_regions:
         guardduty_regions.remove(failed_region)
 
+
     # Processing accounts to be linked
     failed_accounts = []
-    for account in aws_account_dict.keys():
-        try:
-            session = assume_role(account, args.assume_role)
-
-            for aws_region in guardduty_regions:
-                try:
-                    print('Beginning {account} in {region}'.format(
-                        account=account,
-                        region=aws_region
-                    ))
-
-                    gd_client = session.client('guardduty', region_name=aws_region)
-
-                    # get detectors for this region
-                    detector_dict = list_detectors(gd_client, aws_region)
-                    detector_id = detector_dict[aws_region]
-
-                    # If detector does not exist, create it
-                    if detector_id:
-                        # a detector exists
-                        print('Found existing detector {detector} in {region} for {account}'.format(
-                            detector=detector_id,
-                            region=aws_region,
-                            account=account
-                        ))
-
-                    else:
-                        # create a detector
-                        detector_str = gd_client.create_detector(Enable=True)['DetectorId']
-                        print('Created detector {detector} in {region} for {account}'.format(
-                            detector=detector_str,
-                            region=aws_region,
-                            account=account
-                        ))
-
-                        detector_id = detector_str
-
-                    if args.linking:
-                        master_detector_id = master_detector_id_dict[aws_region]
-                        member_dict = get_master_members(master_session, aws_region, master_detector_id)
-
-                        # If detector is not a member of the GuardDuty master account, add it
-                        if account not in member_dict:
-                            gd_client = master_session.client('guardduty', region_name=aws_region)
-
-                            gd_client.create_members(
-                                AccountDetails=[
-                                    {
-                                        'AccountId': account,
-                                        'Email': aws_account_dict[account]
-                                    }
-                                ],
-                                DetectorId=master_detector_id
-                            )
-
-                            print('Added Account {monitored} to member list in GuardDuty master account {master} for region {region}'.format(
-                                monitored=account,
-                                master=args.master_account,
-                                region=aws_region
-                            ))
-
-                            start_time = int(time.time())
-                            while account not in member_dict:
-                                if (int(time.time()) - start_time) > 300:
-                                    print("Membership did not show up for account {}, skipping".format(account))
-                                    break
-
-                                time.sleep(5)
-                                member_dict = get_master_members(master_session, aws_region, master_detector_id)
-
-                        else:
-
-                            print('Account {monitored} is already a member of {master} in region {region}'.format(
-                                monitored=account,
-                                master=args.master_account,
-                                region=aws_region
-                            ))
-
-                        # Check if Verification Was failed before, delete and add it again.
-                        if member_dict[account] == 'EmailVerificationFailed':
-                            # Member is enabled and already being monitored
-                            print('Account {account} Error: EmailVerificationFailed'.format(account=account))
-                            gd_client = master_session.client('guardduty', region_name=aws_region)
-                            gd_client.disassociate_members(
-                                AccountIds=[
-                                    account
-                                ],
-                                DetectorId=master_detector_id
-                            )
-
-                            gd_client.delete_members(
-                                AccountIds=[
-                                    account
-                                ],
-                                DetectorId=master_detector_id
-                            )
-
-                            print('Deleting members for {account} in {region}'.format(
-                                account=account,
-                                region=aws_region
-                            ))
-
-                            gd_client.create_members(
-                                AccountDetails=[
-                                    {
-                                        'AccountId': account,
-                                        'Email': aws_account_dict[account]
-                                    }
-                                ],
-                                DetectorId=master_detector_id
-                            )
-
-                            print('Added Account {monitored} to member list in GuardDuty master account {master} for region {region}'.format(
-                                monitored=account,
-                                master=args.master_account,
-                                region=aws_region
-                            ))
-
-                            start_time = int(time.time())
-                            while account not in member_dict:
-                                if (int(time.time()) - start_time) > 300:
-                                    print("Membership did not show up for account {}, skipping".format(account))
-                                    break
-
-                                time.sleep(5)
-                                member_dict = get_master_members(master_session, aws_region, master_detector_id)
-
-                        if member_dict[account] == 'Enabled':
-                            # Member is enabled and already being monitored
-                            print('Account {account} is already enabled'.format(account=account))
-
-                        else:
-                            master_gd_client = master_session.client('guardduty', region_name=aws_region)
-                            gd_client = session.client('guardduty', region_name=aws_region)
-
-                            if member_dict[account] == 'Disabled':
-                                # Member was disabled
-                                print('Account {account} Error: Disabled'.format(account=account))
-                                master_gd_client.start_monitoring_members(
-                                    AccountIds=[
-                                        account
-                                    ],
-                                    DetectorId=master_detector_id
-                                )
-                                print('Account {account} Re-Enabled'.format(account=account))
-
-                            while member_dict[account] != 'Enabled':
-
-                                if member_dict[account] == 'Created':
-                                    # Member has been created in the GuardDuty master account but not invited yet
-                                    master_gd_client = master_session.client('guardduty', region_name=aws_region)
-
-                                    master_gd_client.invite_members(
-                                        AccountIds=[
-                                            account
-                                        ],
-                                        DetectorId=master_detector_id,
-                                        Message=gd_invite_message
-                                    )
-
-                                    print('Invited Account {monitored} to GuardDuty master account {master} in region {region}'.format(
-                                        monitored=account,
-                                        master=args.master_account,
-                                        region=aws_region
-                                    ))
-
-                                if member_dict[account] == 'Invited' or member_dict[account] == 'Resigned':
-                                    # member has been invited so accept the invite
-
-                                    response = gd_client.list_invitations()
-
-                                    invitation_dict = dict()
-
-                                    invitation_id = None
-                                    for invitation in response['Invitations']:
-                                        invitation_id = invitation['InvitationId']
-
-                                    if invitation_id is not None:
-                                        gd_client.accept_invitation(
-                                            DetectorId=detector_id,
-                                            InvitationId=invitation_id,
-                                            MasterId=str(args.master_account)
-                                        )
-                                        print('Accepting Account {monitored} to GuardDuty master account {master} in region {region}'.format(
-                                            monitored=account,
-                                            master=args.master_account,
-                                            region=aws_region
-                                        ))
-
-                                # Refresh the member dictionary
-                                member_dict = get_master_members(master_session, aws_region, master_detector_id)
-
-                        print('Finished {account} in {region}'.format(account=account, region=aws_region))
-                except ClientError as err:
-                    if err.response['ResponseMetadata']['HTTPStatusCode'] == 403:
-                        print("Failed to list detectors in Target account for region: {} due to an authentication error.  Either your credentials are not correctly configured or the region is an OptIn region that is not enabled on the target account.  Skipping {} and attempting to continue".format(aws_region, aws_region))
-
-        except ClientError as e:
-            print("Error Processing Account {}".format(account))
-            failed_accounts.append({
-                account: repr(e)
-            })
+    if args.plan or args.apply:
+        # Reads are cheap compared to the writes, the snapshot uses at least 10 workers
+        plan, failed_accounts = build_plan(
+            aws_account_dict, guardduty_regions, args.assume_role, master_session, master_detector_id_dict,
+            args.master_account, args.linking, max(10, args.workers)
+        )
+        utils.print_plan(plan)
+
+        if args.plan:
+            print("Plan only, no changes applied")
+        else:
+            changes = set(unit for unit, actions in plan.items() if actions)
+            failed_accounts.extend(process_accounts_concurrently(
+                aws_account_dict, guardduty_regions, args.assume_role, master_session, master_detector_id_dict,
+                args.master_account, gd_invite_message, args.linking, args.workers, per_region_concurrency,
+                only_units=changes
+            ))
+    elif args.batch:
+        # Detectors are created in every member account first, then members are linked region by region
+        detector_ids = dict()
+        failed_accounts = process_accounts_concurrently(
+            aws_account_dict, guardduty_regions, args.assume_role, master_session, master_detector_id_dict,
+            args.master_account, gd_invite_message, False, args.workers, per_region_concurrency, detector_ids
+        )
+
+        # detector_ids only holds the units whose detector is ready, a unit that failed in one region
+        # leaves the account linked in its other regions
+        for aws_region in guardduty_regions:
+            account_emails = OrderedDict(
+                (account, email) for account, email in aws_account_dict.items()
+                if (account, aws_region) in detector_ids
+                and not utils.journal_completed('guardduty', account, aws_region, 'linked')
+            )
+            if not account_emails:
+                continue
+
+            try:
+                failed_accounts.extend(link_members_batched(
+                    master_session, aws_region, master_detector_id_dict[aws_region], account_emails,
+                    args.assume_role, args.master_account, gd_invite_message, args.workers
+                ))
+            except ClientError as e:
+                print("Error linking accounts in {}".format(aws_region))
+                for account in account_emails:
+                    failed_accounts.append({
+                        account: repr(e)
+                    })
+    elif args.workers > 1:
+        print("Processing accounts with {} workers, at most {} per region".format(args.workers, per_region_concurrency))
+        failed_accounts = process_accounts_concurrently(
+            aws_account_dict, guardduty_regions, args.assume_role, master_session, master_detector_id_dict,
+            args.master_account, gd_invite_message, args.linking, args.workers, per_region_concurrency
+        )
+    else:
+        phase = 'linked' if args.linking else 'detector'
+        for account in aws_account_dict.keys():
+            pending_regions = [aws_region for aws_region in guardduty_regions
+                               if utils.region_enabled(account, aws_region) and not utils.journal_completed('guardduty', account, aws_region, phase)]
+            if not pending_regions:
+                print('Skipping {account}, completed by the previous run'.format(account=account))
+                continue
+
+            try:
+                session = utils.assume_role(account, args.assume_role, ROLE_SESSION_NAME)
+
+                for aws_region in pending_regions:
+                    try:
+                        enable_member(session, master_session, account, aws_account_dict[account], aws_region,
+                                      args.master_account, master_detector_id_dict[aws_region], gd_invite_message, args.linking)
+                    except ClientError as err:
+                        utils.journal_record('guardduty', account, aws_region, phase, err)
+                        if err.response['ResponseMetadata']['HTTPStatusCode'] == 403:
+                            print("Failed to list detectors in Target account for region: {} due to an authentication error.  Either your credentials are not correctly configured or the region is an OptIn region that is not enabled on the target account.  Skipping {} and attempting to continue".format(aws_region, aws_region))
+
+            except ClientError as e:
+                utils.log_event('guardduty', account, None, 'account', 'failed', error=e)
+                print("Error Processing Account {}".format(account))
+                failed_accounts.append({
+                    account: repr(e)
+                })
+
+    utils.print_rate_limits()
+    utils.print_api_metrics(args.metrics)
 
     if len(failed_accounts) > 0:
         print("---------------------------------------------------------------")
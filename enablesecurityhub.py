@@ -16,110 +16,192 @@ OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
 SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
 
+import asyncio
 import boto3
 import sys
 import time
 import argparse
+import functools
 import re
 import json
 import random
 import string
+import threading
 import utils
 
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from botocore.exceptions import ClientError
 from six.moves import input as raw_input
-def assume_role(aws_account_number, role_name):
+
+ROLE_SESSION_NAME = 'EnableSecurityHub'
+
+
+_config_lock = threading.Lock()
+_config_accounts = dict()
+_config_regions = dict()
+
+
+def prepare_config_account(session, account, s3_bucket_name):
     """
-    Assumes the provided role in each account and returns a SecurityHub client
-    :param aws_account_number: AWS Account Number
-    :param role_name: Role to assume in target account
-    :param aws_region: AWS Region for the Client call, not required for IAM calls
-    :return: SecurityHub client in the specified AWS Account and Region
+    Runs the account-global part of the AWS Config setup once per account and run
+    The service-linked role and the S3 bucket names are global, so they are only looked up once
+    :param session: Assumed session of the account
+    :param account: AWS Account Number
+    :param s3_bucket_name: Fallback bucket name for the AWS Config delivery channel
+    :return: dict of the account state shared by all its regions, None if the service-linked role could not be created
     """
 
-    # Beginning the assume role process for account
-    sts_client = boto3.client('sts')
+    with _config_lock:
+        account_state = _config_accounts.setdefault(account, {'lock': threading.Lock()})
 
-    # Get the current partition
-    partition = sts_client.get_caller_identity()['Arn'].split(":")[1]
+    with account_state['lock']:
+        if 'ready' in account_state:
+            return account_state if account_state['ready'] else None
 
-    response = sts_client.assume_role(
-        RoleArn='arn:{}:iam::{}:role/{}'.format(
-            partition,
-            aws_account_number,
-            role_name
-        ),
-        RoleSessionName='EnableSecurityHub'
-    )
+        iam = utils.get_client(session, 'iam')
+        s3 = utils.get_client(session, 's3', 'us-east-1')
 
-    # Storing STS credentials
-    session = boto3.Session(
-        aws_access_key_id=response['Credentials']['AccessKeyId'],
-        aws_secret_access_key=response['Credentials']['SecretAccessKey'],
-        aws_session_token=response['Credentials']['SessionToken']
-    )
+        account_state['ready'] = False
+        try:
+            iam.create_service_linked_role(AWSServiceName='config.amazonaws.com', Description='A service-linked role required for AWS Config')
+        except ClientError as e:
+            if e.response['ResponseMetadata']['HTTPStatusCode'] == 400:
+                pass # SLR already exists
+            else:
+                print(e)
+                return None
 
-    print("Assumed session for {}.".format(
-        aws_account_number
-    ))
+        # Check if default bucket name is available.
+        account_state['bucket_exists'] = False
+        account_state['bucket_available'] = False
+        account_state['bucket_name'] = s3_bucket_name
+        try:
+            s3.list_objects(Bucket='config-bucket-{}'.format(account), MaxKeys=1)
+            account_state['bucket_exists'] = True
+            account_state['bucket_name'] = 'config-bucket-{}'.format(account)
+        except ClientError as e:
+            if e.response['ResponseMetadata']['HTTPStatusCode'] == 404:
+                account_state['bucket_available'] = True
+                account_state['bucket_name'] = 'config-bucket-{}'.format(account)
+            pass
+
+        account_state['ready'] = True
+        return account_state
 
-    return session
 
-def get_master_members(sh_client, aws_region):
+def ensure_config_bucket(session, account, account_state):
     """
-    Returns a list of current members of the SecurityHub master account
-    :param aws_region: AWS Region of the SecurityHub master account
-    :param detector_id: DetectorId of the SecurityHub master account in the AWS Region
-    :return: dict of AwsAccountId:RelationshipStatus
+    Creates the S3 bucket for AWS Config delivery the first time a region of the account needs it
+    :return: True if the bucket can be used
     """
 
-    member_dict = dict()
+    with account_state['lock']:
+        if 'bucket_ready' in account_state:
+            return account_state['bucket_ready']
+
+        account_state['bucket_ready'] = True
+        ## Ensure S3 bucket for AWS Config delivery exists
+        if account_state['bucket_available'] and not account_state['bucket_exists']:
+            s3 = utils.get_client(session, 's3', 'us-east-1')
+            s3_bucket_name = account_state['bucket_name']
+            try:
+                s3.create_bucket(Bucket=s3_bucket_name)
+                bucket_policy = {
+                    "Version": "2012-10-17",
+                    "Statement": [
+                        {
+                            "Sid": "AWSConfigBucketPermissionsCheck",
+                            "Effect": "Allow",
+                            "Principal": {"Service": ["config.amazonaws.com"]},
+                            "Action": "s3:GetBucketAcl",
+                            "Resource": "arn:aws:s3:::%s" % s3_bucket_name},
+                        {
+                            "Sid": " AWSConfigBucketDelivery",
+                            "Effect": "Allow",
+                            "Principal": {"Service": ["config.amazonaws.com"]},
+                            "Action": "s3:PutObject",
+                            "Resource": "arn:aws:s3:::%s/AWSLogs/%s/Config/*" % (s3_bucket_name, account),
+                            "Condition": { "StringEquals": { "s3:x-amz-acl": "bucket-owner-full-control" }}
+                        }]
+                }
+                bucket_policy = json.dumps(bucket_policy)
+                s3.put_bucket_policy(Bucket=s3_bucket_name, Policy=bucket_policy)
+                account_state['bucket_exists'] = True
+            except ClientError as e:
+                print("Error {} checking bucket for Config delivery in account {}".format(repr(e), account))
+                account_state['bucket_ready'] = False
 
-    results = sh_client.list_members(
-        OnlyAssociated=False
-    )
+        return account_state['bucket_ready']
 
-    for member in results['Members']:
-        member_dict.update({member['AccountId']: member['MemberStatus']})
 
-    while results.get("NextToken"):
-        results = sh_client.list_members(
-            OnlyAssociated=False,
-            NextToken=results['NextToken']
-        )
+def check_config(session,account, region, s3_bucket_name):
+    """
+    Ensures AWS Config records in the account and region, the result is kept for the rest of the run
+    A ClientError is kept too and raised again instead of repeating the setup
+    :return: True if AWS Config is enabled
+    """
 
-        for member in results['Members']:
-            member_dict.update({member['AccountId']: member['MemberStatus']})
+    with _config_lock:
+        result = _config_regions.get((account, region))
+    if isinstance(result, ClientError):
+        raise result
+    if result is not None:
+        return result
 
-    return member_dict
+    try:
+        result = enable_config(session, account, region, s3_bucket_name)
+    except ClientError as e:
+        with _config_lock:
+            _config_regions[(account, region)] = e
+        raise
 
+    with _config_lock:
+        _config_regions[(account, region)] = result
 
-def check_config(session,account, region, s3_bucket_name):
-    config = session.client('config', region_name=region)
-    iam = session.client('iam')
-    s3 = session.client('s3', region_name='us-east-1')
+    return result
+
+
+def clear_config_cache():
+    """
+    Forgets the AWS Config results kept by check_config, so that a long-running process checks them again
+    """
+
+    with _config_lock:
+        _config_accounts.clear()
+        _config_regions.clear()
+
+
+def check_config_regions(session, account, regions, s3_bucket_name, workers=10):
+    """
+    Runs the account-global AWS Config setup once, then the regional setup of all the regions concurrently
+    :return: dict of AWS_Region: True if AWS Config is enabled
+    """
+
+    prepare_config_account(session, account, s3_bucket_name)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = dict((region, executor.submit(check_config, session, account, region, s3_bucket_name)) for region in regions)
+
+    results = dict()
+    for region, future in futures.items():
+        try:
+            results[region] = future.result()
+        except ClientError as e:
+            print("Error {} enabling Config on account {} in region {}".format(repr(e), account, region))
+            results[region] = False
+
+    return results
+
+
+def enable_config(session, account, region, s3_bucket_name):
+    config = utils.get_client(session, 'config', region)
+
+    account_state = prepare_config_account(session, account, s3_bucket_name)
+    if account_state is None:
+        return False
+    s3_bucket_name = account_state['bucket_name']
 
-    default_bucket_avail = False
-    default_bucket_exists = False
-    try:
-        iam.create_service_linked_role(AWSServiceName='config.amazonaws.com', Description='A service-linked role required for AWS Config')
-    except ClientError as e:
-        if e.response['ResponseMetadata']['HTTPStatusCode'] == 400:
-            pass # SLR already exists
-        else:
-            print(e)
-            return False
-    # Check if default bucket name is available.
-    try:
-        s3.list_objects(Bucket='config-bucket-{}'.format(account), MaxKeys=1)
-        default_bucket_exists = True
-        s3_bucket_name = 'config-bucket-{}'.format(account)
-    except ClientError as e:
-        if e.response['ResponseMetadata']['HTTPStatusCode'] == 404:
-            default_bucket_avail = True
-            s3_bucket_name = 'config-bucket-{}'.format(account)
-        pass
     if not len(config.describe_configuration_recorders()['ConfigurationRecorders']):
         config.put_configuration_recorder( ConfigurationRecorder={'name':'default','roleARN': 'arn:aws:iam::%s:role/aws-service-role/config.amazonaws.com/AWSServiceRoleForConfig' % account,'recordingGroup': {'allSupported' : True, 'includeGlobalResourceTypes': True}})
 
@@ -132,33 +214,8 @@ def check_config(session,account, region, s3_bucket_name):
         except ClientError as e:
             print("Error {} starting configuration recorder for account {} in region {}".format(repr(e), account, region))
             return False
-    ## Ensure S3 bucket for AWS Config delivery exists
-    if default_bucket_avail and not default_bucket_exists:
-        try:
-            s3.create_bucket(Bucket=s3_bucket_name)
-            bucket_policy = {
-                "Version": "2012-10-17",
-                "Statement": [
-                    {
-                        "Sid": "AWSConfigBucketPermissionsCheck",
-                        "Effect": "Allow",
-                        "Principal": {"Service": ["config.amazonaws.com"]},
-                        "Action": "s3:GetBucketAcl",
-                        "Resource": "arn:aws:s3:::%s" % s3_bucket_name},
-                    {
-                        "Sid": " AWSConfigBucketDelivery",
-                        "Effect": "Allow",
-                        "Principal": {"Service": ["config.amazonaws.com"]},
-                        "Action": "s3:PutObject",
-                        "Resource": "arn:aws:s3:::%s/AWSLogs/%s/Config/*" % (s3_bucket_name, account),
-                        "Condition": { "StringEquals": { "s3:x-amz-acl": "bucket-owner-full-control" }}
-                    }]
-            }
-            bucket_policy = json.dumps(bucket_policy)
-            s3.put_bucket_policy(Bucket=s3_bucket_name, Policy=bucket_policy)
-        except ClientError as e:
-            print("Error {} checking bucket for Config delivery in account {}".format(repr(e), account))
-            return False
+    if not ensure_config_bucket(session, account, account_state):
+        return False
     try:
         config.put_delivery_channel(DeliveryChannel={
             'name': 'config-s3-delivery',
@@ -173,7 +230,497 @@ def check_config(session,account, region, s3_bucket_name):
     return False
 
 
+def enable_standards(sh_client, aws_region, standards_arns):
+    """
+    Subscribes the account to the given standards in a region
+    :param sh_client: SecurityHub client
+    :param aws_region: AWS Region
+    :param standards_arns: list of standards ARN resources
+    :return: list of regional standards ARNs that were requested
+    """
+
+    regional_standards_arns = [utils.get_standard_arn_for_region_and_resource(aws_region, standard) for standard in standards_arns]
+    batch_enable_standards_input = [{'StandardsArn': standard_arn} for standard_arn in regional_standards_arns]
+    sh_client.batch_enable_standards(StandardsSubscriptionRequests=batch_enable_standards_input)
+
+    return regional_standards_arns
+
+
+def create_member(master_client, account, email, aws_region, master_account):
+    """
+    Adds the account to the member list of the SecurityHub master account
+    :return: create_members response
+    """
+
+    response = master_client.create_members(
+        AccountDetails=[{
+            "AccountId": account,
+            "Email": email
+        }]
+    )
+
+    print('Added Account {monitored} to member list in SecurityHub master account {master} for region {region}'.format(
+        monitored=account,
+        master=master_account,
+        region=aws_region
+    ))
+
+    return response
+
+
+def invite_member(master_client, account, aws_region, master_account):
+    """
+    Invites a member that has been created in the SecurityHub master account
+    :return: invite_members response
+    """
+
+    response = master_client.invite_members(
+        AccountIds=[account]
+    )
+
+    print('Invited Account {monitored} to SecurityHub master account {master} in region {region}'.format(
+        monitored=account,
+        master=master_account,
+        region=aws_region
+    ))
+
+    return response
+
+
+def accept_invitation(sh_client, account, aws_region, master_account):
+    """
+    Accepts the pending invitation from the SecurityHub master account, if any
+    """
+
+    response = sh_client.list_invitations()
+
+    invitation_id = None
+    for invitation in response['Invitations']:
+        invitation_id = invitation['InvitationId']
+
+    if invitation_id is not None:
+        sh_client.accept_invitation(
+            InvitationId=invitation_id,
+            MasterId=str(master_account)
+        )
+        print('Accepting Account {monitored} to SecurityHub master account {master} in region {region}'.format(
+            monitored=account,
+            master=master_account,
+            region=aws_region
+        ))
+
+
+def enable_member(session, master_client, members, account, email, aws_region, master_account, standards_arns, s3_bucket_name, failed_accounts):
+    """
+    Enables SecurityHub and the requested standards for a single account in a single region and links it to the master account
+    :param session: Assumed session of the member account
+    :param master_client: SecurityHub client of the master account in the AWS Region
+    :param members: dict of AWS_Region: MemberIndex of the master account, updated in place
+    :param account: AWS Account Number of the member account
+    :param email: Email address of the member account
+    :param aws_region: AWS Region
+    :param master_account: AWS Account Number of the SecurityHub master account
+    :param standards_arns: list of standards ARN resources to enable
+    :param s3_bucket_name: Fallback bucket name for the AWS Config delivery channel
+    :param failed_accounts: list of {AwsAccountId: error}, appended in place
+    """
+
+    print('Beginning {account} in {region}'.format(
+        account=account,
+        region=aws_region
+    ))
+    utils.log_event('securityhub', account, aws_region, 'started')
+
+    sh_client = utils.get_client(session, 'securityhub', aws_region)
+    # Error of the Config or standards phase, the unit is not recorded as linked so that resume retries it
+    phase_error = None
+
+    #Ensure AWS Config is enabled for the account/region and enable if it not already enabled.
+    config_result = check_config(session, account, aws_region, s3_bucket_name)
+    if not config_result:
+        failed_accounts.append({account: "Error validating or enabling AWS Config for account {} in {} - requested standards not enabled".format(account,aws_region)})
+        phase_error = "Error validating or enabling AWS Config"
+        utils.journal_record('securityhub', account, aws_region, 'config', phase_error)
+    else:
+        utils.journal_record('securityhub', account, aws_region, 'config')
+        try:
+            sh_client.enable_security_hub()
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ResourceConflictException':
+                pass
+
+        if standards_arns:
+            regional_standards_arns = enable_standards(sh_client, aws_region, standards_arns)
+
+            # Verify standards get enabled
+            not_ready = utils.get_standards_verifier().wait_for(sh_client, account, aws_region, regional_standards_arns, 100)
+            if not_ready:
+                print("Timeout waiting for READY state enabling standards {standards} in region {region} for account {account}, last state: {status}"
+                      .format(standards=regional_standards_arns, region=aws_region, account=account, status=not_ready))
+                phase_error = "Timeout waiting for READY state, last state: {}".format(not_ready)
+                utils.journal_record('securityhub', account, aws_region, 'standards', phase_error)
+            else:
+                utils.journal_record('securityhub', account, aws_region, 'standards')
+
+    if account in members[aws_region]:
+        print('Account {monitored} is already a member of {master} in region {region}'.format(
+            monitored=account,
+            master=master_account,
+            region=aws_region
+        ))
+    else:
+        response = create_member(master_client, account, email, aws_region, master_account)
+        members[aws_region].update([account], 'Created', response)
+
+        if not utils.get_membership_poller(members[aws_region]).wait_for(account, lambda status: status is not None, 300):
+            print("Membership did not show up for account {}, skipping".format(account))
+            failed_accounts.append({
+                account: "Membership did not show up for account {} in {}".format(
+                    account,
+                    aws_region
+                )
+            })
+
+    if account not in members[aws_region]:
+        print("Account {} could not be joined, skipping".format(account))
+        return
+
+    if members[aws_region].get(account) == 'Associated' or members[aws_region].get(account) == 'Enabled':
+        # Member is enabled and already being monitored
+        print('Account {account} is already enabled'.format(account=account))
+
+    else:
+        start_time = int(time.time())
+        while members[aws_region].get(account) != 'Associated' and members[aws_region].get(account) != 'Enabled':
+            if (int(time.time()) - start_time) > 300:
+                print("Invitation did not show up for account {}, skipping".format(account))
+                failed_accounts.append({
+                    account: "Membership did not show up for account {} in {}".format(
+                        account,
+                        aws_region
+                    )
+                })
+                break
+
+            if members[aws_region].get(account) == 'Created':
+                # Member has been created in the SecurityHub master account but not invited yet
+                response = invite_member(master_client, account, aws_region, master_account)
+                members[aws_region].update([account], 'Invited', response)
+
+            if members[aws_region].get(account) == 'Invited':
+                # member has been invited so accept the invite
+                accept_invitation(sh_client, account, aws_region, master_account)
+
+            # Wait for the member status to move on, the invitation is looked up again if it does not
+            current_status = members[aws_region].get(account)
+            utils.get_membership_poller(members[aws_region]).wait_for(account, lambda status: status != current_status, 30)
+
+        print('Finished {account} in {region}'.format(account=account, region=aws_region))
+
+    if phase_error:
+        utils.journal_record('securityhub', account, aws_region, 'linked', phase_error)
+    elif members[aws_region].get(account) in ('Associated', 'Enabled'):
+        utils.journal_record('securityhub', account, aws_region, 'linked')
+    else:
+        utils.journal_record('securityhub', account, aws_region, 'linked', "Member status: {}".format(members[aws_region].get(account)))
+
+
+def describe_unit(session, aws_region):
+    """
+    Reads the AWS Config, SecurityHub and standards state of an account in a region without changing anything
+    :param session: Assumed session of the account
+    :param aws_region: AWS Region
+    :return: dict with 'recording' (AWS Config recorder running), 'hub' (SecurityHub enabled)
+             and 'standards' (dict of StandardsArn:StandardsStatus)
+    """
+
+    config = utils.get_client(session, 'config', aws_region)
+    recorders_status = config.describe_configuration_recorder_status()['ConfigurationRecordersStatus']
+
+    sh_client = utils.get_client(session, 'securityhub', aws_region)
+    hub = True
+    try:
+        sh_client.describe_hub()
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('InvalidAccessException', 'ResourceNotFoundException'):
+            hub = False
+        else:
+            raise
+
+    standards_status = {}
+    if hub:
+        for page in sh_client.get_paginator('get_enabled_standards').paginate():
+            for enabled_standard in page['StandardsSubscriptions']:
+                standards_status[enabled_standard['StandardsArn']] = enabled_standard['StandardsStatus']
+
+    return {
+        'recording': bool(recorders_status) and recorders_status[0]['recording'],
+        'hub': hub,
+        'standards': standards_status
+    }
+
+
+def diff_unit(state, aws_region, standards_arns, member_status=None, linking=True, config=True):
+    """
+    Lists the actions needed to bring a unit from its actual state to the desired state
+    :param state: dict returned by describe_unit
+    :param member_status: MemberStatus of the account in the master account, None if it is not a member
+    :param linking: Diff the membership of the account as well
+    :param config: Diff the AWS Config recorder as well, the master account does not set it up
+    :return: list of actions, empty if the unit is up to date
+    """
+
+    actions = []
+    if config and not state['recording']:
+        actions.append('enable_config')
+
+    if not state['hub']:
+        actions.append('enable_security_hub')
+
+    missing_standards = [standard for standard in standards_arns
+                         if state['standards'].get(utils.get_standard_arn_for_region_and_resource(aws_region, standard)) != 'READY']
+    if missing_standards:
+        actions.append('enable_standards ({})'.format(', '.join(missing_standards)))
+
+    if linking:
+        if member_status is None:
+            actions.extend(['create_member', 'invite_member', 'accept_invitation'])
+        elif member_status == 'Created':
+            actions.extend(['invite_member', 'accept_invitation'])
+        elif member_status == 'Invited':
+            actions.append('accept_invitation')
+        elif member_status not in ('Associated', 'Enabled'):
+            actions.append('link_member ({})'.format(member_status))
+
+    return actions
+
+
+def build_plan(aws_account_dict, securityhub_regions, role_name, members, master_account, standards_arns, workers):
+    """
+    Diffs the actual state of every (account, region) unit against the desired state without changing anything
+    The member accounts are read concurrently, memberships come from the member list of the master account
+    :param members: dict of AWS_Region: MemberIndex of the master account, regions without a hub are missing
+    :param workers: Number of units read at the same time
+    :return: tuple of the plan, an OrderedDict of (AwsAccountId, AWS_Region): list of actions,
+             and the list of {AwsAccountId: error} for the units that could not be read
+    """
+
+    failed_accounts = []
+    broker = utils.get_credential_broker(ROLE_SESSION_NAME)
+    failed_assumes = broker.prewarm(aws_account_dict.keys(), role_name, workers)
+    for account, e in failed_assumes.items():
+        print("Error Processing Account {}".format(account))
+        failed_accounts.append({
+            account: repr(e)
+        })
+
+    def probe(account, aws_region):
+        return describe_unit(broker.get_session(account, role_name), aws_region)
+
+    units = [(account, aws_region) for account in aws_account_dict.keys() if account not in failed_assumes
+             for aws_region in securityhub_regions if utils.region_enabled(account, aws_region)]
+    snapshot = utils.snapshot_units(units, probe, workers)
+
+    plan = OrderedDict()
+    for account, aws_region in units:
+        state = snapshot[(account, aws_region)]
+        if isinstance(state, ClientError):
+            print("Error Processing Account {} in {}".format(account, aws_region))
+            failed_accounts.append({
+                account: repr(state)
+            })
+            continue
+        elif isinstance(state, Exception):
+            raise state
+
+        member_status = members[aws_region].get(account) if aws_region in members else None
+        plan[(account, aws_region)] = diff_unit(state, aws_region, standards_arns, member_status, account != master_account)
+
+    return plan, failed_accounts
+
+
+async def run_in_executor(func, *args):
+    """
+    Runs a blocking botocore call on the default executor of the running event loop
+    """
+
+    return await asyncio.get_running_loop().run_in_executor(None, functools.partial(func, *args))
+
+
+async def enable_member_async(session, master_client, members, account, email, aws_region, master_account, standards_arns, s3_bucket_name, failed_accounts):
+    """
+    Coroutine version of enable_member, all API calls run on the executor and waits yield to the event loop
+    """
+
+    print('Beginning {account} in {region}'.format(
+        account=account,
+        region=aws_region
+    ))
+    utils.log_event('securityhub', account, aws_region, 'started')
+
+    sh_client = await run_in_executor(utils.get_client, session, 'securityhub', aws_region)
+    # Error of the Config or standards phase, the unit is not recorded as linked so that resume retries it
+    phase_error = None
+
+    #Ensure AWS Config is enabled for the account/region and enable if it not already enabled.
+    config_result = await run_in_executor(check_config, session, account, aws_region, s3_bucket_name)
+    if not config_result:
+        failed_accounts.append({account: "Error validating or enabling AWS Config for account {} in {} - requested standards not enabled".format(account,aws_region)})
+        phase_error = "Error validating or enabling AWS Config"
+        utils.journal_record('securityhub', account, aws_region, 'config', phase_error)
+    else:
+        utils.journal_record('securityhub', account, aws_region, 'config')
+        try:
+            await run_in_executor(sh_client.enable_security_hub)
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ResourceConflictException':
+                pass
+
+        if standards_arns:
+            regional_standards_arns = await run_in_executor(enable_standards, sh_client, aws_region, standards_arns)
+
+            # Verify standards get enabled
+            not_ready = await utils.get_standards_verifier().wait_for_async(sh_client, account, aws_region, regional_standards_arns, 100)
+            if not_ready:
+                print("Timeout waiting for READY state enabling standards {standards} in region {region} for account {account}, last state: {status}"
+                      .format(standards=regional_standards_arns, region=aws_region, account=account, status=not_ready))
+                phase_error = "Timeout waiting for READY state, last state: {}".format(not_ready)
+                utils.journal_record('securityhub', account, aws_region, 'standards', phase_error)
+            else:
+                utils.journal_record('securityhub', account, aws_region, 'standards')
+
+    if account in members[aws_region]:
+        print('Account {monitored} is already a member of {master} in region {region}'.format(
+            monitored=account,
+            master=master_account,
+            region=aws_region
+        ))
+    else:
+        response = await run_in_executor(create_member, master_client, account, email, aws_region, master_account)
+        members[aws_region].update([account], 'Created', response)
+
+        if not await utils.get_membership_poller(members[aws_region]).wait_for_async(account, lambda status: status is not None, 300):
+            print("Membership did not show up for account {}, skipping".format(account))
+            failed_accounts.append({
+                account: "Membership did not show up for account {} in {}".format(
+                    account,
+                    aws_region
+                )
+            })
+
+    if account not in members[aws_region]:
+        print("Account {} could not be joined, skipping".format(account))
+        return
+
+    if members[aws_region].get(account) == 'Associated' or members[aws_region].get(account) == 'Enabled':
+        # Member is enabled and already being monitored
+        print('Account {account} is already enabled'.format(account=account))
+
+    else:
+        start_time = int(time.time())
+        while members[aws_region].get(account) != 'Associated' and members[aws_region].get(account) != 'Enabled':
+            if (int(time.time()) - start_time) > 300:
+                print("Invitation did not show up for account {}, skipping".format(account))
+                failed_accounts.append({
+                    account: "Membership did not show up for account {} in {}".format(
+                        account,
+                        aws_region
+                    )
+                })
+                break
+
+            if members[aws_region].get(account) == 'Created':
+                # Member has been created in the SecurityHub master account but not invited yet
+                response = await run_in_executor(invite_member, master_client, account, aws_region, master_account)
+                members[aws_region].update([account], 'Invited', response)
+
+            if members[aws_region].get(account) == 'Invited':
+                # member has been invited so accept the invite
+                await run_in_executor(accept_invitation, sh_client, account, aws_region, master_account)
+
+            # Wait for the member status to move on, the invitation is looked up again if it does not
+            current_status = members[aws_region].get(account)
+            await utils.get_membership_poller(members[aws_region]).wait_for_async(account, lambda status: status != current_status, 30)
+
+        print('Finished {account} in {region}'.format(account=account, region=aws_region))
 
+    if phase_error:
+        utils.journal_record('securityhub', account, aws_region, 'linked', phase_error)
+    elif members[aws_region].get(account) in ('Associated', 'Enabled'):
+        utils.journal_record('securityhub', account, aws_region, 'linked')
+    else:
+        utils.journal_record('securityhub', account, aws_region, 'linked', "Member status: {}".format(members[aws_region].get(account)))
+
+
+async def process_accounts_async(aws_account_dict, securityhub_regions, role_name, master_clients, members, master_account, standards_arns, max_concurrency, only_units=None):
+    """
+    Enrolls every (account, region) unit as a coroutine, at most max_concurrency of them in flight
+    :param only_units: collection of (AwsAccountId, AWS_Region) to restrict the run to, all units if None
+    :return: list of {AwsAccountId: error} for the failed accounts
+    """
+
+    failed_accounts = []
+    semaphore = asyncio.Semaphore(max_concurrency)
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=max_concurrency))
+
+    # Units completed by the run being resumed are skipped
+    pending_regions = OrderedDict()
+    for account in aws_account_dict.keys():
+        regions = [aws_region for aws_region in securityhub_regions
+                   if (only_units is None or (account, aws_region) in only_units)
+                   and utils.region_enabled(account, aws_region)
+                   and not utils.journal_completed('securityhub', account, aws_region, 'linked')]
+        if regions:
+            pending_regions[account] = regions
+        elif only_units is None:
+            print('Skipping {account}, completed by the previous run'.format(account=account))
+
+    # Assume every account up front, accounts that fail here are retried and reported by process_account
+    await run_in_executor(utils.get_credential_broker(ROLE_SESSION_NAME).prewarm, list(pending_regions.keys()), role_name, max_concurrency)
+
+    async def process_unit(session, account, aws_region, s3_bucket_name):
+        async with semaphore:
+            try:
+                await enable_member_async(session, master_clients[aws_region], members, account, aws_account_dict[account], aws_region,
+                                          master_account, standards_arns, s3_bucket_name, failed_accounts)
+            except Exception as e:
+                utils.journal_record('securityhub', account, aws_region, 'linked', e)
+                print("Error Processing Account {} in {}".format(account, aws_region))
+                failed_accounts.append({
+                    account: repr(e)
+                })
+
+    async def process_account(account):
+        if account == master_account:
+            print("Won't try to link master account %s to itself" % account)
+
+        try:
+            async with semaphore:
+                session = await run_in_executor(utils.assume_role, account, role_name, ROLE_SESSION_NAME)
+        except Exception as e:
+            utils.log_event('securityhub', account, None, 'account', 'failed', error=e)
+            print("Error Processing Account {}".format(account))
+            failed_accounts.append({
+                account: repr(e)
+            })
+            return
+
+        # Generate unique bucket name for Config delivery channel if default is not avaialable.
+        s3_bucket_name = 'config-bucket-{}-{}'.format(''.join(random.SystemRandom().choice(string.ascii_lowercase + string.digits) for _ in range(5)), account)
+
+        await asyncio.gather(*[process_unit(session, account, aws_region, s3_bucket_name) for aws_region in pending_regions[account]],
+                             return_exceptions=True)
+
+    # An account failing in an unexpected way is reported with the others instead of aborting the run
+    results = await asyncio.gather(*[process_account(account) for account in pending_regions.keys()], return_exceptions=True)
+    for account, result in zip(pending_regions.keys(), results):
+        if isinstance(result, Exception):
+            print("Error Processing Account {}".format(account))
+            failed_accounts.append({
+                account: repr(result)
+            })
+
+    return failed_accounts
 
 
 if __name__ == '__main__':
@@ -185,17 +732,52 @@ if __name__ == '__main__':
     parser.add_argument('--assume_role', type=str, required=True, help="Role Name to assume in each account")
     parser.add_argument('--enabled_regions', type=str, help="comma separated list of regions to enable SecurityHub. If not specified, all available regions enabled")
     parser.add_argument('--enable_standards', type=str, required=False,help="comma separated list of standards ARN resources to enable ( i.e. ruleset/cis-aws-foundations-benchmark/v/1.2.0 )")
+    parser.add_argument('--asyncio', action='store_true', default=False, help="enroll accounts and regions concurrently with asyncio instead of one by one")
+    parser.add_argument('--max_concurrency', type=int, default=50, help="maximum number of account/region units in flight with --asyncio")
+    parser.add_argument('--journal', type=str, help="path of a SQLite file recording the completed account/region units of the run")
+    parser.add_argument('--resume', action="store_true", help="skip the units completed by the previous run recorded in --journal")
+    parser.add_argument('--region_cache', type=str, help="path of a JSON file caching the regions enabled in each account. When --enabled_regions is omitted, regions not enabled in an account are skipped up front")
+    parser.add_argument('--region_cache_ttl', type=int, default=24, help="number of hours the enabled regions of an account stay cached. Defaults to 24")
+    parser.add_argument('--plan', action="store_true", help="read the actual state of every account and region and print the changes needed, without applying them")
+    parser.add_argument('--apply', action="store_true", help="read the actual state of every account and region and only process the units that need changes")
+    parser.add_argument('--metrics', type=str, help="path of a JSON file to write the per-operation API call metrics and latency histograms to, a summary is printed at the end of the run")
+    parser.add_argument('--event_log', type=str, help="path of a JSON lines file the structured events of the run (account, region, phase, outcome, duration, error) are appended to")
+    parser.add_argument('--event_console', action="store_true", help="print a human-readable line for every structured event")
     args = parser.parse_args()
 
     # Validate master accountId
     if not re.match(r'[0-9]{12}',args.master_account):
         raise ValueError("Master AccountId is not valid")
 
+    if args.max_concurrency < 1:
+        raise ValueError("--max_concurrency must be at least 1")
+
+    if args.resume and not args.journal:
+        raise ValueError("--resume requires --journal")
+
+    if args.plan and args.apply:
+        raise ValueError("--plan and --apply are mutually exclusive")
+
+    if args.event_log or args.event_console:
+        utils.open_event_log(args.event_log, args.event_console)
+
+    if args.journal:
+        utils.open_journal(args.journal, args.resume)
+
+    # Count the calls, retries, throttles and errors and time every API call of the run
+    utils.configure_api_metrics()
+
+    if args.asyncio or args.plan or args.apply:
+        # Size the connection pools so that every unit in flight can hold a connection to the master account
+        utils.configure_client_pool(max_pool_connections=max(10, args.max_concurrency))
+        # Parallel calls hit the SecurityHub request limits, pace them per operation, region and account
+        utils.configure_rate_limiter()
+
     # Generate dict with account & email information
     aws_account_dict = OrderedDict()
 
     # Notify on Config dependency if standards are enabled
-    if args.enable_standards:
+    if args.enable_standards and not args.plan:
         print(
         '''
         *****************************************************************************************************************************************************************************************
@@ -243,6 +825,14 @@ if __name__ == '__main__':
         securityhub_regions = session.get_available_regions('securityhub')
         print("Enabling members in all available SecurityHub regions {}".format(securityhub_regions))
 
+        if args.region_cache:
+            # Opt-in regions an account did not enable are pruned instead of failing with a 403 each
+            print("Resolving the enabled regions of {} accounts".format(len(aws_account_dict)))
+            broker = utils.get_credential_broker(ROLE_SESSION_NAME)
+            utils.configure_region_resolver(args.region_cache, args.region_cache_ttl * 3600).resolve(
+                aws_account_dict.keys(), lambda account: broker.get_session(account, args.assume_role), 10
+            )
+
     # Check if enable Standards
     standards_arns = []
     if args.enable_standards:
@@ -251,204 +841,110 @@ if __name__ == '__main__':
 
 
     # Processing Master account
-    master_session = assume_role(args.master_account, args.assume_role)
+    master_session = utils.assume_role(args.master_account, args.assume_role, ROLE_SESSION_NAME)
     #master_session = boto3.Session()
     master_clients = {}
     members = {}
+    master_standards = []
     for aws_region in securityhub_regions:
-        master_clients[aws_region] = master_session.client('securityhub', region_name=aws_region)
-        try:
-            # Enable Security Hub for the Master Account
-            master_clients[aws_region].enable_security_hub()
-
-            # Enable compliance Standards for Master account
-            compliance_standards_arns = [utils.get_standard_arn_for_region_and_resource(aws_region, standard) for standard in standards_arns]
-            batch_enable_standards_input = [{'StandardsArn': standard_arn} for standard_arn in compliance_standards_arns]
-            master_clients[aws_region].batch_enable_standards(StandardsSubscriptionRequests=batch_enable_standards_input)
-
-            # Verify standards get enabled in the Master Account
-            standards_to_verify = compliance_standards_arns[:]
-            standards_status = {}
-            start_time = int(time.time())
-            while len(standards_to_verify) > 0:
-                if (int(time.time()) - start_time) > 100:
-                    print("Timeout waiting for READY state enabling standards {standards} in region {region} for account {account}, last state: {status}"
-                          .format(standards=compliance_standards_arns, region=aws_region, account=args.master_account, status=standards_status))
-                    break
-                enabled_standards = master_clients[aws_region].get_enabled_standards()
-                for enabled_standard in enabled_standards['StandardsSubscriptions']:
-                    enabled_standard_arn = enabled_standard['StandardsArn']
-                    enabled_standard_status = enabled_standard['StandardsStatus']
-                    standards_status[enabled_standard_arn] = enabled_standard_status
-                    if enabled_standard_arn in standards_to_verify and enabled_standard_status == 'READY':
-                        print("Finished enabling stanard {} on account {} for region {}".format(enabled_standard_arn, args.master_account, aws_region))
-                        standards_to_verify.remove(enabled_standard_arn)
-
+        master_clients[aws_region] = utils.get_client(master_session, 'securityhub', aws_region)
+        if args.plan or args.apply:
+            master_state = describe_unit(master_session, aws_region)
+            master_actions = diff_unit(master_state, aws_region, standards_arns, linking=False, config=False)
+            if master_actions:
+                print("Plan: {} for master account {} in {}".format(', '.join(master_actions), args.master_account, aws_region))
+
+            # Nothing is changed in the master account with --plan, nor with --apply when it is up to date
+            if args.plan or not master_actions:
+                if master_state['hub']:
+                    members[aws_region] = utils.get_member_index(master_clients[aws_region])
+                continue
 
+        try:
+            # Enable Security Hub for the Master Account, --apply only performs the actions of the plan
+            if not args.apply or 'enable_security_hub' in master_actions:
+                master_clients[aws_region].enable_security_hub()
         except ClientError as e:
-            if e.response['Error']['Code'] == 'ResourceConflictException':
-                pass
-            else:
+            if e.response['Error']['Code'] != 'ResourceConflictException':
                 print("Error: Unable to enable Security Hub on Master account in region {}".format(aws_region))
                 print(e.response['Error'])
                 raise SystemExit(0)
 
-        members[aws_region] = get_master_members(master_clients[aws_region], aws_region)
-
-    # Processing accounts to be linked
-    failed_accounts = []
-    for account in aws_account_dict.keys():
-        if account == args.master_account:
-            print("Won't try to link master account %s to itself" % account)
-
         try:
+            # Enable compliance Standards for Master account, whether the hub was just enabled or already was
+            if not args.apply or any(action.startswith('enable_standards') for action in master_actions):
+                compliance_standards_arns = enable_standards(master_clients[aws_region], aws_region, standards_arns)
 
-            session = assume_role(account, args.assume_role)
-            # Generate unique bucket name for Config delivery channel if default is not avaialable.
-            s3_bucket_name = 'config-bucket-{}-{}'.format(''.join(random.SystemRandom().choice(string.ascii_lowercase + string.digits) for _ in range(5)), account)
-
-            for aws_region in securityhub_regions:
-                print('Beginning {account} in {region}'.format(
-                    account=account,
-                    region=aws_region
-                ))
-
-                sh_client = session.client('securityhub', region_name=aws_region)
-                #Ensure AWS Config is enabled for the account/region and enable if it not already enabled.
-                config_result = check_config(session, account, aws_region, s3_bucket_name)
-                if not config_result:
-                    failed_accounts.append({account: "Error validating or enabling AWS Config for account {} in {} - requested standards not enabled".format(account,aws_region)})
-                else:
-                    try:
-                        sh_client.enable_security_hub()
-                    except ClientError as e:
-                        if e.response['Error']['Code'] == 'ResourceConflictException':
-                            pass
-
-                    if args.enable_standards:
-                        regional_standards_arns = [utils.get_standard_arn_for_region_and_resource(aws_region, standard) for standard in standards_arns]
-                        batch_enable_standards_input = [{'StandardsArn': standard_arn} for standard_arn in regional_standards_arns]
-                        sh_client.batch_enable_standards(StandardsSubscriptionRequests=batch_enable_standards_input)
-
-                        # Verify standards get enabled
-                        standards_to_verify = regional_standards_arns[:]
-                        standards_status = {}
-                        start_time = int(time.time())
-                        while len(standards_to_verify) > 0:
-                            if (int(time.time()) - start_time) > 100:
-                                print("Timeout waiting for READY state enabling standards {standards} in region {region} for account {account}, last state: {status}"
-                                      .format(standards=regional_standards_arns, region=aws_region, account=account, status=standards_status))
-                                break
-                            enabled_standards = sh_client.get_enabled_standards()
-                            for enabled_standard in enabled_standards['StandardsSubscriptions']:
-                                enabled_standard_arn = enabled_standard['StandardsArn']
-                                enabled_standard_status = enabled_standard['StandardsStatus']
-                                standards_status[enabled_standard_arn] = enabled_standard_status
-                                if enabled_standard_arn in standards_to_verify and enabled_standard_status == 'READY':
-                                    print("Finished enabling stanard {} on account {} for region {}".format(enabled_standard_arn,account, aws_region))
-                                    standards_to_verify.remove(enabled_standard_arn)
-
-
-                if account in members[aws_region]:
-                    print('Account {monitored} is already a member of {master} in region {region}'.format(
-                        monitored=account,
-                        master=args.master_account,
-                        region=aws_region
-                    ))
-                else:
-                    master_clients[aws_region].create_members(
-                        AccountDetails=[{
-                            "AccountId": account,
-                            "Email": aws_account_dict[account]
-                        }]
-                    )
+                # Standards of the Master Account are verified for all the regions together
+                master_standards.append((master_clients[aws_region], args.master_account, aws_region, compliance_standards_arns))
+        except ClientError as e:
+            print("Error: Unable to enable standards on Master account in region {}".format(aws_region))
+            print(e.response['Error'])
+            raise SystemExit(0)
 
-                    print('Added Account {monitored} to member list in SecurityHub master account {master} for region {region}'.format(
-                        monitored=account,
-                        master=args.master_account,
-                        region=aws_region
-                    ))
-
-                    start_time = int(time.time())
-                    while account not in members[aws_region]:
-                        if (int(time.time()) - start_time) > 300:
-                            print("Membership did not show up for account {}, skipping".format(account))
-                            failed_accounts.append({
-                                account: "Membership did not show up for account {} in {}".format(
-                                    account,
-                                    aws_region
-                                )
-                            })
-                            break
-
-                        time.sleep(5)
-                        members[aws_region] = get_master_members(master_clients[aws_region], aws_region)
-
-                if account not in members[aws_region]:
-                    print("Account {} could not be joined, skipping".format(account))
-                    continue
-
-                if members[aws_region][account] == 'Associated' or members[aws_region][account] == 'Enabled':
-                    # Member is enabled and already being monitored
-                    print('Account {account} is already enabled'.format(account=account))
-
-                else:
-                    start_time = int(time.time())
-                    while members[aws_region][account] != 'Associated' and members[aws_region][account] != 'Enabled':
-                        if (int(time.time()) - start_time) > 300:
-                            print("Invitation did not show up for account {}, skipping".format(account))
-                            failed_accounts.append({
-                                account: "Membership did not show up for account {} in {}".format(
-                                    account,
-                                    aws_region
-                                )
-                            })
-                            break
-
-                        if members[aws_region][account] == 'Created':
-                            # Member has been created in the SecurityHub master account but not invited yet
-                            master_clients[aws_region].invite_members(
-                                AccountIds=[account]
-                            )
-
-                            print('Invited Account {monitored} to SecurityHub master account {master} in region {region}'.format(
-                                monitored=account,
-                                master=args.master_account,
-                                region=aws_region
-                            ))
-
-                        if members[aws_region][account] == 'Invited':
-                            # member has been invited so accept the invite
-
-                            response = sh_client.list_invitations()
-
-                            invitation_dict = dict()
-
-                            invitation_id = None
-                            for invitation in response['Invitations']:
-                                invitation_id = invitation['InvitationId']
-
-                            if invitation_id is not None:
-                                sh_client.accept_invitation(
-                                    InvitationId=invitation_id,
-                                    MasterId=str(args.master_account)
-                                )
-                                print('Accepting Account {monitored} to SecurityHub master account {master} in region {region}'.format(
-                                    monitored=account,
-                                    master=args.master_account,
-                                    region=aws_region
-                                ))
-
-                        # Refresh the member dictionary
-                        members[aws_region] = get_master_members(master_clients[aws_region], aws_region)
-
-                    print('Finished {account} in {region}'.format(account=account, region=aws_region))
+        members[aws_region] = utils.get_member_index(master_clients[aws_region])
 
-        except ClientError as e:
-            print("Error Processing Account {}".format(account))
-            failed_accounts.append({
-                account: repr(e)
-            })
+    # Verify standards get enabled in the Master Account
+    for (account, aws_region), not_ready in utils.get_standards_verifier().wait_for_all(master_standards, 100).items():
+        print("Timeout waiting for READY state enabling standards {standards} in region {region} for account {account}, last state: {status}"
+              .format(standards=list(not_ready.keys()), region=aws_region, account=account, status=not_ready))
+
+    # Processing accounts to be linked
+    failed_accounts = []
+    changes = None
+    if args.plan or args.apply:
+        plan, failed_accounts = build_plan(
+            aws_account_dict, securityhub_regions, args.assume_role, members,
+            args.master_account, standards_arns, max(10, args.max_concurrency)
+        )
+        utils.print_plan(plan)
+        changes = set(unit for unit, actions in plan.items() if actions)
+
+    if args.plan:
+        print("Plan only, no changes applied")
+    elif args.asyncio:
+        print("Processing accounts with asyncio, at most {} account/region units in flight".format(args.max_concurrency))
+        failed_accounts.extend(asyncio.run(process_accounts_async(
+            aws_account_dict, securityhub_regions, args.assume_role, master_clients, members,
+            args.master_account, standards_arns, args.max_concurrency, changes
+        )))
+    else:
+        for account in aws_account_dict.keys():
+            if account == args.master_account:
+                print("Won't try to link master account %s to itself" % account)
+
+            pending_regions = [aws_region for aws_region in securityhub_regions
+                               if (changes is None or (account, aws_region) in changes)
+                               and utils.region_enabled(account, aws_region)
+                               and not utils.journal_completed('securityhub', account, aws_region, 'linked')]
+            if not pending_regions:
+                if changes is None:
+                    print('Skipping {account}, completed by the previous run'.format(account=account))
+                continue
+
+            try:
+
+                session = utils.assume_role(account, args.assume_role, ROLE_SESSION_NAME)
+                # Generate unique bucket name for Config delivery channel if default is not avaialable.
+                s3_bucket_name = 'config-bucket-{}-{}'.format(''.join(random.SystemRandom().choice(string.ascii_lowercase + string.digits) for _ in range(5)), account)
+
+                # AWS Config is set up in all the regions of the account first, enable_member reuses the results
+                check_config_regions(session, account, pending_regions, s3_bucket_name)
+
+                for aws_region in pending_regions:
+                    enable_member(session, master_clients[aws_region], members, account, aws_account_dict[account], aws_region,
+                                  args.master_account, standards_arns, s3_bucket_name, failed_accounts)
+
+            except ClientError as e:
+                utils.log_event('securityhub', account, None, 'account', 'failed', error=e)
+                print("Error Processing Account {}".format(account))
+                failed_accounts.append({
+                    account: repr(e)
+                })
+
+    utils.print_rate_limits()
+    utils.print_standards_report()
+    utils.print_api_metrics(args.metrics)
 
     if len(failed_accounts) > 0:
         print("---------------------------------------------------------------")
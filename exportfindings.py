@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+"""
+Copyright 2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this
+software and associated documentation files (the "Software"), to deal in the Software
+without restriction, including without limitation the rights to use, copy, modify,
+merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+This script exports the SecurityHub findings of the administrator account to compressed JSON
+lines files. Every region, or every (region, member account) pair with --accounts, is a partition
+exported concurrently with its own file and NextToken cursor. Each page is written as a complete
+gzip member or zstd frame and its cursor is committed with the file offset after it, so an
+interrupted export resumed with --resume truncates the partial page and continues from the cursor.
+"""
+
+import boto3
+import gzip
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import argparse
+import utils
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from botocore.exceptions import ClientError
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Maximum number of findings returned by a single GetFindings call
+GET_FINDINGS_MAX_RESULTS = 100
+
+EXTENSIONS = {'gzip': '.jsonl.gz', 'zstd': '.jsonl.zst', 'none': '.jsonl'}
+
+
+class ExportCursors(object):
+    """
+    NextToken cursors of the partitions in a local SQLite database, in the same way as utils.RunJournal
+    """
+
+    def __init__(self, path, resume=False):
+        """
+        :param path: Path of the SQLite database, created if it does not exist
+        :param resume: Keep the cursors of the previous export instead of starting over
+        """
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS cursors ('
+                'partition TEXT PRIMARY KEY, next_token TEXT, offset INTEGER NOT NULL, '
+                'findings INTEGER NOT NULL, done INTEGER NOT NULL, updated_at REAL NOT NULL)'
+            )
+            if not resume:
+                self._connection.execute('DELETE FROM cursors')
+
+    def get(self, partition):
+        """
+        :return: (next_token, offset, findings, done) of the partition, None if it was not started
+        """
+        with self._lock:
+            return self._connection.execute(
+                'SELECT next_token, offset, findings, done FROM cursors WHERE partition = ?', (partition,)
+            ).fetchone()
+
+    def commit(self, partition, next_token, offset, findings):
+        """
+        Records the cursor of the partition after a page was written, the partition is done without next_token
+        """
+        with self._lock, self._connection:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO cursors (partition, next_token, offset, findings, done, updated_at) VALUES (?, ?, ?, ?, ?, ?)',
+                (partition, next_token, offset, findings, 0 if next_token else 1, time.time())
+            )
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+def compressor(compression):
+    """
+    :return: function compressing a page into a self-contained gzip member or zstd frame
+    """
+
+    if compression == 'gzip':
+        return lambda data: gzip.compress(data, compresslevel=6)
+    if compression == 'zstd':
+        # ZstdCompressor objects are not thread safe, every page gets its own
+        return lambda data: zstandard.ZstdCompressor(level=3).compress(data)
+    return lambda data: data
+
+
+def export_partition(region, account, filters, output_dir, compression, cursors, writer):
+    """
+    Exports the findings of a partition page by page
+    The next page is requested while the previous one is serialized, compressed and written by the writer
+    :param region: AWS Region
+    :param account: AWS Account Number whose findings are exported, None for all the accounts of the region
+    :param filters: SecurityHub Filters of the export
+    :param cursors: ExportCursors
+    :param writer: ThreadPoolExecutor serializing and writing the pages
+    :return: Number of findings exported by the partition, previous runs included
+    """
+
+    partition = region if account is None else '{}-{}'.format(region, account)
+    path = os.path.join(output_dir, 'findings-{}{}'.format(partition, EXTENSIONS[compression]))
+    partition_filters = dict(filters)
+    if account is not None:
+        partition_filters['AwsAccountId'] = [{'Value': account, 'Comparison': 'EQUALS'}]
+
+    next_token, offset, findings, done = cursors.get(partition) or (None, 0, 0, 0)
+    if done:
+        print('Skipping {}, exported by the previous run'.format(partition))
+        return findings
+
+    sh_client = utils.get_client(None, 'securityhub', region)
+    compress = compressor(compression)
+    start_time = time.time()
+    utils.log_event('securityhub', account, region, 'started', partition=partition)
+
+    # Drop the page that was being written when the previous export stopped
+    mode = 'r+b' if os.path.exists(path) else 'wb'
+    with open(path, mode) as output_file:
+        output_file.truncate(offset)
+        output_file.seek(offset)
+
+        def write_page(page, token):
+            data = ''.join(json.dumps(finding, separators=(',', ':'), default=str) + '\n' for finding in page).encode('utf-8')
+            output_file.write(compress(data))
+            output_file.flush()
+            return output_file.tell(), token, len(page)
+
+        pending = None
+        try:
+            while True:
+                params = {'Filters': partition_filters, 'MaxResults': GET_FINDINGS_MAX_RESULTS}
+                if next_token:
+                    params['NextToken'] = next_token
+                response = sh_client.get_findings(**params)
+                next_token = response.get('NextToken')
+
+                # Pages are written in order, the cursor only moves once its page is on disk
+                if pending is not None:
+                    offset, token, count = pending.result()
+                    findings += count
+                    cursors.commit(partition, token, offset, findings)
+                pending = writer.submit(write_page, response['Findings'], next_token)
+
+                if not next_token:
+                    break
+
+            offset, token, count = pending.result()
+            findings += count
+            cursors.commit(partition, token, offset, findings)
+        finally:
+            # A failed partition lets its last page finish before the file is closed
+            if pending is not None:
+                wait([pending])
+
+    utils.log_event('securityhub', account, region, 'exported', 'completed', duration=time.time() - start_time, findings=findings)
+    print('Exported {} findings of {} to {}'.format(findings, partition, path))
+
+    return findings
+
+
+if __name__ == '__main__':
+
+    # Setup command line arguments
+    parser = argparse.ArgumentParser(description='Export the SecurityHub findings of the administrator account to compressed JSON lines files')
+    parser.add_argument('--output_dir', type=str, required=True, help="directory the findings files and the export cursors are written to")
+    parser.add_argument('--enabled_regions', type=str, help="comma separated list of regions to export the findings of. If not specified, all available regions")
+    parser.add_argument('--accounts', type=str, help="path to CSV file containing the list of account IDs and Email addresses. If specified, the findings of every member account are exported as a separate partition")
+    parser.add_argument('--filters', type=str, help="SecurityHub Filters of the export as JSON, i.e. '{\"RecordState\": [{\"Value\": \"ACTIVE\", \"Comparison\": \"EQUALS\"}]}'")
+    parser.add_argument('--compression', type=str, default='gzip', choices=['gzip', 'zstd', 'none'], help="compression of the findings files. Defaults to gzip, zstd requires the zstandard package")
+    parser.add_argument('--workers', type=int, default=10, help="number of partitions exported concurrently. Defaults to 10")
+    parser.add_argument('--resume', action="store_true", help="continue the previous export in --output_dir from its cursors")
+    parser.add_argument('--event_log', type=str, help="path of a JSON lines file the structured events of the export are appended to")
+    parser.add_argument('--metrics', type=str, help="path of a JSON file to write the per-operation API call metrics and latency histograms to, a summary is printed at the end of the run")
+    args = parser.parse_args()
+
+    if args.compression == 'zstd' and zstandard is None:
+        raise ValueError("--compression zstd requires the zstandard package, install it with pip install zstandard")
+
+    if args.workers < 1:
+        raise ValueError("--workers must be at least 1")
+
+    filters = json.loads(args.filters) if args.filters else dict()
+
+    accounts = [None]
+    if args.accounts:
+        accounts = []
+        with open(args.accounts) as input_file:
+            for acct in input_file.readlines():
+                split_line = acct.rstrip().split(",")
+                if not re.match(r'[0-9]{12}', str(split_line[0])):
+                    print("Invalid account number {}, skipping".format(split_line[0]))
+                    continue
+                accounts.append(split_line[0])
+
+    if not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    if args.event_log:
+        utils.open_event_log(args.event_log)
+
+    # Count the calls, retries, throttles and errors and time every API call of the run
+    utils.configure_api_metrics()
+
+    # Size the connection pools so that every worker can hold a connection
+    utils.configure_client_pool(max_pool_connections=max(10, args.workers))
+    # GetFindings has a low request limit, pace the partitions of a region together
+    utils.configure_rate_limiter()
+
+    session = boto3.session.Session()
+    if args.enabled_regions:
+        securityhub_regions = [str(item) for item in args.enabled_regions.split(',')]
+    else:
+        securityhub_regions = session.get_available_regions('securityhub')
+    print("Exporting findings in these regions: {}".format(securityhub_regions))
+
+    cursors = ExportCursors(os.path.join(args.output_dir, 'cursors.db'), args.resume)
+    partitions = [(aws_region, account) for aws_region in securityhub_regions for account in accounts]
+
+    failed_partitions = OrderedDict()
+    total_findings = 0
+    start_time = time.time()
+
+    # Compression releases the GIL, the writers compress pages while the workers wait for the API
+    with ThreadPoolExecutor(max_workers=args.workers) as writer, ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = OrderedDict(
+            ((aws_region, account), executor.submit(export_partition, aws_region, account, filters, args.output_dir, args.compression, cursors, writer))
+            for aws_region, account in partitions
+        )
+
+        for (aws_region, account), future in futures.items():
+            try:
+                total_findings += future.result()
+            except Exception as e:
+                # A partition failing for any reason, e.g. an unreachable opt-in region, does not stop the others
+                utils.log_event('securityhub', account, aws_region, 'exported', 'failed', error=e)
+                if isinstance(e, ClientError) and e.response['ResponseMetadata']['HTTPStatusCode'] == 403:
+                    print("Failed to get findings in {} due to an authentication error. Either SecurityHub is not enabled or the region is an OptIn region that is not enabled. Skipping {}".format(aws_region, aws_region))
+                failed_partitions[(aws_region, account)] = repr(e)
+
+    cursors.close()
+
+    print("Exported {} findings in {:.1f}s".format(total_findings, time.time() - start_time))
+    utils.print_rate_limits()
+    utils.print_api_metrics(args.metrics)
+
+    if len(failed_partitions) > 0:
+        print("---------------------------------------------------------------")
+        print("Failed Partitions, run again with --resume to continue them")
+        print("---------------------------------------------------------------")
+        for (aws_region, account), message in failed_partitions.items():
+            print("{} {}: \n\t{}".format(aws_region, account or '', message))
+            print("---------------------------------------------------------------")
@@ -1,12 +1,16 @@
 import boto3
 import argparse
+import os
 import re
 import json
+import sys
 
 from collections import OrderedDict
 from botocore.exceptions import ClientError
 
-org_client = boto3.client('organizations')
+# Shared helpers live in the parent directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import utils
 
 def list_detectors(client, aws_region):
     """
@@ -35,12 +39,17 @@ if __name__ == '__main__':
     parser.add_argument('--master_account', type=str, required=True, help="AccountId for Central AWS Account")
     parser.add_argument('--enabled_regions', type=str, help="comma separated list of regions to enable GuardDuty. If not specified, all available regions enabled")
     parser.add_argument('--disable_master', action="store_true", help="indicate if disable GuardDuty service for master account")
+    parser.add_argument('--workers', type=int, default=10, help="number of regions processed concurrently. Defaults to 10")
+    parser.add_argument('--metrics', type=str, help="path of a JSON file to write the per-operation API call metrics and latency histograms to, a summary is printed at the end of the run")
     args = parser.parse_args()
 
     # Validate master accountId
     if not re.match(r'[0-9]{12}', args.master_account):
         raise ValueError("Master AccountId is not valid")
 
+    # Count the calls, retries, throttles and errors and time every API call of the run
+    utils.configure_api_metrics()
+
     # Getting GuardDuty regions
     session = boto3.session.Session()
 
@@ -54,9 +63,9 @@ if __name__ == '__main__':
 
     master_detector_id_dict = dict()
 
-    for aws_region in guardduty_regions:
+    def process_region(aws_region):
         try:
-            gd_client = boto3.client('guardduty', region_name=aws_region)
+            gd_client = utils.get_client(None, 'guardduty', aws_region)
             detector_dict = list_detectors(gd_client, aws_region)
 
             if detector_dict[aws_region]:
@@ -76,8 +85,6 @@ if __name__ == '__main__':
                     account=args.master_account
                 ))
 
-            master_detector=detector_dict[aws_region]
-
             response = gd_client.list_members(
                 DetectorId=detector_dict[aws_region],
                 OnlyAssociated='true'
@@ -141,4 +148,11 @@ if __name__ == '__main__':
             print('Error code: {code}, Error message: {message}'.format(
                     code=err.response['ResponseMetadata']['HTTPStatusCode'],
                     message=err.response['Error']['Message']
-                ))
\ No newline at end of file
+                ))
+            raise
+
+    # Regions are independent, they are processed concurrently
+    results = utils.run_regions(guardduty_regions, process_region, args.workers)
+    utils.print_region_results(results)
+
+    utils.print_api_metrics(args.metrics)
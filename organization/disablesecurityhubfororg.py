@@ -1,12 +1,16 @@
 import boto3
 import argparse
+import os
 import re
 import json
+import sys
 
 from collections import OrderedDict
 from botocore.exceptions import ClientError
 
-org_client = boto3.client('organizations')
+# Shared helpers live in the parent directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import utils
 
 def is_securityhub_enabled(client):
     """
@@ -36,12 +40,17 @@ if __name__ == '__main__':
     parser.add_argument('--master_region', type=str, required=True, help="Region that you want to use as the aggregation Region.")
     parser.add_argument('--enabled_regions', type=str, help="comma separated list of regions to enable SecurityHub. If not specified, all available regions enabled")
     parser.add_argument('--disable_master', action="store_true", help="indicate if disable SecurityHub service for master account")
+    parser.add_argument('--workers', type=int, default=10, help="number of regions processed concurrently. Defaults to 10")
+    parser.add_argument('--metrics', type=str, help="path of a JSON file to write the per-operation API call metrics and latency histograms to, a summary is printed at the end of the run")
     args = parser.parse_args()
 
     # Validate master accountId
     if not re.match(r'[0-9]{12}', args.master_account):
         raise ValueError("Master AccountId is not valid")
 
+    # Count the calls, retries, throttles and errors and time every API call of the run
+    utils.configure_api_metrics()
+
     # Getting SecurityHub regions
     session = boto3.session.Session()
 
@@ -56,7 +65,7 @@ if __name__ == '__main__':
     # Disabling finding aggregation for master region
     try:
 
-        sh_client = boto3.client('securityhub', region_name=args.master_region)
+        sh_client = utils.get_client(None, 'securityhub', args.master_region)
 
         if is_securityhub_enabled(sh_client):
 
@@ -95,9 +104,9 @@ if __name__ == '__main__':
                 message=err.response['Error']['Message']
             ))
 
-    for aws_region in securityhub_regions:
+    def process_region(aws_region):
         try:
-            sh_client = boto3.client('securityhub', region_name=aws_region)
+            sh_client = utils.get_client(None, 'securityhub', aws_region)
 
             if is_securityhub_enabled(sh_client):
                 
@@ -161,6 +170,10 @@ if __name__ == '__main__':
                     code=err.response['ResponseMetadata']['HTTPStatusCode'],
                     message=err.response['Error']['Message']
                 ))
-    
+            raise
+
+    # Regions are independent, they are processed concurrently
+    results = utils.run_regions(securityhub_regions, process_region, args.workers)
+    utils.print_region_results(results)
 
-    
\ No newline at end of file
+    utils.print_api_metrics(args.metrics)
@@ -1,12 +1,17 @@
 import boto3
 import argparse
+import os
 import re
 import json
+import sys
 
 from collections import OrderedDict
 from botocore.exceptions import ClientError
 
-org_client = boto3.client('organizations')
+# Shared helpers live in the parent directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import utils
+
 
 def list_detectors(client, aws_region):
     """
@@ -34,12 +39,18 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Link AWS Accounts to central GuardDuty Account')
     parser.add_argument('--master_account', type=str, required=True, help="AccountId for Central AWS Account")
     parser.add_argument('--enabled_regions', type=str, help="comma separated list of regions to enable GuardDuty. If not specified, all available regions enabled")
+    parser.add_argument('--organizational_unit', type=str, help="root or organizational unit id whose accounts, including the nested organizational units, are added as members. If not specified, all accounts of the organization are added")
+    parser.add_argument('--workers', type=int, default=10, help="number of regions processed concurrently. Defaults to 10")
+    parser.add_argument('--metrics', type=str, help="path of a JSON file to write the per-operation API call metrics and latency histograms to, a summary is printed at the end of the run")
     args = parser.parse_args()
 
     # Validate master accountId
     if not re.match(r'[0-9]{12}', args.master_account):
         raise ValueError("Master AccountId is not valid")
 
+    # Count the calls, retries, throttles and errors and time every API call of the run
+    utils.configure_api_metrics()
+
     # Getting GuardDuty regions
     session = boto3.session.Session()
 
@@ -53,9 +64,9 @@ if __name__ == '__main__':
 
     master_detector_id_dict = dict()
 
-    for aws_region in guardduty_regions:
+    def process_region(aws_region):
         try:
-            gd_client = boto3.client('guardduty', region_name=aws_region)
+            gd_client = utils.get_client(None, 'guardduty', aws_region)
             detector_dict = list_detectors(gd_client, aws_region)
 
             if detector_dict[aws_region]:
@@ -86,8 +97,6 @@ if __name__ == '__main__':
                 detector_dict.update({aws_region: detector_str})
                 master_detector_id_dict.update({aws_region: detector_dict[aws_region]})
 
-            master_detector=detector_dict[aws_region]
-
             response = gd_client.list_organization_admin_accounts()
 
             if response['AdminAccounts']:
@@ -105,19 +114,16 @@ if __name__ == '__main__':
                     region=aws_region
                 ))
 
-            response = org_client.list_accounts()
-            accountDetails=[]
-
-            if response['Accounts']:
-                for account in response['Accounts']:
-                    if account['Id'] != args.master_account:
-                        memberAccount = {
-                            'AccountId': account['Id'],
-                            'Email': account['Email']
-                        }
-                        accountDetails.append(memberAccount)
+            # The organization is listed once for all regions, members are created as the pages arrive
+            member_accounts = (
+                {'AccountId': account['Id'], 'Email': account['Email']}
+                for account in utils.get_account_enumerator(args.organizational_unit)
+                if account['Id'] != args.master_account
+            )
+            member_count = 0
 
-            if accountDetails:
+            for accountDetails in utils.chunks(member_accounts, utils.MEMBER_API_CHUNK_SIZE):
+                member_count += len(accountDetails)
                 print('Accounts found in organization of master account {account} in {region}: {accounts}'.format(
                     account=args.master_account,
                     region=aws_region,
@@ -139,7 +145,8 @@ if __name__ == '__main__':
                         detector=detector_dict[aws_region],
                         region=aws_region,
                     ))
-            else:
+
+            if not member_count:
                 print('No accounts found in organization of master account {account} in {region}'.format(
                     account=args.master_account,
                     region=aws_region
@@ -160,4 +167,11 @@ if __name__ == '__main__':
             print('Error code: {code}, Error message: {message}'.format(
                     code=err.response['ResponseMetadata']['HTTPStatusCode'],
                     message=err.response['Error']['Message']
-                ))
\ No newline at end of file
+                ))
+            raise
+
+    # Regions are independent, they are processed concurrently
+    results = utils.run_regions(guardduty_regions, process_region, args.workers)
+    utils.print_region_results(results)
+
+    utils.print_api_metrics(args.metrics)
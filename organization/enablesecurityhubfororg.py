@@ -1,12 +1,17 @@
 import boto3
 import argparse
+import os
 import re
 import json
+import sys
 
 from collections import OrderedDict
 from botocore.exceptions import ClientError
 
-org_client = boto3.client('organizations')
+# Shared helpers live in the parent directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import utils
+
 
 def is_securityhub_enabled(client):
     """
@@ -35,12 +40,18 @@ if __name__ == '__main__':
     parser.add_argument('--master_account', type=str, required=True, help="AccountId for Central AWS Account")
     parser.add_argument('--master_region', type=str, required=True, help="Region that you want to use as the aggregation Region.")
     parser.add_argument('--enabled_regions', type=str, help="comma separated list of regions to enable SecurityHub. If not specified, all available regions enabled")
+    parser.add_argument('--organizational_unit', type=str, help="root or organizational unit id whose accounts, including the nested organizational units, are added as members. If not specified, all accounts of the organization are added")
+    parser.add_argument('--workers', type=int, default=10, help="number of regions processed concurrently. Defaults to 10")
+    parser.add_argument('--metrics', type=str, help="path of a JSON file to write the per-operation API call metrics and latency histograms to, a summary is printed at the end of the run")
     args = parser.parse_args()
 
     # Validate master accountId
     if not re.match(r'[0-9]{12}', args.master_account):
         raise ValueError("Master AccountId is not valid")
 
+    # Count the calls, retries, throttles and errors and time every API call of the run
+    utils.configure_api_metrics()
+
     # Getting SecurityHub regions
     session = boto3.session.Session()
 
@@ -52,9 +63,9 @@ if __name__ == '__main__':
         securityhub_regions = session.get_available_regions('guardduty')
         print("Enabling members in all available SecurityHub regions {}".format(securityhub_regions))
 
-    for aws_region in securityhub_regions:
+    def process_region(aws_region):
         try:
-            sh_client = boto3.client('securityhub', region_name=aws_region)
+            sh_client = utils.get_client(None, 'securityhub', aws_region)
 
             if is_securityhub_enabled(sh_client):
                 print('Master account {account} is already subscribed to SecurityHub in {region}'.format(
@@ -87,19 +98,16 @@ if __name__ == '__main__':
                     region=aws_region
                 ))
 
-            response = org_client.list_accounts()
-            accountDetails=[]
-
-            if response['Accounts']:
-                for account in response['Accounts']:
-                    if account['Id'] != args.master_account:
-                        memberAccount = {
-                            'AccountId': account['Id'],
-                            'Email': account['Email']
-                        }
-                        accountDetails.append(memberAccount)
+            # The organization is listed once for all regions, members are created as the pages arrive
+            member_accounts = (
+                {'AccountId': account['Id'], 'Email': account['Email']}
+                for account in utils.get_account_enumerator(args.organizational_unit)
+                if account['Id'] != args.master_account
+            )
+            member_count = 0
 
-            if accountDetails:
+            for accountDetails in utils.chunks(member_accounts, utils.MEMBER_API_CHUNK_SIZE):
+                member_count += len(accountDetails)
                 print('Accounts found in organization of master account {account} in {region}: {accounts}'.format(
                     account=args.master_account,
                     region=aws_region,
@@ -120,7 +128,8 @@ if __name__ == '__main__':
                         account=args.master_account,
                         region=aws_region,
                     ))
-            else:
+
+            if not member_count:
                 print('No accounts found in organization of master account {account} in {region}'.format(
                     account=args.master_account,
                     region=aws_region
@@ -140,11 +149,16 @@ if __name__ == '__main__':
                     code=err.response['ResponseMetadata']['HTTPStatusCode'],
                     message=err.response['Error']['Message']
                 ))
+            raise
+
+    # Regions are independent, they are processed concurrently
+    results = utils.run_regions(securityhub_regions, process_region, args.workers)
+    utils.print_region_results(results)
 
     # Enabling finding aggregation only for master region
     try:
 
-        sh_client = boto3.client('securityhub', region_name=args.master_region)
+        sh_client = utils.get_client(None, 'securityhub', args.master_region)
         response = sh_client.list_finding_aggregators()
 
         if response['FindingAggregators']:
@@ -167,4 +181,6 @@ if __name__ == '__main__':
         print('Error code: {code}, Error message: {message}'.format(
                 code=err.response['ResponseMetadata']['HTTPStatusCode'],
                 message=err.response['Error']['Message']
-            ))
\ No newline at end of file
+            ))
+
+    utils.print_api_metrics(args.metrics)
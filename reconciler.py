@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+"""
+Copyright 2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this
+software and associated documentation files (the "Software"), to deal in the Software
+without restriction, including without limitation the rights to use, copy, modify,
+merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+This script keeps GuardDuty and SecurityHub enrollment converged as a long-running process.
+Sessions and clients stay warm between cycles. Every cycle reads the actual state of the
+accounts, diffs it against the accounts file and only applies the changes, the same way as
+the --apply mode of enableguardduty.py and enablesecurityhub.py. A full reconciliation runs
+every --interval seconds and accounts added to the accounts file are reconciled as soon as
+the file changes.
+"""
+
+import asyncio
+import boto3
+import os
+import re
+import signal
+import time
+import argparse
+import utils
+import enableguardduty
+import enablesecurityhub
+
+from collections import OrderedDict
+from botocore.exceptions import ClientError
+
+
+def read_accounts(path):
+    """
+    Reads the accounts file
+    :param path: Path of the CSV file containing the list of account IDs and Email addresses
+    :return: OrderedDict of AwsAccountId:Email
+    """
+
+    aws_account_dict = OrderedDict()
+
+    with open(path) as input_file:
+        for acct in input_file.readlines():
+            split_line = acct.rstrip().split(",")
+            if len(split_line) < 2:
+                print("Unable to process line: {}".format(acct))
+                continue
+
+            if not re.match(r'[0-9]{12}', str(split_line[0])):
+                print("Invalid account number {}, skipping".format(split_line[0]))
+                continue
+
+            aws_account_dict[split_line[0]] = split_line[1]
+
+    return aws_account_dict
+
+
+def print_failed_accounts(failed_accounts):
+    if len(failed_accounts) > 0:
+        print("---------------------------------------------------------------")
+        print("Failed Accounts")
+        print("---------------------------------------------------------------")
+        for account in failed_accounts:
+            for account_id, message in account.items():
+                print("{}: \n\t{}".format(account_id, message))
+        print("---------------------------------------------------------------")
+
+
+def reconcile_guardduty(aws_account_dict, regions, args):
+    """
+    Converges the GuardDuty detectors and memberships of the accounts
+    :return: list of {AwsAccountId: error} for the failed accounts
+    """
+
+    master_session = utils.get_credential_broker(enableguardduty.ROLE_SESSION_NAME).get_session(args.master_account, args.assume_role)
+    invite_message = 'Account {account} invites you to join GuardDuty.'.format(account=args.master_account)
+
+    master_detector_id_dict = dict()
+    for aws_region in regions:
+        try:
+            gd_client = utils.get_client(master_session, 'guardduty', aws_region)
+            detector_id = enableguardduty.list_detectors(gd_client, aws_region)[aws_region]
+            if not detector_id:
+                detector_id = gd_client.create_detector(Enable=True)['DetectorId']
+                print('Created detector {detector} in {region} for {account}'.format(
+                    detector=detector_id,
+                    region=aws_region,
+                    account=args.master_account
+                ))
+            master_detector_id_dict[aws_region] = detector_id
+
+            # The member index is kept between cycles, only the accounts of the file are read again
+            if args.linking:
+                enableguardduty.get_member_index(master_session, aws_region, detector_id).refresh(list(aws_account_dict.keys()))
+        except ClientError as err:
+            print("Error reading GuardDuty master account in {}: {}".format(aws_region, repr(err)))
+
+    regions = [aws_region for aws_region in regions if aws_region in master_detector_id_dict]
+
+    plan, failed_accounts = enableguardduty.build_plan(
+        aws_account_dict, regions, args.assume_role, master_session, master_detector_id_dict,
+        args.master_account, args.linking, max(10, args.workers)
+    )
+    utils.print_plan(plan)
+
+    changes = set(unit for unit, actions in plan.items() if actions)
+    if changes:
+        failed_accounts.extend(enableguardduty.process_accounts_concurrently(
+            aws_account_dict, regions, args.assume_role, master_session, master_detector_id_dict,
+            args.master_account, invite_message, args.linking, args.workers, args.workers,
+            only_units=changes
+        ))
+
+    return failed_accounts
+
+
+def reconcile_securityhub(aws_account_dict, regions, standards_arns, args):
+    """
+    Converges AWS Config, SecurityHub, the standards and the memberships of the accounts
+    :return: list of {AwsAccountId: error} for the failed accounts
+    """
+
+    master_session = utils.get_credential_broker(enablesecurityhub.ROLE_SESSION_NAME).get_session(args.master_account, args.assume_role)
+
+    # AWS Config may have been turned off since the previous cycle
+    enablesecurityhub.clear_config_cache()
+
+    master_clients = dict()
+    members = dict()
+    for aws_region in regions:
+        try:
+            master_clients[aws_region] = utils.get_client(master_session, 'securityhub', aws_region)
+            master_state = enablesecurityhub.describe_unit(master_session, aws_region)
+            if enablesecurityhub.diff_unit(master_state, aws_region, standards_arns, linking=False, config=False):
+                if not master_state['hub']:
+                    master_clients[aws_region].enable_security_hub()
+                if standards_arns:
+                    enablesecurityhub.enable_standards(master_clients[aws_region], aws_region, standards_arns)
+
+            # The member index is kept between cycles, only the accounts of the file are read again
+            members[aws_region] = utils.get_member_index(master_clients[aws_region])
+            members[aws_region].refresh(list(aws_account_dict.keys()))
+        except ClientError as err:
+            print("Error reading SecurityHub master account in {}: {}".format(aws_region, repr(err)))
+
+    regions = [aws_region for aws_region in regions if aws_region in members]
+
+    plan, failed_accounts = enablesecurityhub.build_plan(
+        aws_account_dict, regions, args.assume_role, members,
+        args.master_account, standards_arns, max(10, args.workers)
+    )
+    utils.print_plan(plan)
+
+    changes = set(unit for unit, actions in plan.items() if actions)
+    if changes:
+        failed_accounts.extend(asyncio.run(enablesecurityhub.process_accounts_async(
+            aws_account_dict, regions, args.assume_role, master_clients, members,
+            args.master_account, standards_arns, args.workers, changes
+        )))
+
+    return failed_accounts
+
+
+def stop(signum, frame):
+    raise SystemExit(0)
+
+
+def reconcile(aws_account_dict, services, guardduty_regions, securityhub_regions, standards_arns, args):
+    """
+    Runs one reconciliation cycle for the accounts
+    """
+
+    start_time = time.time()
+    failed_accounts = []
+    error = None
+
+    # A failed cycle is retried by the next one, the process keeps running
+    try:
+        if 'guardduty' in services:
+            failed_accounts.extend(reconcile_guardduty(aws_account_dict, guardduty_regions, args))
+
+        if 'securityhub' in services:
+            failed_accounts.extend(reconcile_securityhub(aws_account_dict, securityhub_regions, standards_arns, args))
+    except Exception as e:
+        print("Error reconciling accounts: {}".format(repr(e)))
+        error = e
+
+    utils.print_rate_limits()
+    utils.print_api_metrics(args.metrics)
+    print_failed_accounts(failed_accounts)
+    utils.log_event('reconciler', phase='cycle', outcome='failed' if error else 'completed', duration=time.time() - start_time,
+                    error=error, accounts=len(aws_account_dict), failed=len(failed_accounts))
+    print("Reconciled {} accounts in {:.1f}s".format(len(aws_account_dict), time.time() - start_time))
+
+
+if __name__ == '__main__':
+
+    # Setup command line arguments
+    parser = argparse.ArgumentParser(description='Continuously reconcile the GuardDuty and SecurityHub enrollment of AWS Accounts')
+    parser.add_argument('--master_account', type=str, required=True, help="AccountId for Central AWS Account")
+    parser.add_argument('input_file', type=str, help='Path to CSV file containing the list of account IDs and Email addresses, watched for changes')
+    parser.add_argument('--assume_role', type=str, required=True, help="Role Name to assume in each account")
+    parser.add_argument('--services', type=str, default='guardduty,securityhub', help="comma separated list of services to reconcile. Defaults to guardduty,securityhub")
+    parser.add_argument('--enabled_regions', type=str, help="comma separated list of regions to reconcile. If not specified, all available regions of each service")
+    parser.add_argument('--enable_standards', type=str, required=False, help="comma separated list of SecurityHub standards ARN resources to enable ( i.e. ruleset/cis-aws-foundations-benchmark/v/1.2.0 )")
+    parser.add_argument('-l', '--linking', action="store_true", help="indicate if linking GuardDuty member accounts to master account")
+    parser.add_argument('--workers', type=int, default=10, help="number of account/region units processed concurrently. Defaults to 10")
+    parser.add_argument('--interval', type=int, default=3600, help="seconds between full reconciliations. Defaults to 3600")
+    parser.add_argument('--watch_interval', type=int, default=5, help="seconds between checks of the accounts file for changes. Defaults to 5")
+    parser.add_argument('--event_log', type=str, help="path of a JSON lines file the structured events of every cycle (account, region, phase, outcome, duration, error) are appended to")
+    parser.add_argument('--event_console', action="store_true", help="print a human-readable line for every structured event")
+    parser.add_argument('--metrics', type=str, help="path of a JSON file to write the API call metrics and latency histograms of the process to after every cycle")
+    args = parser.parse_args()
+
+    # Validate master accountId
+    if not re.match(r'[0-9]{12}', args.master_account):
+        raise ValueError("Master AccountId is not valid")
+
+    if args.workers < 1:
+        raise ValueError("--workers must be at least 1")
+
+    services = [str(item) for item in args.services.split(',')]
+    for service in services:
+        if service not in ('guardduty', 'securityhub'):
+            raise ValueError("Unknown service {}".format(service))
+
+    # Stop cleanly on SIGTERM, e.g. from systemd or a container runtime
+    signal.signal(signal.SIGTERM, stop)
+
+    if args.event_log or args.event_console:
+        utils.open_event_log(args.event_log, args.event_console)
+
+    # Count the calls, retries, throttles and errors and time every API call of the process
+    utils.configure_api_metrics()
+
+    # Clients and sessions are kept for the lifetime of the process
+    utils.configure_client_pool(max_pool_connections=max(10, args.workers))
+    # Parallel calls hit the GuardDuty and SecurityHub request limits, pace them per operation, region and account
+    utils.configure_rate_limiter()
+
+    session = boto3.session.Session()
+    if args.enabled_regions:
+        guardduty_regions = securityhub_regions = [str(item) for item in args.enabled_regions.split(',')]
+    else:
+        guardduty_regions = session.get_available_regions('guardduty')
+        securityhub_regions = session.get_available_regions('securityhub')
+
+    standards_arns = []
+    if args.enable_standards:
+        standards_arns = [str(item) for item in args.enable_standards.split(',')]
+        print("Keeping the following Security Hub Standards enabled, AWS Config is enabled where needed: {}".format(standards_arns))
+
+    aws_account_dict = read_accounts(args.input_file)
+    last_modified = os.stat(args.input_file).st_mtime
+    next_full_run = 0
+
+    try:
+        while True:
+            if time.time() >= next_full_run:
+                print("Reconciling all {} accounts".format(len(aws_account_dict)))
+                reconcile(aws_account_dict, services, guardduty_regions, securityhub_regions, standards_arns, args)
+                next_full_run = time.time() + args.interval
+
+            time.sleep(args.watch_interval)
+
+            try:
+                modified = os.stat(args.input_file).st_mtime
+            except OSError as e:
+                print("Unable to read {}: {}".format(args.input_file, repr(e)))
+                continue
+
+            if modified != last_modified:
+                last_modified = modified
+                updated_account_dict = read_accounts(args.input_file)
+
+                # Accounts added to the file, or whose email changed, are reconciled right away
+                added = OrderedDict(
+                    (account, email) for account, email in updated_account_dict.items()
+                    if aws_account_dict.get(account) != email
+                )
+                removed = [account for account in aws_account_dict if account not in updated_account_dict]
+                aws_account_dict = updated_account_dict
+
+                if removed:
+                    print("Accounts removed from {}, they are left as they are: {}".format(args.input_file, removed))
+
+                if added:
+                    print("Reconciling {} accounts added to {}".format(len(added), args.input_file))
+                    reconcile(added, services, guardduty_regions, securityhub_regions, standards_arns, args)
+
+    except KeyboardInterrupt:
+        print("Stopping")
@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+"""
+Copyright 2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this
+software and associated documentation files (the "Software"), to deal in the Software
+without restriction, including without limitation the rights to use, copy, modify,
+merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+This script builds the weekly findings report. Findings are loaded once into NumPy column arrays,
+from the SQLite index of syncfindings.py or from the files of exportfindings.py and EventBridge
+events like data/findiings_sample.json. Group-by rollups, week-over-week deltas and the top
+resources are then computed with vectorized operations on integer codes of the columns, and
+written as CSV and JSON.
+"""
+
+import csv
+import gzip
+import io
+import json
+import os
+import sqlite3
+import time
+import argparse
+import syncfindings
+
+from collections import OrderedDict
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Columns loaded for every finding, updated_at and created_at are milliseconds since the epoch once loaded
+CATEGORY_COLUMNS = ('service', 'account', 'region', 'severity_label', 'product', 'type', 'resource_id', 'record_state')
+TIME_COLUMNS = ('created_at', 'updated_at')
+
+DEFAULT_ROLLUPS = 'account;region;severity_label;product;type;account,severity_label'
+
+WEEK_MILLIS = 7 * 86400 * 1000
+
+
+def finding_values(finding, aws_region=None):
+    """
+    Extracts the report columns of a SecurityHub or GuardDuty finding
+    Timestamps are kept as strings and parsed all at once by to_columns
+    :return: tuple in the order of CATEGORY_COLUMNS followed by TIME_COLUMNS
+    """
+
+    if 'AwsAccountId' in finding:
+        resources = finding.get('Resources') or [{}]
+        return (
+            'securityhub',
+            finding.get('AwsAccountId') or '',
+            finding.get('Region') or aws_region or '',
+            syncfindings.securityhub_severity_label(finding.get('Severity', {})),
+            finding.get('ProductName') or finding.get('ProductArn') or '',
+            (finding.get('Types') or [''])[0],
+            resources[0].get('Id') or '',
+            finding.get('RecordState') or 'ACTIVE',
+            finding['CreatedAt'].rstrip('Z'),
+            finding['UpdatedAt'].rstrip('Z')
+        )
+
+    return (
+        'guardduty',
+        finding.get('AccountId') or '',
+        finding.get('Region') or aws_region or '',
+        syncfindings.guardduty_severity_label(finding.get('Severity', 0)),
+        'GuardDuty',
+        finding.get('Type') or '',
+        syncfindings.guardduty_resource_id(finding.get('Resource', {})) or '',
+        'ARCHIVED' if finding.get('Service', {}).get('Archived') else 'ACTIVE',
+        finding['CreatedAt'].rstrip('Z'),
+        finding['UpdatedAt'].rstrip('Z')
+    )
+
+
+def iter_findings(document):
+    """
+    Yields the findings of a finding, a list of findings or an EventBridge event carrying findings
+    """
+
+    if isinstance(document, list):
+        for item in document:
+            for finding in iter_findings(item):
+                yield finding
+    elif 'detail' in document:
+        for finding in document['detail'].get('findings', []):
+            yield finding
+        if 'Id' in document['detail'] and 'Type' in document['detail']:
+            # GuardDuty findings are delivered one per event
+            yield document['detail']
+    else:
+        yield document
+
+
+def open_text(path):
+    if path.endswith('.gz'):
+        # Files of exportfindings.py are one gzip member per page, gzip reads across members
+        return gzip.open(path, 'rt', encoding='utf-8')
+    if path.endswith('.zst'):
+        if zstandard is None:
+            raise ValueError("Reading {} requires the zstandard package, install it with pip install zstandard".format(path))
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), read_across_frames=True), encoding='utf-8')
+    return open(path, encoding='utf-8')
+
+
+def load_files(paths):
+    """
+    Loads findings from JSON lines files, optionally compressed, and JSON documents such as data/findiings_sample.json
+    :return: list of tuples in the order of CATEGORY_COLUMNS followed by TIME_COLUMNS
+    """
+
+    rows = []
+    for path in paths:
+        with open_text(path) as input_file:
+            if path.endswith('.json'):
+                documents = [json.load(input_file)]
+            else:
+                documents = (json.loads(line) for line in input_file if line.strip())
+
+            for document in documents:
+                for finding in iter_findings(document):
+                    rows.append(finding_values(finding))
+
+    return rows
+
+
+def load_database(path):
+    """
+    Loads findings from the SQLite index of syncfindings.py, the type is read from the stored finding
+    :return: list of tuples in the order of CATEGORY_COLUMNS followed by TIME_COLUMNS
+    """
+
+    connection = sqlite3.connect(path)
+    try:
+        return connection.execute(
+            "SELECT service, COALESCE(account, ''), COALESCE(region, ''), COALESCE(severity_label, ''), COALESCE(product, ''), "
+            "COALESCE(json_extract(finding, '$.Types[0]'), json_extract(finding, '$.Type'), ''), COALESCE(resource_id, ''), "
+            "COALESCE(record_state, 'ACTIVE'), COALESCE(created_at, updated_at), updated_at FROM findings"
+        ).fetchall()
+    finally:
+        connection.close()
+
+
+def to_columns(rows):
+    """
+    Transposes the rows into column arrays, category columns are stored as integer codes into their unique values
+    Time columns mix milliseconds from the database and ISO 8601 strings from files, numpy parses both in one pass
+    :return: OrderedDict of column: (values, codes) for the category columns and column: int64 array for the time columns
+    """
+
+    columns = OrderedDict()
+    transposed = list(zip(*rows)) if rows else [()] * (len(CATEGORY_COLUMNS) + len(TIME_COLUMNS))
+
+    for index, column in enumerate(CATEGORY_COLUMNS):
+        values, codes = numpy.unique(numpy.array(transposed[index], dtype=object).astype(str), return_inverse=True)
+        columns[column] = (values, codes.reshape(-1))
+
+    for index, column in enumerate(TIME_COLUMNS):
+        columns[column] = numpy.array(transposed[len(CATEGORY_COLUMNS) + index], dtype='datetime64[ms]').astype(numpy.int64)
+
+    return columns
+
+
+def group_codes(columns, dimensions):
+    """
+    :return: (list of tuples of dimension values of every group, group index of every finding)
+    """
+
+    if len(dimensions) == 1:
+        values, codes = columns[dimensions[0]]
+        return [(value,) for value in values], codes
+
+    stacked = numpy.stack([columns[dimension][1] for dimension in dimensions], axis=1)
+    groups, inverse = numpy.unique(stacked, axis=0, return_inverse=True)
+    labels = [
+        tuple(columns[dimension][0][code] for dimension, code in zip(dimensions, group))
+        for group in groups
+    ]
+    return labels, inverse.reshape(-1)
+
+
+def rollup(columns, dimensions, masks):
+    """
+    Counts the findings of every group of the dimensions under each mask
+    :param dimensions: list of category columns to group by
+    :param masks: OrderedDict of name: boolean array selecting the findings counted under that name
+    :return: list of OrderedDict rows, the groups with the most findings in the current week first
+    """
+
+    labels, codes = group_codes(columns, dimensions)
+    counts = OrderedDict(
+        (name, numpy.bincount(codes[mask], minlength=len(labels)))
+        for name, mask in masks.items()
+    )
+    counts['delta'] = counts['current_week'] - counts['previous_week']
+
+    present = numpy.flatnonzero(counts['active'] + counts['current_week'] + counts['previous_week'])
+    order = present[numpy.lexsort((-counts['active'][present], -counts['current_week'][present]))]
+
+    rows = []
+    for index in order:
+        row = OrderedDict(zip(dimensions, labels[index]))
+        for name, values in counts.items():
+            row[name] = int(values[index])
+        rows.append(row)
+    return rows
+
+
+def top_resources(columns, mask, count):
+    """
+    :return: list of OrderedDict rows of the resources with the most findings under the mask
+    """
+
+    values, codes = columns['resource_id']
+    counts = numpy.bincount(codes[mask], minlength=len(values))
+    counts[values == ''] = 0
+    top = numpy.argsort(-counts, kind='stable')[:count]
+    return [OrderedDict([('resource_id', values[index]), ('findings', int(counts[index]))]) for index in top if counts[index]]
+
+
+def write_csv(path, rows):
+    with open(path, 'w', newline='') as output_file:
+        if not rows:
+            return
+        writer = csv.DictWriter(output_file, fieldnames=list(rows[0].keys()))
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+if __name__ == '__main__':
+
+    # Setup command line arguments
+    parser = argparse.ArgumentParser(description='Compute the weekly rollups of SecurityHub and GuardDuty findings')
+    parser.add_argument('--database', type=str, help="path of the SQLite index of syncfindings.py to load the findings from")
+    parser.add_argument('--findings', type=str, help="comma separated list of JSON lines files of exportfindings.py (.jsonl, .jsonl.gz, .jsonl.zst) or JSON files of findings or events to load the findings from")
+    parser.add_argument('--output_dir', type=str, required=True, help="directory the CSV files and report.json are written to")
+    parser.add_argument('--rollups', type=str, default=DEFAULT_ROLLUPS, help="semicolon separated list of rollups, each a comma separated list of columns among {}. Defaults to {}".format(','.join(CATEGORY_COLUMNS), DEFAULT_ROLLUPS))
+    parser.add_argument('--top', type=int, default=20, help="number of resources with the most new findings of the week to report. Defaults to 20")
+    parser.add_argument('--as_of', type=str, help="end of the current week as an ISO 8601 timestamp in UTC. Defaults to now")
+    args = parser.parse_args()
+
+    if numpy is None:
+        raise ValueError("reportfindings.py requires the numpy package, install it with pip install numpy")
+
+    if not args.database and not args.findings:
+        raise ValueError("--database or --findings is required")
+
+    rollups = [[str(column) for column in item.split(',')] for item in args.rollups.split(';') if item]
+    for dimensions in rollups:
+        for column in dimensions:
+            if column not in CATEGORY_COLUMNS:
+                raise ValueError("Unknown column {}".format(column))
+
+    if not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    start_time = time.time()
+    rows = []
+    if args.database:
+        rows.extend(load_database(args.database))
+    if args.findings:
+        rows.extend(load_files([str(item) for item in args.findings.split(',')]))
+    columns = to_columns(rows)
+    del rows
+    loaded_time = time.time()
+    print("Loaded {} findings in {:.1f}s".format(len(columns['updated_at']), loaded_time - start_time))
+
+    # Weeks are counted on CreatedAt, a finding is new in the week it was created
+    as_of = syncfindings.to_epoch_millis(args.as_of) if args.as_of else int(time.time() * 1000)
+    created_at = columns['created_at']
+    values, codes = columns['record_state']
+    masks = OrderedDict([
+        ('active', numpy.isin(codes, numpy.flatnonzero(values == 'ACTIVE'))),
+        ('current_week', (created_at >= as_of - WEEK_MILLIS) & (created_at < as_of)),
+        ('previous_week', (created_at >= as_of - 2 * WEEK_MILLIS) & (created_at < as_of - WEEK_MILLIS)),
+    ])
+
+    report = OrderedDict([
+        ('as_of', syncfindings.to_timestamp(as_of)),
+        ('findings', int(len(created_at))),
+        ('active', int(masks['active'].sum())),
+        ('current_week', int(masks['current_week'].sum())),
+        ('previous_week', int(masks['previous_week'].sum())),
+        ('rollups', OrderedDict()),
+    ])
+
+    for dimensions in rollups:
+        name = '_'.join(dimensions)
+        report['rollups'][name] = rollup(columns, dimensions, masks)
+        write_csv(os.path.join(args.output_dir, 'rollup_{}.csv'.format(name)), report['rollups'][name])
+
+    report['top_resources'] = top_resources(columns, masks['current_week'], args.top)
+    write_csv(os.path.join(args.output_dir, 'top_resources.csv'), report['top_resources'])
+
+    with open(os.path.join(args.output_dir, 'report.json'), 'w') as output_file:
+        json.dump(report, output_file, indent=2)
+
+    print("---------------------------------------------------------------")
+    print("Findings Report as of {}".format(report['as_of']))
+    print("---------------------------------------------------------------")
+    print("{} findings, {} active, {} new this week, {} new the previous week".format(
+        report['findings'], report['active'], report['current_week'], report['previous_week']
+    ))
+    if 'severity_label' in report['rollups']:
+        for row in report['rollups']['severity_label']:
+            print("{}: {} active, {} new this week ({:+d})".format(row['severity_label'], row['active'], row['current_week'], row['delta']))
+    print("Computed the rollups in {:.2f}s, written to {}".format(time.time() - loaded_time, args.output_dir))
+    print("---------------------------------------------------------------")
@@ -0,0 +1,406 @@
+#!/usr/bin/env python
+"""
+Copyright 2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this
+software and associated documentation files (the "Software"), to deal in the Software
+without restriction, including without limitation the rights to use, copy, modify,
+merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+This script is an HTTP(S) endpoint for the SNS topic of template/Notification.json. It runs a
+single asyncio event loop with keep-alive connections, confirms the subscription, verifies the
+signature of every message with the signing certificates cached per URL, drops duplicate
+deliveries and queues the findings of the notifications. A batcher hands the queued findings to
+the JSON lines output in batches, and a full queue answers 503 so that SNS retries later.
+
+The stand-in benchmark/snsload.py posts signed SNS-format payloads for local testing.
+"""
+
+import asyncio
+import base64
+import json
+import re
+import signal
+import ssl
+import argparse
+
+from collections import OrderedDict
+from urllib.parse import urlparse
+from urllib.request import urlopen
+
+try:
+    from cryptography import x509
+    from cryptography.exceptions import InvalidSignature
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import padding
+except ImportError:
+    x509 = None
+
+# Maximum size of an SNS message is 256 KB, the HTTP body carries it with its envelope
+MAX_BODY_SIZE = 1024 * 1024
+
+# Fields of each message type that are signed, in the order of the string to sign
+SIGNED_FIELDS = {
+    'Notification': ('Message', 'MessageId', 'Subject', 'Timestamp', 'TopicArn', 'Type'),
+    'SubscriptionConfirmation': ('Message', 'MessageId', 'SubscribeURL', 'Timestamp', 'Token', 'TopicArn', 'Type'),
+    'UnsubscribeConfirmation': ('Message', 'MessageId', 'SubscribeURL', 'Timestamp', 'Token', 'TopicArn', 'Type'),
+}
+
+SIGNING_CERT_HOST = re.compile(r'^sns\.[a-z0-9-]+\.amazonaws\.com(\.cn)?$')
+
+REASONS = {200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found', 405: 'Method Not Allowed', 413: 'Payload Too Large', 503: 'Service Unavailable'}
+
+
+class SignatureVerifier(object):
+    """
+    Verifies the signature of SNS messages, the public key of every signing certificate is downloaded once
+    Concurrent messages signed with a certificate that is not cached yet wait for the same download
+    """
+
+    def __init__(self, test_cert=None):
+        """
+        :param test_cert: Path of a PEM certificate used for every message instead of downloading the signing certificate, for local testing
+        """
+        self._keys = dict()
+        self._downloads = dict()
+        self._test_key = None
+        if test_cert:
+            with open(test_cert, 'rb') as cert_file:
+                self._test_key = x509.load_pem_x509_certificate(cert_file.read()).public_key()
+
+    def _download(self, url):
+        parsed = urlparse(url)
+        if parsed.scheme != 'https' or not SIGNING_CERT_HOST.match(parsed.hostname or ''):
+            raise ValueError("Untrusted SigningCertURL {}".format(url))
+        with urlopen(url, timeout=10) as response:
+            return x509.load_pem_x509_certificate(response.read()).public_key()
+
+    async def _public_key(self, url):
+        if self._test_key is not None:
+            return self._test_key
+        if url in self._keys:
+            return self._keys[url]
+
+        if url not in self._downloads:
+            self._downloads[url] = asyncio.ensure_future(asyncio.get_running_loop().run_in_executor(None, self._download, url))
+        try:
+            self._keys[url] = await self._downloads[url]
+        finally:
+            self._downloads.pop(url, None)
+        return self._keys[url]
+
+    async def verify(self, message):
+        """
+        :raise ValueError: if the message is not signed by SNS
+        """
+        fields = SIGNED_FIELDS.get(message.get('Type'))
+        if fields is None:
+            raise ValueError("Unknown message type {}".format(message.get('Type')))
+
+        string_to_sign = ''.join(
+            '{}\n{}\n'.format(field, message[field]) for field in fields if message.get(field) is not None
+        ).encode('utf-8')
+        algorithm = hashes.SHA256() if message.get('SignatureVersion') == '2' else hashes.SHA1()
+
+        public_key = await self._public_key(message.get('SigningCertURL', ''))
+        try:
+            public_key.verify(base64.b64decode(message.get('Signature', '')), string_to_sign, padding.PKCS1v15(), algorithm)
+        except InvalidSignature:
+            raise ValueError("Invalid signature of message {}".format(message.get('MessageId')))
+
+
+class Receiver(object):
+    """
+    Handles the SNS deliveries and queues the findings of the notifications
+    """
+
+    def __init__(self, verifier, topic_arns=None, queue_size=100000, dedupe_size=100000):
+        """
+        :param verifier: SignatureVerifier, None to accept unsigned messages
+        :param topic_arns: collection of the TopicArns accepted, any topic if None
+        :param queue_size: Number of findings queued at most before deliveries are rejected with 503
+        :param dedupe_size: Number of recent MessageIds kept to drop duplicate deliveries
+        """
+        self.verifier = verifier
+        self.topic_arns = topic_arns
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.dedupe_size = dedupe_size
+        self.stats = OrderedDict([('notifications', 0), ('findings', 0), ('duplicates', 0), ('rejected', 0), ('invalid', 0)])
+        self.stopping = False
+        self._message_ids = OrderedDict()
+        self._writers = set()
+
+    async def handle(self, method, body):
+        """
+        :return: HTTP status of the response
+        """
+        if method != 'POST':
+            return 405
+
+        try:
+            message = json.loads(body)
+        except ValueError:
+            self.stats['invalid'] += 1
+            return 400
+        if not isinstance(message, dict) or message.get('Type') not in SIGNED_FIELDS or \
+                any(field not in message for field in ('Message', 'MessageId', 'Timestamp', 'TopicArn')):
+            self.stats['invalid'] += 1
+            return 400
+
+        if self.topic_arns is not None and message.get('TopicArn') not in self.topic_arns:
+            self.stats['invalid'] += 1
+            return 403
+
+        if self.verifier is not None:
+            try:
+                await self.verifier.verify(message)
+            except (ValueError, TypeError) as e:
+                self.stats['invalid'] += 1
+                print("Rejected message: {}".format(e))
+                return 403
+            except OSError as e:
+                # The signing certificate could not be downloaded, SNS retries the delivery
+                print("Error downloading the signing certificate: {}".format(repr(e)))
+                return 503
+
+        if message['Type'] == 'SubscriptionConfirmation':
+            print("Confirming the subscription to {}".format(message['TopicArn']))
+            asyncio.get_running_loop().run_in_executor(None, self.confirm, message.get('SubscribeURL', ''))
+            return 200
+
+        if message['Type'] == 'UnsubscribeConfirmation':
+            print("Unsubscribed from {}".format(message['TopicArn']))
+            return 200
+
+        # SNS delivers at least once, a retried delivery carries the same MessageId
+        if message['MessageId'] in self._message_ids:
+            self.stats['duplicates'] += 1
+            return 200
+
+        try:
+            event = json.loads(message['Message'])
+        except ValueError:
+            event = {'Message': message['Message']}
+        findings = event.get('detail', {}).get('findings') if isinstance(event, dict) else None
+        items = findings if findings else [event]
+
+        # Once the receiver stops the queue is drained for the last time, SNS retries the delivery later
+        if self.stopping:
+            return 503
+
+        if self.queue.maxsize and self.queue.qsize() + len(items) > self.queue.maxsize:
+            self.stats['rejected'] += 1
+            return 503
+
+        for item in items:
+            self.queue.put_nowait(item)
+
+        self._message_ids[message['MessageId']] = True
+        if len(self._message_ids) > self.dedupe_size:
+            self._message_ids.popitem(last=False)
+
+        self.stats['notifications'] += 1
+        self.stats['findings'] += len(items)
+        return 200
+
+    def confirm(self, subscribe_url):
+        parsed = urlparse(subscribe_url)
+        if self.verifier is not None and (parsed.scheme != 'https' or not SIGNING_CERT_HOST.match(parsed.hostname or '')):
+            print("Untrusted SubscribeURL {}, the subscription is not confirmed".format(subscribe_url))
+            return
+        try:
+            with urlopen(subscribe_url, timeout=10) as response:
+                response.read()
+            print("Subscription confirmed")
+        except (OSError, ValueError) as e:
+            print("Error confirming the subscription: {}".format(repr(e)))
+
+    def close_connections(self):
+        """
+        Closes the open keep-alive connections, their requests in progress are answered 503
+        """
+        self.stopping = True
+        for writer in list(self._writers):
+            writer.close()
+
+    async def serve_connection(self, reader, writer):
+        """
+        Serves the HTTP/1.1 requests of a keep-alive connection one after the other
+        """
+        self._writers.add(writer)
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+
+                headers = dict()
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                method = request_line.split(b' ', 1)[0].decode('latin-1')
+                length = int(headers.get('content-length', 0))
+                if length > MAX_BODY_SIZE:
+                    status = 413
+                    keep_alive = False
+                else:
+                    body = await reader.readexactly(length)
+                    status = await self.handle(method, body)
+                    keep_alive = headers.get('connection', '').lower() != 'close' and not self.stopping
+
+                writer.write('HTTP/1.1 {} {}\r\nContent-Length: 0\r\n{}\r\n'.format(
+                    status, REASONS[status], '' if keep_alive else 'Connection: close\r\n'
+                ).encode('latin-1'))
+                await writer.drain()
+
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+
+async def batcher(queue, output_path, batch_size, batch_interval, stats):
+    """
+    Takes the queued findings in batches of up to batch_size, or whatever arrived within batch_interval
+    Batches are appended to the output file on the default executor, off the event loop
+    """
+
+    loop = asyncio.get_running_loop()
+    output_file = open(output_path, 'a') if output_path else None
+
+    def write(batch):
+        output_file.write(''.join(json.dumps(item, separators=(',', ':')) + '\n' for item in batch))
+        output_file.flush()
+
+    # The batch being filled and its write are kept outside the loop, so that findings already
+    # acknowledged to SNS are still written when the receiver stops in the middle of a batch
+    batch = []
+    pending_write = None
+    try:
+        while True:
+            batch.append(await queue.get())
+            deadline = loop.time() + batch_interval
+            while len(batch) < batch_size:
+                while len(batch) < batch_size and not queue.empty():
+                    batch.append(queue.get_nowait())
+                remaining = deadline - loop.time()
+                if len(batch) >= batch_size or remaining <= 0:
+                    break
+                await asyncio.sleep(min(remaining, 0.01))
+
+            if output_file:
+                # Cancelling the batcher does not cancel a write that is running on the executor
+                pending_write = loop.run_in_executor(None, write, batch)
+                await asyncio.shield(pending_write)
+                pending_write = None
+            batch = []
+            stats['batches'] = stats.get('batches', 0) + 1
+    finally:
+        if pending_write is not None:
+            await asyncio.wait([pending_write])
+            if pending_write.exception() is None:
+                batch = []
+
+        # Findings still queued when the receiver stops are written before exiting
+        while not queue.empty():
+            batch.append(queue.get_nowait())
+        if output_file:
+            if batch:
+                write(batch)
+            output_file.close()
+
+
+async def print_stats(receiver, interval):
+    previous = dict(receiver.stats)
+    while True:
+        await asyncio.sleep(interval)
+        current = dict(receiver.stats)
+        print("{:.0f} notifications/s, {:.0f} findings/s, {} queued, {}".format(
+            (current['notifications'] - previous['notifications']) / interval,
+            (current['findings'] - previous['findings']) / interval,
+            receiver.queue.qsize(),
+            ', '.join('{} {}'.format(value, name) for name, value in current.items())
+        ))
+        previous = current
+
+
+async def main(args):
+    verifier = None if args.no_verify else SignatureVerifier(args.test_cert)
+    topic_arns = set(str(item) for item in args.topic_arns.split(',')) if args.topic_arns else None
+    receiver = Receiver(verifier, topic_arns, args.queue_size)
+
+    ssl_context = None
+    if args.certfile:
+        ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        ssl_context.load_cert_chain(args.certfile, args.keyfile)
+
+    server = await asyncio.start_server(receiver.serve_connection, args.host, args.port, ssl=ssl_context, backlog=1024)
+    print("Listening on {}://{}:{}".format('https' if ssl_context else 'http', args.host, args.port))
+
+    stopped = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stopped.set)
+
+    tasks = [
+        asyncio.ensure_future(batcher(receiver.queue, args.output, args.batch_size, args.batch_interval, receiver.stats)),
+        asyncio.ensure_future(print_stats(receiver, args.stats_interval)),
+    ]
+
+    await stopped.wait()
+
+    # Stop accepting deliveries before the batcher drains the queue for the last time, open keep-alive
+    # connections are closed too as closing the server only closes the listening socket
+    server.close()
+    receiver.close_connections()
+    try:
+        await asyncio.wait_for(server.wait_closed(), timeout=10)
+    except asyncio.TimeoutError:
+        pass
+
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    print("Stopped: {}".format(', '.join('{} {}'.format(value, name) for name, value in receiver.stats.items())))
+
+
+if __name__ == '__main__':
+
+    # Setup command line arguments
+    parser = argparse.ArgumentParser(description='Receive the SecurityHub finding notifications of an SNS topic over HTTP(S)')
+    parser.add_argument('--host', type=str, default='0.0.0.0', help="address to listen on. Defaults to 0.0.0.0")
+    parser.add_argument('--port', type=int, default=8080, help="port to listen on. Defaults to 8080")
+    parser.add_argument('--certfile', type=str, help="path of the PEM certificate chain to serve HTTPS with")
+    parser.add_argument('--keyfile', type=str, help="path of the PEM private key of --certfile")
+    parser.add_argument('--topic_arns', type=str, help="comma separated list of the SNS topic ARNs accepted. If not specified, any topic")
+    parser.add_argument('--output', type=str, help="path of a JSON lines file the batches of findings are appended to")
+    parser.add_argument('--batch_size', type=int, default=500, help="number of findings handed over in a batch at most. Defaults to 500")
+    parser.add_argument('--batch_interval', type=float, default=1.0, help="seconds a batch waits to fill up. Defaults to 1")
+    parser.add_argument('--queue_size', type=int, default=100000, help="number of findings queued at most, deliveries are rejected with 503 beyond. Defaults to 100000")
+    parser.add_argument('--stats_interval', type=float, default=10, help="seconds between throughput reports. Defaults to 10")
+    parser.add_argument('--test_cert', type=str, help="path of a PEM certificate that signs every message instead of the SNS signing certificates, for local testing with benchmark/snsload.py")
+    parser.add_argument('--no_verify', action="store_true", help="accept messages without verifying their signature, for local testing only")
+    args = parser.parse_args()
+
+    if args.certfile and not args.keyfile:
+        raise ValueError("--certfile requires --keyfile")
+
+    if not args.no_verify and x509 is None:
+        raise ValueError("Verifying the SNS signatures requires the cryptography package, install it with pip install cryptography")
+
+    asyncio.run(main(args))
@@ -0,0 +1,383 @@
+#!/usr/bin/env python
+"""
+Copyright 2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this
+software and associated documentation files (the "Software"), to deal in the Software
+without restriction, including without limitation the rights to use, copy, modify,
+merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+This script keeps a local SQLite index of the SecurityHub and GuardDuty findings of the
+administrator account up to date. Every (service, region) keeps a watermark, the UpdatedAt of
+the latest finding stored, and a sync only fetches the findings updated since, sorted by UpdatedAt
+so that the watermark moves forward with every page. Findings are upserted by Id and indexed by
+account, region, severity label, product, resource and UpdatedAt for local queries.
+"""
+
+import boto3
+import calendar
+import json
+import re
+import sqlite3
+import threading
+import time
+import argparse
+import utils
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+
+# Maximum number of findings returned by a single SecurityHub GetFindings call
+SECURITYHUB_MAX_RESULTS = 100
+# Maximum number of findings listed or fetched by a single GuardDuty call
+GUARDDUTY_MAX_RESULTS = 50
+
+FINDING_COLUMNS = (
+    'id', 'service', 'account', 'region', 'severity_label', 'severity', 'product',
+    'resource_type', 'resource_id', 'title', 'record_state', 'workflow_status',
+    'created_at', 'updated_at', 'finding'
+)
+
+
+def to_epoch_millis(timestamp):
+    """
+    :param timestamp: ISO 8601 timestamp in UTC, as returned by SecurityHub and GuardDuty
+    :return: Milliseconds since the epoch
+    """
+
+    match = re.match(r'(\d{4}-\d{2}-\d{2})T(\d{2}:\d{2}:\d{2})(?:\.(\d+))?', timestamp)
+    if not match:
+        raise ValueError("Invalid timestamp {}".format(timestamp))
+    seconds = calendar.timegm(time.strptime('{}T{}'.format(match.group(1), match.group(2)), '%Y-%m-%dT%H:%M:%S'))
+    return seconds * 1000 + int((match.group(3) or '0')[:3].ljust(3, '0'))
+
+
+def to_timestamp(epoch_millis):
+    """
+    :return: ISO 8601 timestamp in UTC with milliseconds
+    """
+
+    return '{}.{:03d}Z'.format(time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(epoch_millis // 1000)), epoch_millis % 1000)
+
+
+def guardduty_severity_label(severity):
+    """
+    :return: Severity label of a GuardDuty severity, with the same ranges as the GuardDuty console
+    """
+
+    if severity >= 7:
+        return 'HIGH'
+    if severity >= 4:
+        return 'MEDIUM'
+    return 'LOW'
+
+
+def securityhub_severity_label(severity):
+    """
+    :return: Severity label of a SecurityHub finding, derived from the normalized severity for findings without a label
+    """
+
+    if severity.get('Label'):
+        return severity['Label']
+    normalized = severity.get('Normalized', 0)
+    for bound, label in ((90, 'CRITICAL'), (70, 'HIGH'), (40, 'MEDIUM'), (1, 'LOW')):
+        if normalized >= bound:
+            return label
+    return 'INFORMATIONAL'
+
+
+def securityhub_row(finding, aws_region):
+    resources = finding.get('Resources') or [{}]
+    return (
+        finding['Id'],
+        'securityhub',
+        finding.get('AwsAccountId'),
+        finding.get('Region', aws_region),
+        securityhub_severity_label(finding.get('Severity', {})),
+        finding.get('Severity', {}).get('Normalized'),
+        finding.get('ProductName') or finding.get('ProductArn'),
+        resources[0].get('Type'),
+        resources[0].get('Id'),
+        finding.get('Title'),
+        finding.get('RecordState'),
+        finding.get('Workflow', {}).get('Status'),
+        to_epoch_millis(finding['CreatedAt']),
+        to_epoch_millis(finding['UpdatedAt']),
+        json.dumps(finding, separators=(',', ':'), default=str)
+    )
+
+
+def guardduty_resource_id(resource):
+    for details, key in (('InstanceDetails', 'InstanceId'), ('AccessKeyDetails', 'AccessKeyId'), ('EksClusterDetails', 'Name')):
+        if resource.get(details, {}).get(key):
+            return resource[details][key]
+    for bucket in resource.get('S3BucketDetails', []):
+        return bucket.get('Arn') or bucket.get('Name')
+    return None
+
+
+def guardduty_row(finding, aws_region):
+    resource = finding.get('Resource', {})
+    return (
+        finding['Id'],
+        'guardduty',
+        finding.get('AccountId'),
+        finding.get('Region', aws_region),
+        guardduty_severity_label(finding.get('Severity', 0)),
+        finding.get('Severity'),
+        'GuardDuty',
+        resource.get('ResourceType'),
+        guardduty_resource_id(resource),
+        finding.get('Title'),
+        'ARCHIVED' if finding.get('Service', {}).get('Archived') else 'ACTIVE',
+        None,
+        to_epoch_millis(finding['CreatedAt']),
+        to_epoch_millis(finding['UpdatedAt']),
+        json.dumps(finding, separators=(',', ':'), default=str)
+    )
+
+
+class FindingsStore(object):
+    """
+    Findings keyed by Id and the watermark of every (service, region) in a local SQLite database
+    A page of findings and the watermark it moves to are written in the same transaction
+    """
+
+    def __init__(self, path):
+        """
+        :param path: Path of the SQLite database, created if it does not exist
+        """
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS findings ('
+                'id TEXT PRIMARY KEY, service TEXT NOT NULL, account TEXT, region TEXT, severity_label TEXT, severity REAL, '
+                'product TEXT, resource_type TEXT, resource_id TEXT, title TEXT, record_state TEXT, workflow_status TEXT, '
+                'created_at INTEGER, updated_at INTEGER NOT NULL, finding TEXT NOT NULL)'
+            )
+            for column in ('account', 'region', 'severity_label', 'product', 'resource_id', 'updated_at'):
+                self._connection.execute('CREATE INDEX IF NOT EXISTS findings_{0} ON findings ({0})'.format(column))
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS watermarks ('
+                'service TEXT NOT NULL, region TEXT NOT NULL, updated_at INTEGER NOT NULL, synced_at REAL NOT NULL, '
+                'PRIMARY KEY (service, region))'
+            )
+
+    def watermark(self, service, region):
+        """
+        :return: UpdatedAt in milliseconds of the latest finding stored for the service and region, None before the first sync
+        """
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT updated_at FROM watermarks WHERE service = ? AND region = ?', (service, region)
+            ).fetchone()
+        return row[0] if row else None
+
+    def upsert(self, service, region, rows):
+        """
+        Stores a page of findings and moves the watermark of the service and region to the latest UpdatedAt of the page
+        :param rows: list of tuples in the order of FINDING_COLUMNS
+        """
+        if not rows:
+            return
+
+        watermark = max(row[FINDING_COLUMNS.index('updated_at')] for row in rows)
+        with self._lock, self._connection:
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO findings ({}) VALUES ({})'.format(', '.join(FINDING_COLUMNS), ', '.join('?' * len(FINDING_COLUMNS))),
+                rows
+            )
+            self._connection.execute(
+                'INSERT INTO watermarks (service, region, updated_at, synced_at) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT (service, region) DO UPDATE SET updated_at = MAX(updated_at, excluded.updated_at), synced_at = excluded.synced_at',
+                (service, region, watermark, time.time())
+            )
+
+    def query(self, sql, parameters=()):
+        with self._lock:
+            return self._connection.execute(sql, parameters).fetchall()
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+def sync_securityhub(store, aws_region):
+    """
+    Fetches the SecurityHub findings updated since the watermark of the region, oldest first
+    :return: Number of findings stored
+    """
+
+    sh_client = utils.get_client(None, 'securityhub', aws_region)
+    watermark = store.watermark('securityhub', aws_region)
+
+    params = {
+        'SortCriteria': [{'Field': 'UpdatedAt', 'SortOrder': 'asc'}],
+        'MaxResults': SECURITYHUB_MAX_RESULTS
+    }
+    # The watermark is inclusive, findings updated in the same millisecond are upserted again
+    if watermark is not None:
+        params['Filters'] = {'UpdatedAt': [{'Start': to_timestamp(watermark), 'End': to_timestamp(int(time.time() * 1000))}]}
+
+    count = 0
+    for page in sh_client.get_paginator('get_findings').paginate(**params):
+        store.upsert('securityhub', aws_region, [securityhub_row(finding, aws_region) for finding in page['Findings']])
+        count += len(page['Findings'])
+
+    return count
+
+
+def sync_guardduty(store, aws_region):
+    """
+    Lists the GuardDuty findings updated since the watermark of the region, oldest first, and fetches them in batches of 50
+    :return: Number of findings stored
+    """
+
+    gd_client = utils.get_client(None, 'guardduty', aws_region)
+    detector_ids = gd_client.list_detectors()['DetectorIds']
+    if not detector_ids:
+        print('No detector found in {region}'.format(region=aws_region))
+        return 0
+
+    watermark = store.watermark('guardduty', aws_region)
+
+    params = {
+        'DetectorId': detector_ids[0],
+        'SortCriteria': {'AttributeName': 'updatedAt', 'OrderBy': 'ASC'},
+        'MaxResults': GUARDDUTY_MAX_RESULTS
+    }
+    if watermark is not None:
+        params['FindingCriteria'] = {'Criterion': {'updatedAt': {'GreaterThanOrEqual': watermark}}}
+
+    count = 0
+    for page in gd_client.get_paginator('list_findings').paginate(**params):
+        if not page['FindingIds']:
+            continue
+        findings = gd_client.get_findings(DetectorId=detector_ids[0], FindingIds=page['FindingIds'])['Findings']
+        store.upsert('guardduty', aws_region, [guardduty_row(finding, aws_region) for finding in findings])
+        count += len(findings)
+
+    return count
+
+
+def print_posture(store, days):
+    """
+    Prints the findings updated in the last days by service and severity label, from the local index only
+    """
+
+    start_time = time.time()
+    since = int((time.time() - days * 86400) * 1000)
+    rows = store.query(
+        'SELECT service, severity_label, COUNT(*) FROM findings '
+        "WHERE updated_at >= ? AND (record_state IS NULL OR record_state = 'ACTIVE') "
+        'GROUP BY service, severity_label ORDER BY service, severity_label',
+        (since,)
+    )
+    elapsed = time.time() - start_time
+
+    print("---------------------------------------------------------------")
+    print("Active Findings Updated in the Last {} Days".format(days))
+    print("---------------------------------------------------------------")
+    for service, severity_label, count in rows:
+        print("{} {}: {}".format(service, severity_label, count))
+    print("Queried the local index in {:.1f}ms".format(elapsed * 1000))
+    print("---------------------------------------------------------------")
+
+
+SYNC_FUNCTIONS = OrderedDict([('securityhub', sync_securityhub), ('guardduty', sync_guardduty)])
+
+if __name__ == '__main__':
+
+    # Setup command line arguments
+    parser = argparse.ArgumentParser(description='Incrementally sync the SecurityHub and GuardDuty findings of the administrator account into a local SQLite index')
+    parser.add_argument('--database', type=str, required=True, help="path of the SQLite database of the findings, created on the first sync")
+    parser.add_argument('--services', type=str, default='securityhub,guardduty', help="comma separated list of services to sync the findings of. Defaults to securityhub,guardduty")
+    parser.add_argument('--enabled_regions', type=str, help="comma separated list of regions to sync. If not specified, all available regions of each service")
+    parser.add_argument('--workers', type=int, default=10, help="number of (service, region) pairs synced concurrently. Defaults to 10")
+    parser.add_argument('--report_days', type=int, default=30, help="print the active findings updated in the last number of days after the sync, 0 to skip. Defaults to 30")
+    parser.add_argument('--event_log', type=str, help="path of a JSON lines file the structured events of the sync are appended to")
+    parser.add_argument('--metrics', type=str, help="path of a JSON file to write the per-operation API call metrics and latency histograms to, a summary is printed at the end of the run")
+    args = parser.parse_args()
+
+    services = [str(item) for item in args.services.split(',')]
+    for service in services:
+        if service not in SYNC_FUNCTIONS:
+            raise ValueError("Unknown service {}".format(service))
+
+    if args.workers < 1:
+        raise ValueError("--workers must be at least 1")
+
+    if args.event_log:
+        utils.open_event_log(args.event_log)
+
+    # Count the calls, retries, throttles and errors and time every API call of the run
+    utils.configure_api_metrics()
+
+    # Size the connection pools so that every worker can hold a connection
+    utils.configure_client_pool(max_pool_connections=max(10, args.workers))
+    # GetFindings has a low request limit, pace the calls per operation and region
+    utils.configure_rate_limiter()
+
+    session = boto3.session.Session()
+    units = []
+    for service in services:
+        if args.enabled_regions:
+            regions = [str(item) for item in args.enabled_regions.split(',')]
+        else:
+            regions = session.get_available_regions(service)
+        units.extend((service, aws_region) for aws_region in regions)
+
+    store = FindingsStore(args.database)
+    failed_units = OrderedDict()
+    start_time = time.time()
+
+    def sync(service, aws_region):
+        unit_start = time.time()
+        count = SYNC_FUNCTIONS[service](store, aws_region)
+        utils.log_event(service, None, aws_region, 'synced', 'completed', duration=time.time() - unit_start, findings=count)
+        print('Synced {} {} findings in {}'.format(count, service, aws_region))
+        return count
+
+    total_findings = 0
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = OrderedDict(((service, aws_region), executor.submit(sync, service, aws_region)) for service, aws_region in units)
+
+        for (service, aws_region), future in futures.items():
+            try:
+                total_findings += future.result()
+            except Exception as e:
+                # A region failing for any reason, e.g. an unreachable opt-in region, does not stop the others
+                utils.log_event(service, None, aws_region, 'synced', 'failed', error=e)
+                if isinstance(e, ClientError) and e.response['ResponseMetadata']['HTTPStatusCode'] == 403:
+                    print("Failed to sync {} findings in {} due to an authentication error. Either the service is not enabled or the region is an OptIn region that is not enabled. Skipping {}".format(service, aws_region, aws_region))
+                failed_units[(service, aws_region)] = repr(e)
+
+    print("Synced {} findings in {:.1f}s".format(total_findings, time.time() - start_time))
+
+    if args.report_days:
+        print_posture(store, args.report_days)
+
+    store.close()
+
+    utils.print_rate_limits()
+    utils.print_api_metrics(args.metrics)
+
+    if len(failed_units) > 0:
+        print("---------------------------------------------------------------")
+        print("Failed Regions, their watermark is kept and the next sync continues from it")
+        print("---------------------------------------------------------------")
+        for (service, aws_region), message in failed_units.items():
+            print("{} {}: \n\t{}".format(service, aws_region, message))
+            print("---------------------------------------------------------------")
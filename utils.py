@@ -1,6 +1,21 @@
+import asyncio
+import atexit
 import boto3
 import botocore
+import botocore.config
+import botocore.credentials
+import botocore.session
+import functools
 import json
+import os
+import queue
+import random
+import sqlite3
+import threading
+import time
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 CIS_STANDARD_RESOURCE = 'ruleset/cis-aws-foundations-benchmark/v/1.2.0'
 
@@ -13,8 +28,1720 @@ def get_standard_arn_for_region_and_resource(region, standard_resource):
     else:
         return 'arn:{partition}:securityhub:{region}::{resource}'.format(partition='aws', region=region, resource=standard_resource)
 
+# boto3 sessions are not thread safe, client creation is serialized so that
+# worker threads can share a session. The clients themselves are thread safe.
+_client_lock = threading.Lock()
+
+# AWS Account Number of the sessions assumed by the CredentialBroker, keyed by id(session)
+_session_accounts = dict()
+
+# Functions called with (client, account) for every new client, used to hook into the botocore events
+_client_hooks = []
+
+def register_client_hook(hook):
+    """
+    Registers hook(client, account) to be called for every client created by the client pool
+    Clients created before the hook was registered are not passed to it
+    """
+    with _client_lock:
+        _client_hooks.append(hook)
+
+class ClientPool(object):
+    """
+    LRU cache of clients keyed by the credentials of the session, the service and the region
+    Reusing clients keeps their connection pools and parsed service models for the whole run
+    """
+
+    def __init__(self, max_size=512, max_pool_connections=10, tcp_keepalive=True):
+        """
+        :param max_size: Maximum number of cached clients, the least recently used client is evicted first
+        :param max_pool_connections: Maximum number of connections kept open by each client
+        :param tcp_keepalive: Enable TCP keep-alive on the client connections
+        """
+        self.max_size = max_size
+        self.config = botocore.config.Config(
+            max_pool_connections=max_pool_connections,
+            tcp_keepalive=tcp_keepalive
+        )
+        self._clients = OrderedDict()
+
+    def get(self, session, service_name, region_name=None):
+        """
+        Returns the cached client or creates it, must be called with _client_lock held
+        """
+        if session is None:
+            session = boto3._get_default_session()
+
+        credentials = session.get_credentials()
+        key = (id(credentials), service_name, region_name)
+
+        if key in self._clients:
+            self._clients.move_to_end(key)
+            return self._clients[key][1]
+
+        client = session.client(service_name, region_name=region_name, config=self.config)
+        for hook in _client_hooks:
+            hook(client, _session_accounts.get(id(session)))
+        # Keep a reference to the credentials so that their id is not reused while cached
+        self._clients[key] = (credentials, client)
+        if len(self._clients) > self.max_size:
+            self._clients.popitem(last=False)
+
+        return client
+
+_client_pool = ClientPool()
+
+def configure_client_pool(max_size=512, max_pool_connections=10, tcp_keepalive=True):
+    """
+    Replaces the shared client pool, clients created before are not reused afterwards
+    :param max_size: Maximum number of cached clients
+    :param max_pool_connections: Maximum number of connections kept open by each client
+    :param tcp_keepalive: Enable TCP keep-alive on the client connections
+    """
+    global _client_pool
+    with _client_lock:
+        _client_pool = ClientPool(max_size, max_pool_connections, tcp_keepalive)
+
+def get_client(session, service_name, region_name=None):
+    """
+    Returns a client from the shared client pool, safe to call from multiple threads
+    :param session: boto3 Session, None for the default session
+    :param service_name: AWS service name, e.g. guardduty
+    :param region_name: AWS Region, not required for global services
+    :return: boto3 client
+    """
+    with _client_lock:
+        return _client_pool.get(session, service_name, region_name)
+
+# Error codes returned by AWS services when a request is throttled
+THROTTLING_ERROR_CODES = (
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'TooManyRequestsException',
+    'RequestLimitExceeded',
+    'RequestThrottled',
+    'RequestThrottledException',
+    'SlowDown'
+)
+
+class TokenBucket(object):
+    """
+    Token bucket whose rate adapts AIMD style: it grows by about increase requests per second
+    every second without throttling and is multiplied by decrease on every throttled request
+    """
+
+    def __init__(self, rate, min_rate, max_rate, increase, decrease):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.throttles = 0
+        self._tokens = 1.0
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def _fill(self):
+        now = time.time()
+        self._tokens = min(max(1.0, self.rate), self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self):
+        """
+        Blocks until a token is available and takes it
+        """
+        while True:
+            with self._lock:
+                self._fill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def succeeded(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase / self.rate)
+
+    def throttled(self):
+        with self._lock:
+            self._fill()
+            self.throttles += 1
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            self._tokens = min(self._tokens, 0.0)
+
+class RateLimiter(object):
+    """
+    Client side rate limiting with one adaptive TokenBucket per (service, operation, region, account)
+    Hooked into the botocore events of each client: a token is taken before every call and every
+    retry of a throttled request, throttled responses decrease the rate and successful calls increase it
+    """
+
+    def __init__(self, initial_rate=5, min_rate=0.2, max_rate=100, increase=1, decrease=0.5):
+        """
+        :param initial_rate: Requests per second allowed for an operation before any feedback
+        :param min_rate: Lowest rate a bucket can be throttled down to
+        :param max_rate: Highest rate a bucket can grow up to
+        :param increase: Requests per second added for every second without throttling
+        :param decrease: Factor applied to the rate on every throttled request
+        """
+        self.initial_rate = initial_rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self._buckets = dict()
+        self._lock = threading.Lock()
+
+    def register(self, client, account=None):
+        """
+        Applies the rate limiter to all the calls made by the client
+        :param client: boto3 client
+        :param account: AWS Account Number of the client credentials
+        """
+        key = (client.meta.service_model.service_name, client.meta.region_name, account)
+        client.meta.events.register('before-call', functools.partial(self._before_call, key))
+        client.meta.events.register('needs-retry', functools.partial(self._needs_retry, key))
+        client.meta.events.register('after-call', functools.partial(self._after_call, key))
+
+    def _bucket(self, key, operation_name):
+        service_name, region_name, account = key
+        bucket_key = (service_name, operation_name, region_name, account)
+        with self._lock:
+            if bucket_key not in self._buckets:
+                self._buckets[bucket_key] = TokenBucket(self.initial_rate, self.min_rate, self.max_rate, self.increase, self.decrease)
+            return self._buckets[bucket_key]
+
+    def _before_call(self, key, model, **kwargs):
+        self._bucket(key, model.name).acquire()
+
+    def _needs_retry(self, key, operation, response=None, **kwargs):
+        if response is None:
+            return None
+
+        if response[1].get('Error', {}).get('Code') in THROTTLING_ERROR_CODES:
+            bucket = self._bucket(key, operation.name)
+            bucket.throttled()
+            # The retry waits for a token as well
+            bucket.acquire()
+
+        return None
+
+    def _after_call(self, key, model, parsed, **kwargs):
+        if 'Error' not in parsed:
+            self._bucket(key, model.name).succeeded()
+
+    def rates(self):
+        """
+        :return: dict of (service, operation, region, account): {'rate': requests per second, 'throttles': count}
+        """
+        with self._lock:
+            return dict((bucket_key, {'rate': bucket.rate, 'throttles': bucket.throttles}) for bucket_key, bucket in self._buckets.items())
+
+_rate_limiter = None
+
+def configure_rate_limiter(**kwargs):
+    """
+    Enables client side rate limiting for every client created afterwards by the client pool
+    :param kwargs: RateLimiter parameters
+    :return: RateLimiter
+    """
+    global _rate_limiter
+    if _rate_limiter is None:
+        _rate_limiter = RateLimiter(**kwargs)
+        register_client_hook(_rate_limiter.register)
+    return _rate_limiter
+
+def print_rate_limits():
+    """
+    Prints the current rate of the operations that were throttled during the run
+    """
+    if _rate_limiter is None:
+        return
+
+    throttled = sorted(
+        ((key, value) for key, value in _rate_limiter.rates().items() if value['throttles']),
+        key=lambda item: [str(part) for part in item[0]]
+    )
+    if throttled:
+        print("---------------------------------------------------------------")
+        print("Throttled Operations")
+        print("---------------------------------------------------------------")
+        for (service_name, operation_name, region_name, account), value in throttled:
+            print("{} {} in {} for {}: {} throttles, {:.2f} requests/s".format(
+                service_name, operation_name, region_name, account or 'default', value['throttles'], value['rate']
+            ))
+        print("---------------------------------------------------------------")
+
+# Upper bounds in milliseconds of the latency histogram buckets, the last bucket is unbounded
+LATENCY_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+class OperationMetrics(object):
+    """
+    Counters and latency histogram of an operation in a region
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.retries = 0
+        self.throttles = 0
+        self.errors = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def observe(self, latency):
+        """
+        :param latency: Milliseconds the call took, retries included
+        """
+        self.calls += 1
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if latency <= bound:
+                self.histogram[index] += 1
+                return
+        self.histogram[-1] += 1
+
+    def percentile(self, fraction):
+        """
+        :return: Upper bound in milliseconds of the bucket holding the given fraction of the calls
+        """
+        threshold = fraction * self.calls
+        count = 0
+        for index, bucket_count in enumerate(self.histogram):
+            count += bucket_count
+            if count >= threshold and bucket_count:
+                return LATENCY_BUCKETS[index] if index < len(LATENCY_BUCKETS) else self.max_latency
+        return 0.0
+
+    def as_dict(self):
+        return {
+            'calls': self.calls,
+            'retries': self.retries,
+            'throttles': self.throttles,
+            'errors': self.errors,
+            'mean_ms': self.total_latency / self.calls if self.calls else 0.0,
+            'p50_ms': self.percentile(0.5),
+            'p90_ms': self.percentile(0.9),
+            'p99_ms': self.percentile(0.99),
+            'max_ms': self.max_latency,
+            'histogram': dict(
+                ('le_{}'.format(bound) if index < len(LATENCY_BUCKETS) else 'gt_{}'.format(LATENCY_BUCKETS[-1]), count)
+                for index, (bound, count) in enumerate(zip(LATENCY_BUCKETS + (None,), self.histogram))
+            )
+        }
+
+class ApiMetrics(object):
+    """
+    Counts the calls, retries, throttles and errors and records the latency of every API call per
+    (service, operation, region), hooked into the botocore events of each client like the RateLimiter
+    """
+
+    def __init__(self):
+        self._operations = dict()
+        self._lock = threading.Lock()
+
+    def register(self, client, account=None):
+        """
+        Records the metrics of all the calls made by the client
+        :param client: boto3 client
+        :param account: AWS Account Number of the client credentials, not part of the metrics key
+        """
+        key = (client.meta.service_model.service_name, client.meta.region_name)
+        client.meta.events.register('before-call', self._before_call)
+        client.meta.events.register('needs-retry', functools.partial(self._needs_retry, key))
+        client.meta.events.register('after-call', functools.partial(self._after_call, key))
+        client.meta.events.register('after-call-error', functools.partial(self._after_call_error, key))
+
+    def _metrics(self, key, operation_name):
+        service_name, region_name = key
+        with self._lock:
+            operation_key = (service_name, operation_name, region_name)
+            if operation_key not in self._operations:
+                self._operations[operation_key] = OperationMetrics()
+            return self._operations[operation_key]
+
+    def _before_call(self, model, context, **kwargs):
+        # The context is shared by all the events of a single call, retries included
+        context['metrics_start'] = time.time()
+        context['metrics_operation'] = model.name
+
+    def _needs_retry(self, key, operation, response=None, **kwargs):
+        if response is not None and response[1].get('Error', {}).get('Code') in THROTTLING_ERROR_CODES:
+            metrics = self._metrics(key, operation.name)
+            with self._lock:
+                metrics.throttles += 1
+        return None
+
+    def _observe(self, key, operation_name, context, retries, error):
+        latency = (time.time() - context.get('metrics_start', time.time())) * 1000
+        metrics = self._metrics(key, operation_name)
+        with self._lock:
+            metrics.observe(latency)
+            metrics.retries += retries
+            if error:
+                metrics.errors += 1
+
+    def _after_call(self, key, model, parsed, context, **kwargs):
+        retries = parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+        self._observe(key, model.name, context, retries, 'Error' in parsed)
+
+    def _after_call_error(self, key, context, **kwargs):
+        # Raised before a response was parsed, e.g. a connection error once the retries are exhausted
+        if 'metrics_operation' in context:
+            self._observe(key, context['metrics_operation'], context, 0, True)
+
+    def summary(self):
+        """
+        :return: list of dict with the metrics of every (service, operation, region), the most called first
+        """
+        with self._lock:
+            operations = [
+                dict(service=service_name, operation=operation_name, region=region_name, **metrics.as_dict())
+                for (service_name, operation_name, region_name), metrics in self._operations.items()
+            ]
+        return sorted(operations, key=lambda item: (-item['calls'], item['service'], item['operation'], str(item['region'])))
+
+_api_metrics = None
+
+def configure_api_metrics():
+    """
+    Records API metrics for every client created afterwards by the client pool
+    :return: ApiMetrics
+    """
+    global _api_metrics
+    if _api_metrics is None:
+        _api_metrics = ApiMetrics()
+        register_client_hook(_api_metrics.register)
+    return _api_metrics
+
+def print_api_metrics(path=None):
+    """
+    Prints the calls per operation with their share of the run and their latency, most called first
+    :param path: path of a JSON file the full metrics, histograms included, are written to
+    """
+    if _api_metrics is None:
+        return
+
+    summary = _api_metrics.summary()
+    if path:
+        with open(path, 'w') as output_file:
+            json.dump(summary, output_file, indent=2)
+
+    operations = OrderedDict()
+    for item in summary:
+        totals = operations.setdefault((item['service'], item['operation']), {'calls': 0, 'retries': 0, 'throttles': 0, 'errors': 0, 'p90_ms': 0.0})
+        for field in ('calls', 'retries', 'throttles', 'errors'):
+            totals[field] += item[field]
+        totals['p90_ms'] = max(totals['p90_ms'], item['p90_ms'])
+
+    total_calls = sum(totals['calls'] for totals in operations.values())
+    if not total_calls:
+        return
+
+    print("---------------------------------------------------------------")
+    print("API Calls")
+    print("---------------------------------------------------------------")
+    for (service_name, operation_name), totals in sorted(operations.items(), key=lambda item: -item[1]['calls']):
+        print("{} {}: {} calls ({:.1f}%), {} retries, {} throttles, {} errors, p90 {:.0f}ms".format(
+            service_name, operation_name, totals['calls'], 100.0 * totals['calls'] / total_calls,
+            totals['retries'], totals['throttles'], totals['errors'], totals['p90_ms']
+        ))
+    print("{} calls in total".format(total_calls))
+    if path:
+        print("API metrics written to {}".format(path))
+    print("---------------------------------------------------------------")
+
+class _AssumedRoleProvider(botocore.credentials.CredentialProvider):
+    """
+    Hands the refreshable credentials of an assumed role to the botocore session
+    """
+
+    METHOD = 'sts-assume-role'
+
+    def __init__(self, credentials):
+        self._credentials = credentials
+
+    def load(self):
+        return self._credentials
+
+class CredentialBroker(object):
+    """
+    Assumes roles in the target accounts and caches the resulting sessions for the whole run
+    Sessions are backed by refreshable credentials, botocore assumes the role again shortly
+    before the credentials expire so long runs keep working past the first hour
+    """
+
+    def __init__(self, role_session_name, botocore_session=None, regional_sts=True):
+        """
+        :param role_session_name: RoleSessionName used for every AssumeRole call
+        :param botocore_session: botocore Session holding the caller credentials, defaults to a new Session
+        :param regional_sts: Use the regional STS endpoint of the client region instead of the global endpoint
+        """
+        self.role_session_name = role_session_name
+        self._botocore_session = botocore_session or botocore.session.Session()
+        if regional_sts:
+            self._botocore_session.set_config_variable('sts_regional_endpoints', 'regional')
+        self._base_session = boto3.Session(botocore_session=self._botocore_session)
+        self._partition = None
+        self._sessions = dict()
+        self._failures = dict()
+        self._lock = threading.Lock()
+        self._account_locks = dict()
+
+    def get_partition(self):
+        """
+        Returns the partition of the caller, looked up once per run
+        :return: partition, e.g. aws or aws-cn
+        """
+        with self._lock:
+            if self._partition is None:
+                sts_client = get_client(self._base_session, 'sts')
+                self._partition = sts_client.get_caller_identity()['Arn'].split(":")[1]
+            return self._partition
+
+    def _assume_role(self, aws_account_number, role_name, region_name):
+        sts_client = get_client(self._base_session, 'sts', region_name)
+
+        response = sts_client.assume_role(
+            RoleArn='arn:{}:iam::{}:role/{}'.format(
+                self.get_partition(),
+                aws_account_number,
+                role_name
+            ),
+            RoleSessionName=self.role_session_name
+        )
+
+        return {
+            'access_key': response['Credentials']['AccessKeyId'],
+            'secret_key': response['Credentials']['SecretAccessKey'],
+            'token': response['Credentials']['SessionToken'],
+            'expiry_time': response['Credentials']['Expiration'].isoformat()
+        }
+
+    def get_session(self, aws_account_number, role_name, region_name=None):
+        """
+        Returns the cached session for the account and role, assuming the role on first use
+        :param aws_account_number: AWS Account Number
+        :param role_name: Role to assume in target account
+        :param region_name: AWS Region of the STS endpoint, defaults to the region of the base session
+        :return: boto3 Session in the specified AWS Account
+        """
+        key = (aws_account_number, role_name)
+        with self._lock:
+            account_lock = self._account_locks.setdefault(key, threading.Lock())
+
+        with account_lock:
+            # A role that could not be assumed fails the same way for every region of the account
+            if key in self._failures:
+                raise self._failures[key]
+
+            if key not in self._sessions:
+                region_name = region_name or self._base_session.region_name
+                try:
+                    metadata = self._assume_role(aws_account_number, role_name, region_name)
+                except botocore.exceptions.ClientError as e:
+                    self._failures[key] = e
+                    raise
+                credentials = botocore.credentials.RefreshableCredentials.create_from_metadata(
+                    metadata=metadata,
+                    refresh_using=functools.partial(self._assume_role, aws_account_number, role_name, region_name),
+                    method='sts-assume-role'
+                )
+
+                # Share the data loader so service models are only parsed once per run
+                botocore_session = botocore.session.Session()
+                botocore_session.register_component('data_loader', self._botocore_session.get_component('data_loader'))
+                botocore_session.register_component('credential_provider', botocore.credentials.CredentialResolver([_AssumedRoleProvider(credentials)]))
+                self._sessions[key] = boto3.Session(botocore_session=botocore_session)
+                _session_accounts[id(self._sessions[key])] = aws_account_number
+
+                print("Assumed session for {}.".format(
+                    aws_account_number
+                ))
+
+            return self._sessions[key]
+
+    def prewarm(self, aws_account_numbers, role_name, workers=10, region_name=None):
+        """
+        Assumes the role in all the accounts concurrently
+        :param aws_account_numbers: list of AWS Account Numbers
+        :param role_name: Role to assume in target accounts
+        :param workers: Number of concurrent AssumeRole calls
+        :param region_name: AWS Region of the STS endpoint, defaults to the region of the base session
+        :return: dict of AwsAccountId:error for the accounts that could not be assumed
+        """
+        failed = dict()
+        self.get_partition()
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = dict((executor.submit(self.get_session, account, role_name, region_name), account) for account in aws_account_numbers)
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except botocore.exceptions.ClientError as e:
+                    failed[futures[future]] = e
+
+        return failed
+
+_credential_brokers = dict()
+
+def get_credential_broker(role_session_name):
+    """
+    Returns the credential broker shared by the whole run for a RoleSessionName
+    """
+    with _client_lock:
+        if role_session_name not in _credential_brokers:
+            _credential_brokers[role_session_name] = CredentialBroker(role_session_name)
+        return _credential_brokers[role_session_name]
+
+def assume_role(aws_account_number, role_name, role_session_name):
+    """
+    Assumes the provided role in the account, reusing the session if it was assumed before
+    :param aws_account_number: AWS Account Number
+    :param role_name: Role to assume in target account
+    :param role_session_name: RoleSessionName for the AssumeRole call
+    :return: boto3 Session in the specified AWS Account
+    """
+    return get_credential_broker(role_session_name).get_session(aws_account_number, role_name)
+
+class RegionResolver(object):
+    """
+    Resolves the regions enabled in each account, so that opt-in regions the account did not
+    enable are pruned before any work is scheduled instead of failing with a 403 per service call
+    Results are cached on disk for ttl seconds, keyed by account
+    """
+
+    def __init__(self, cache_path=None, ttl=86400):
+        """
+        :param cache_path: Path of the JSON cache file, nothing is cached on disk if None
+        :param ttl: Number of seconds a cached result stays valid
+        """
+        self.cache_path = cache_path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._cache = dict()
+        if cache_path and os.path.exists(cache_path):
+            try:
+                with open(cache_path) as cache_file:
+                    self._cache = json.load(cache_file)
+            except ValueError:
+                print("Ignoring unreadable region cache {}".format(cache_path))
+
+    def _save(self):
+        if not self.cache_path:
+            return
+        temp_path = '{}.tmp'.format(self.cache_path)
+        with open(temp_path, 'w') as cache_file:
+            json.dump(self._cache, cache_file)
+        os.replace(temp_path, self.cache_path)
+
+    def _list_enabled_regions(self, session):
+        region_name = session.region_name or 'us-east-1'
+        try:
+            account_client = get_client(session, 'account', region_name)
+            regions = []
+            for page in account_client.get_paginator('list_regions').paginate(RegionOptStatusContains=['ENABLED', 'ENABLED_BY_DEFAULT']):
+                regions.extend(region['RegionName'] for region in page['Regions'])
+            return regions
+        except botocore.exceptions.ClientError:
+            # The Account API needs account:ListRegions, EC2 only returns the enabled regions as well
+            ec2_client = get_client(session, 'ec2', region_name)
+            return [region['RegionName'] for region in ec2_client.describe_regions()['Regions']]
+
+    def get_enabled_regions(self, session, account):
+        """
+        Returns the regions enabled in the account, from the cache if it has not expired
+        :param session: Session in the account, only used on a cache miss
+        :param account: AWS Account Number
+        :return: list of AWS Regions
+        """
+        with self._lock:
+            cached = self._cache.get(account)
+            if cached and cached['expires'] > time.time():
+                return cached['regions']
+
+        regions = self._list_enabled_regions(session)
+        with self._lock:
+            self._cache[account] = {'regions': regions, 'expires': time.time() + self.ttl}
+
+        return regions
+
+    def resolve(self, accounts, get_session, workers=10):
+        """
+        Resolves the enabled regions of all the accounts concurrently and saves the cache
+        Accounts that cannot be resolved are left out and treated as having every region enabled
+        :param accounts: list of AWS Account Numbers
+        :param get_session: function returning the session of an account
+        :param workers: Number of accounts resolved at the same time
+        """
+        def resolve_account(account):
+            with self._lock:
+                cached = self._cache.get(account)
+                if cached and cached['expires'] > time.time():
+                    return
+            self.get_enabled_regions(get_session(account), account)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = dict((executor.submit(resolve_account, account), account) for account in accounts)
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except botocore.exceptions.ClientError as e:
+                    print("Unable to list the enabled regions of account {}, assuming all of them: {}".format(futures[future], repr(e)))
+
+        with self._lock:
+            self._save()
+
+    def is_enabled(self, account, region):
+        """
+        :return: False only if the region is known to be disabled in the account
+        """
+        with self._lock:
+            cached = self._cache.get(account)
+            return cached is None or region in cached['regions']
+
+_region_resolver = None
+
+def configure_region_resolver(cache_path=None, ttl=86400):
+    """
+    Sets the region resolver used by region_enabled
+    :return: RegionResolver
+    """
+    global _region_resolver
+    _region_resolver = RegionResolver(cache_path, ttl)
+    return _region_resolver
+
+def region_enabled(account, region):
+    """
+    :return: False if the region resolver knows the region is not enabled in the account
+    """
+    return _region_resolver is None or _region_resolver.is_enabled(account, region)
+
+# Maximum number of accounts accepted by a single GuardDuty/SecurityHub member API call
+MEMBER_API_CHUNK_SIZE = 50
+
+def chunks(items, size):
+    """
+    Splits a list, or any iterable as its items arrive, into consecutive chunks of at most size items
+    """
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+def call_in_chunks(operation, account_ids, request, chunk_size=MEMBER_API_CHUNK_SIZE, attempts=3, delay=2, workers=1):
+    """
+    Calls a member API for chunks of accounts and retries the accounts returned as UnprocessedAccounts
+    :param operation: client method, e.g. gd_client.invite_members
+    :param account_ids: list of AWS Account Numbers
+    :param request: function returning the keyword arguments of the call for a chunk of account ids
+    :param chunk_size: Maximum number of accounts in a single call
+    :param attempts: Number of times unprocessed accounts are sent
+    :param delay: Seconds to wait before the first retry, doubled for every further retry
+    :param workers: Number of chunks sent at the same time
+    :return: dict of AwsAccountId:Result for the accounts still unprocessed after all attempts
+    """
+    pending = list(account_ids)
+    unprocessed = dict()
+
+    def call(chunk):
+        response = operation(**request(chunk))
+        return [
+            (account['AccountId'], account.get('Result', account.get('ProcessingResult')))
+            for account in response.get('UnprocessedAccounts', [])
+        ]
+
+    for attempt in range(attempts):
+        unprocessed = dict()
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(call, chunks(pending, chunk_size)))
+        else:
+            results = [call(chunk) for chunk in chunks(pending, chunk_size)]
+
+        for result in results:
+            unprocessed.update(result)
+
+        pending = list(unprocessed.keys())
+        if not pending or attempt == attempts - 1:
+            break
+
+        print("Retrying {} unprocessed accounts for {}".format(len(pending), operation.__name__))
+        time.sleep(delay * 2 ** attempt)
+
+    return unprocessed
+
+class AccountEnumerator(object):
+    """
+    Streams the accounts of the organization, enumerated once per run
+    The first consumer pages through ListAccounts, or walks the OU tree with ListAccountsForParent,
+    and every consumer gets the accounts as the pages arrive. Later consumers replay the accounts
+    already listed and wait for the pages still to come instead of listing the organization again
+    """
+
+    def __init__(self, parent_id=None):
+        """
+        :param parent_id: Root or organizational unit to enumerate recursively, the whole organization if None
+        """
+        self.parent_id = parent_id
+        self._accounts = []
+        self._pages = None
+        self._fetching = False
+        self._done = False
+        self._error = None
+        self._condition = threading.Condition()
+
+    def _list_pages(self):
+        org_client = get_client(None, 'organizations')
+        if self.parent_id is None:
+            for page in org_client.get_paginator('list_accounts').paginate():
+                yield page['Accounts']
+            return
+
+        parents = [self.parent_id]
+        while parents:
+            parent_id = parents.pop(0)
+            for page in org_client.get_paginator('list_accounts_for_parent').paginate(ParentId=parent_id):
+                yield page['Accounts']
+            for page in org_client.get_paginator('list_organizational_units_for_parent').paginate(ParentId=parent_id):
+                parents.extend(organizational_unit['Id'] for organizational_unit in page['OrganizationalUnits'])
+
+    def __iter__(self):
+        index = 0
+        while True:
+            with self._condition:
+                while index >= len(self._accounts) and not self._done and self._fetching:
+                    self._condition.wait()
+
+                if index < len(self._accounts):
+                    accounts = self._accounts[index:]
+                elif self._error is not None:
+                    # The listing failed, every consumer fails instead of seeing a truncated organization
+                    raise self._error
+                elif self._done:
+                    return
+                else:
+                    # This consumer fetches the next page, the others wait for it
+                    self._fetching = True
+                    if self._pages is None:
+                        self._pages = self._list_pages()
+                    accounts = None
+
+            if accounts is None:
+                try:
+                    page = next(self._pages, None)
+                except Exception as e:
+                    with self._condition:
+                        self._error = e
+                        self._fetching = False
+                        self._condition.notify_all()
+                    raise
+
+                with self._condition:
+                    if page is None:
+                        self._done = True
+                    else:
+                        self._accounts.extend(page)
+                    self._fetching = False
+                    self._condition.notify_all()
+                continue
+
+            for account in accounts:
+                yield account
+            index += len(accounts)
+
+_account_enumerators = dict()
+
+def get_account_enumerator(parent_id=None):
+    """
+    Returns the account enumerator shared by the whole run for an organization root or OU
+    """
+    with _client_lock:
+        if parent_id not in _account_enumerators:
+            _account_enumerators[parent_id] = AccountEnumerator(parent_id)
+        return _account_enumerators[parent_id]
+
+class MemberIndex(object):
+    """
+    Member status of a GuardDuty or SecurityHub administrator account in one region
+    The index is loaded once with list_members, kept up to date from the responses of the
+    mutating member calls and refreshed for specific accounts with batched get_members calls
+    """
+
+    STATUS_KEYS = {
+        'guardduty': 'RelationshipStatus',
+        'securityhub': 'MemberStatus'
+    }
+
+    def __init__(self, client, detector_id=None):
+        """
+        :param client: GuardDuty or SecurityHub client of the administrator account
+        :param detector_id: DetectorId of the administrator account, GuardDuty only
+        """
+        self.client = client
+        self.detector_id = detector_id
+        self.status_key = self.STATUS_KEYS[client.meta.service_model.service_name]
+        self._members = dict()
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def _params(self, **params):
+        if self.detector_id:
+            params['DetectorId'] = self.detector_id
+        return params
+
+    def load(self):
+        """
+        Lists all the members once, later calls are no-ops
+        """
+        with self._lock:
+            if self._loaded:
+                return
+
+            # GuardDuty expects a string for OnlyAssociated, SecurityHub a boolean
+            only_associated = 'false' if self.detector_id else False
+            results = self.client.list_members(**self._params(OnlyAssociated=only_associated))
+            while True:
+                for member in results['Members']:
+                    self._members[member['AccountId']] = member[self.status_key]
+
+                if not results.get('NextToken'):
+                    break
+
+                results = self.client.list_members(**self._params(OnlyAssociated=only_associated, NextToken=results['NextToken']))
+
+            self._loaded = True
+
+    def refresh(self, account_ids):
+        """
+        Refreshes the status of the given accounts with get_members, in chunks of up to 50 accounts
+        Accounts that are not members anymore are removed from the index
+        :param account_ids: list of AWS Account Numbers
+        """
+        for chunk in chunks(account_ids, MEMBER_API_CHUNK_SIZE):
+            response = self.client.get_members(**self._params(AccountIds=chunk))
+            found = dict((member['AccountId'], member[self.status_key]) for member in response['Members'])
+
+            with self._lock:
+                for account in chunk:
+                    if account in found:
+                        self._members[account] = found[account]
+                    else:
+                        self._members.pop(account, None)
+
+    def update(self, account_ids, status, response=None):
+        """
+        Records the status of accounts processed by a mutating call
+        :param account_ids: list of AWS Account Numbers sent in the call
+        :param status: Status of the processed accounts, None if they are not members anymore
+        :param response: Response of the call, its UnprocessedAccounts are left unchanged
+        """
+        unprocessed = set()
+        if response:
+            unprocessed = set(account['AccountId'] for account in response.get('UnprocessedAccounts', []))
+
+        with self._lock:
+            for account in account_ids:
+                if account in unprocessed:
+                    continue
+                if status is None:
+                    self._members.pop(account, None)
+                else:
+                    self._members[account] = status
+
+    def get(self, account, default=None):
+        with self._lock:
+            return self._members.get(account, default)
+
+    def as_dict(self):
+        """
+        :return: dict of AwsAccountId:Status
+        """
+        with self._lock:
+            return dict(self._members)
+
+    def __contains__(self, account):
+        with self._lock:
+            return account in self._members
+
+_member_indexes = dict()
+
+def get_member_index(client, detector_id=None):
+    """
+    Returns the member index of the administrator account for the region of the client, loaded once per run
+    :param client: GuardDuty or SecurityHub client of the administrator account
+    :param detector_id: DetectorId of the administrator account, GuardDuty only
+    :return: MemberIndex
+    """
+    key = (client.meta.service_model.service_name, client.meta.region_name, detector_id)
+    with _client_lock:
+        if key not in _member_indexes:
+            _member_indexes[key] = MemberIndex(client, detector_id)
+        member_index = _member_indexes[key]
+
+    member_index.load()
+    return member_index
+
+class MembershipPoller(object):
+    """
+    Waits for member status transitions of a MemberIndex with a single background poller
+    Every tick refreshes all the accounts that are waited on with batched get_members calls and wakes
+    the waiters whose condition is met. The interval doubles, with jitter, while nothing changes and
+    drops back to the minimum whenever a status changes or a new waiter arrives
+    """
+
+    def __init__(self, member_index, min_interval=1, max_interval=30):
+        """
+        :param member_index: MemberIndex of the administrator account in one region
+        :param min_interval: Seconds between polls right after a change
+        :param max_interval: Upper bound of the seconds between polls
+        """
+        self.member_index = member_index
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self._interval = min_interval
+        self._next_poll = 0
+        self._waiters = []
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def watch(self, account, predicate, callback, errback=None):
+        """
+        Calls callback(status) once predicate(status) is true for the account, from the poller thread
+        If the condition already holds the callback is called right away
+        :param errback: Called with the exception instead if the poll fails, the waiter keeps waiting if None
+        :return: handle for unwatch, None if the callback was already called
+        """
+        status = self.member_index.get(account)
+        if predicate(status):
+            callback(status)
+            return None
+
+        waiter = (account, predicate, callback, errback)
+        with self._condition:
+            self._waiters.append(waiter)
+            self._interval = self.min_interval
+            # Waiters arriving together are polled together on the next tick
+            self._next_poll = min(self._next_poll or float('inf'), time.time() + self.min_interval)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='MembershipPoller')
+                self._thread.daemon = True
+                self._thread.start()
+            self._condition.notify()
+
+        return waiter
+
+    def unwatch(self, waiter):
+        """
+        Removes a waiter registered with watch, e.g. after a timeout
+        """
+        with self._condition:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+
+    def wait_for_all(self, account_ids, predicate, timeout=300):
+        """
+        Blocks until predicate(status) is true for all the accounts or the timeout expires
+        :return: list of the accounts whose condition was not met
+        """
+        pending = set(account_ids)
+        failed = []
+        done = threading.Condition()
+
+        def callback(account):
+            def notify(status):
+                with done:
+                    pending.discard(account)
+                    done.notify()
+            return notify
+
+        def errback(account):
+            def notify(error):
+                with done:
+                    if account in pending:
+                        pending.discard(account)
+                        failed.append(account)
+                    done.notify()
+            return notify
+
+        waiters = [self.watch(account, predicate, callback(account), errback(account)) for account in list(pending)]
+
+        deadline = time.time() + timeout
+        with done:
+            while pending and time.time() < deadline:
+                done.wait(deadline - time.time())
+            not_met = list(pending) + failed
+
+        for waiter in waiters:
+            if waiter is not None:
+                self.unwatch(waiter)
+
+        return not_met
+
+    def wait_for(self, account, predicate, timeout=300):
+        """
+        Blocks until predicate(status) is true for the account or the timeout expires
+        :return: True if the condition was met
+        """
+        return not self.wait_for_all([account], predicate, timeout)
+
+    async def wait_for_async(self, account, predicate, timeout=300):
+        """
+        Coroutine version of wait_for, the event loop keeps running while waiting
+        :return: True if the condition was met
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def resolve(met):
+            if not future.done():
+                future.set_result(met)
+
+        waiter = self.watch(
+            account, predicate,
+            lambda status: loop.call_soon_threadsafe(resolve, True),
+            lambda error: loop.call_soon_threadsafe(resolve, False)
+        )
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            self.unwatch(waiter)
+            return False
+
+    def _run(self):
+        try:
+            while True:
+                with self._condition:
+                    while self._waiters and time.time() < self._next_poll:
+                        self._condition.wait(self._next_poll - time.time())
+
+                    if not self._waiters:
+                        self._thread = None
+                        return
+
+                    waiters = list(self._waiters)
+
+                try:
+                    self._tick(waiters)
+                except Exception as e:
+                    # The waiters of a failed tick get the error instead of waiting for their timeout
+                    print("Error polling member status: {}".format(repr(e)))
+                    with self._condition:
+                        failed = [waiter for waiter in waiters if waiter[3] is not None and waiter in self._waiters]
+                        for waiter in failed:
+                            self._waiters.remove(waiter)
+                        self._next_poll = time.time() + self._interval
+                    for waiter in failed:
+                        waiter[3](e)
+        finally:
+            # After a failure the next watch starts a new poller thread
+            with self._condition:
+                if self._thread is threading.current_thread():
+                    self._thread = None
+
+    def _tick(self, waiters):
+        account_ids = list(OrderedDict((waiter[0], None) for waiter in waiters).keys())
+        before = dict((account, self.member_index.get(account)) for account in account_ids)
+        try:
+            self.member_index.refresh(account_ids)
+        except botocore.exceptions.ClientError as e:
+            print("Error refreshing member status: {}".format(repr(e)))
+
+        changed = any(self.member_index.get(account) != before[account] for account in account_ids)
+
+        satisfied = []
+        for waiter in waiters:
+            status = self.member_index.get(waiter[0])
+            if waiter[1](status):
+                satisfied.append((waiter, status))
+
+        with self._condition:
+            for waiter, status in satisfied:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+            self._interval = self.min_interval if changed else min(self._interval * 2, self.max_interval)
+            self._next_poll = time.time() + self._interval * random.uniform(0.5, 1.0)
+
+        for waiter, status in satisfied:
+            waiter[2](status)
+
+_membership_pollers = dict()
+
+def get_membership_poller(member_index):
+    """
+    Returns the poller shared by everything waiting on the members of a MemberIndex
+    """
+    with _client_lock:
+        if id(member_index) not in _membership_pollers:
+            _membership_pollers[id(member_index)] = MembershipPoller(member_index)
+        return _membership_pollers[id(member_index)]
+
+class StandardsVerifier(object):
+    """
+    Waits for SecurityHub standards subscriptions to reach READY with a single background poller
+    All the outstanding (account, region) units are tracked together, each one is polled with its own
+    exponential backoff and the units that are due are polled concurrently. The time every standard
+    took to become READY is kept for the report
+    """
+
+    def __init__(self, min_interval=1, max_interval=30, workers=10):
+        """
+        :param min_interval: Seconds before the first poll of a unit
+        :param max_interval: Upper bound of the seconds between polls of a unit
+        :param workers: Number of units polled at the same time
+        """
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.workers = workers
+        self._units = []
+        self._ready_times = []
+        self._timeouts = []
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def watch(self, sh_client, account, region, standards_arns, callback, timeout=100):
+        """
+        Calls callback(not_ready) from the poller thread once all the standards are READY, one of them
+        failed or the timeout expired. not_ready is a dict of StandardsArn:StandardsStatus, empty on success
+        :param sh_client: SecurityHub client of the account in the region
+        :param standards_arns: list of regional standards ARNs subscribed to
+        :return: handle of the watched unit, None if there was nothing to wait for
+        """
+        if not standards_arns:
+            callback(dict())
+            return None
+
+        now = time.time()
+        unit = {
+            'client': sh_client,
+            'account': account,
+            'region': region,
+            'started': now,
+            'deadline': now + timeout,
+            'interval': self.min_interval,
+            'next_poll': now + self.min_interval,
+            'pending': dict((standard_arn, None) for standard_arn in standards_arns),
+            'callback': callback
+        }
+
+        with self._condition:
+            self._units.append(unit)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='StandardsVerifier')
+                self._thread.daemon = True
+                self._thread.start()
+            self._condition.notify()
+
+        return unit
+
+    def wait_for_all(self, units, timeout=100):
+        """
+        Blocks until every unit is resolved
+        :param units: list of (sh_client, account, region, standards_arns)
+        :return: dict of (account, region): not_ready for the units whose standards did not all reach READY
+        """
+        results = dict()
+        pending = set((account, region) for _, account, region, _ in units)
+        done = threading.Condition()
+
+        def callback(key):
+            def notify(not_ready):
+                with done:
+                    if key in pending:
+                        pending.discard(key)
+                        if not_ready:
+                            results[key] = not_ready
+                    done.notify()
+            return notify
+
+        watched = dict()
+        for sh_client, account, region, standards_arns in units:
+            watched[(account, region)] = self.watch(sh_client, account, region, standards_arns, callback((account, region)), timeout)
+
+        # Units resolve by their deadline, the margin covers a poll still in flight at that time
+        deadline = time.time() + timeout + self.max_interval
+        with done:
+            while pending and time.time() < deadline:
+                done.wait(deadline - time.time())
+            for key in pending:
+                results[key] = dict(watched[key]['pending'])
+            pending.clear()
+
+        return results
+
+    def wait_for(self, sh_client, account, region, standards_arns, timeout=100):
+        """
+        Blocks until all the standards of the unit are READY, one failed or the timeout expires
+        :return: dict of StandardsArn:StandardsStatus of the standards that are not READY
+        """
+        return self.wait_for_all([(sh_client, account, region, standards_arns)], timeout).get((account, region), {})
+
+    async def wait_for_async(self, sh_client, account, region, standards_arns, timeout=100):
+        """
+        Coroutine version of wait_for, the event loop keeps running while waiting
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def resolve(not_ready):
+            if not future.done():
+                future.set_result(not_ready)
+
+        unit = self.watch(sh_client, account, region, standards_arns, lambda not_ready: loop.call_soon_threadsafe(resolve, not_ready), timeout)
+        try:
+            return await asyncio.wait_for(future, timeout + self.max_interval)
+        except asyncio.TimeoutError:
+            return dict(unit['pending'])
+
+    def _poll(self, unit):
+        standards_status = dict()
+        for page in unit['client'].get_paginator('get_enabled_standards').paginate():
+            for enabled_standard in page['StandardsSubscriptions']:
+                standards_status[enabled_standard['StandardsArn']] = enabled_standard['StandardsStatus']
+
+        return standards_status
+
+    def _run(self):
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                while True:
+                    with self._condition:
+                        while self._units and time.time() < min(unit['next_poll'] for unit in self._units):
+                            self._condition.wait(min(unit['next_poll'] for unit in self._units) - time.time())
+
+                        if not self._units:
+                            self._thread = None
+                            return
+
+                        now = time.time()
+                        due = [unit for unit in self._units if unit['next_poll'] <= now]
+
+                    self._tick(executor, due)
+        finally:
+            # After a failure the next watch starts a new poller thread
+            with self._condition:
+                if self._thread is threading.current_thread():
+                    self._thread = None
+
+    def _tick(self, executor, due):
+        futures = dict((executor.submit(self._poll, unit), unit) for unit in due)
+        resolved = []
+        for future in as_completed(futures):
+            unit = futures[future]
+            now = time.time()
+            error = None
+            try:
+                standards_status = future.result()
+            except botocore.exceptions.ClientError as e:
+                print("Error polling standards of account {} in {}: {}".format(unit['account'], unit['region'], repr(e)))
+                standards_status = dict()
+            except Exception as e:
+                # Anything else, e.g. an unreachable endpoint, fails the unit instead of the poller
+                print("Error polling standards of account {} in {}: {}".format(unit['account'], unit['region'], repr(e)))
+                standards_status = dict()
+                error = repr(e)
+
+            for standard_arn in list(unit['pending'].keys()):
+                status = standards_status.get(standard_arn, unit['pending'][standard_arn])
+                unit['pending'][standard_arn] = status
+                if status == 'READY':
+                    print("Finished enabling stanard {} on account {} for region {}".format(standard_arn, unit['account'], unit['region']))
+                    del unit['pending'][standard_arn]
+                    with self._condition:
+                        self._ready_times.append((unit['account'], unit['region'], standard_arn, now - unit['started']))
+
+            if error is not None:
+                for standard_arn in unit['pending']:
+                    unit['pending'][standard_arn] = error
+                resolved.append(unit)
+                continue
+
+            failed = any(status in ('FAILED', 'INCOMPLETE') for status in unit['pending'].values())
+            if not unit['pending'] or failed or now >= unit['deadline']:
+                resolved.append(unit)
+            else:
+                unit['interval'] = min(unit['interval'] * 2, self.max_interval)
+                unit['next_poll'] = min(now + unit['interval'] * random.uniform(0.5, 1.0), unit['deadline'])
+
+        with self._condition:
+            for unit in resolved:
+                self._units.remove(unit)
+                if unit['pending']:
+                    self._timeouts.extend((unit['account'], unit['region'], standard_arn, status) for standard_arn, status in unit['pending'].items())
+
+        for unit in resolved:
+            unit['callback'](dict(unit['pending']))
+
+    def report(self):
+        """
+        :return: tuple of the list of (account, region, StandardsArn, seconds to READY) and the
+                 list of (account, region, StandardsArn, last status) of the standards that never got READY
+        """
+        with self._condition:
+            return list(self._ready_times), list(self._timeouts)
+
+_standards_verifier = None
+
+def get_standards_verifier():
+    """
+    Returns the standards verifier shared by the whole run
+    """
+    global _standards_verifier
+    with _client_lock:
+        if _standards_verifier is None:
+            _standards_verifier = StandardsVerifier()
+        return _standards_verifier
+
+def print_standards_report():
+    """
+    Prints the time the standards took to reach READY, per standard, to help tuning the timeouts
+    """
+    if _standards_verifier is None:
+        return
+
+    ready_times, timeouts = _standards_verifier.report()
+    if not ready_times and not timeouts:
+        return
+
+    per_standard = OrderedDict()
+    for _, region, standard_arn, seconds in sorted(ready_times, key=lambda item: item[2]):
+        # Regional ARNs of the same standard are reported together
+        per_standard.setdefault(standard_arn.replace(':{}:'.format(region), '::'), []).append(seconds)
+
+    print("---------------------------------------------------------------")
+    print("Standards Time to READY")
+    print("---------------------------------------------------------------")
+    for standard_arn, seconds in per_standard.items():
+        seconds.sort()
+        print("{}: {} subscriptions, min {:.1f}s, median {:.1f}s, max {:.1f}s".format(
+            standard_arn, len(seconds), seconds[0], seconds[len(seconds) // 2], seconds[-1]
+        ))
+    for account, region, standard_arn, status in timeouts:
+        print("{} in {} for {}: not READY, last state: {}".format(standard_arn, region, account, status))
+    print("---------------------------------------------------------------")
+
+class RunJournal(object):
+    """
+    Checkpoints of a run in a local SQLite database
+    Every completed phase of a (service, account, region) unit is recorded as soon as it finishes,
+    so that an interrupted run can be resumed and skip the units that already went through
+    """
+
+    def __init__(self, path, resume=False):
+        """
+        :param path: Path of the SQLite database, created if it does not exist
+        :param resume: Keep the checkpoints of the previous run instead of starting over
+        """
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS units ('
+                'service TEXT NOT NULL, account TEXT NOT NULL, region TEXT NOT NULL, phase TEXT NOT NULL, '
+                'status TEXT NOT NULL, error TEXT, updated_at REAL NOT NULL, '
+                'PRIMARY KEY (service, account, region, phase))'
+            )
+            if not resume:
+                self._connection.execute('DELETE FROM units')
+
+            self._completed = set(self._connection.execute(
+                "SELECT service, account, region, phase FROM units WHERE status = 'completed'"
+            ).fetchall())
+
+    def record(self, service, account, region, phase, error=None):
+        """
+        Records a phase of a unit as completed, or as failed if an error is given
+        """
+        status = 'failed' if error else 'completed'
+        with self._lock, self._connection:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO units (service, account, region, phase, status, error, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (service, account, region, phase, status, error, time.time())
+            )
+            if error:
+                self._completed.discard((service, account, region, phase))
+            else:
+                self._completed.add((service, account, region, phase))
+
+    def is_completed(self, service, account, region, phase):
+        with self._lock:
+            return (service, account, region, phase) in self._completed
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+_journal = None
+
+def open_journal(path, resume=False):
+    """
+    Opens the run journal used by journal_record and journal_completed
+    :param path: Path of the SQLite database
+    :param resume: Keep the checkpoints of the previous run
+    :return: RunJournal
+    """
+    global _journal
+    _journal = RunJournal(path, resume)
+    return _journal
+
+def journal_record(service, account, region, phase, error=None):
+    """
+    Records a phase of a unit in the run journal and the event log, if they are open
+    :param error: exception or message if the phase failed
+    """
+    log_event(service, account, region, phase, 'failed' if error else 'completed', error=error)
+    if _journal is not None:
+        _journal.record(service, account, region, phase, repr(error) if isinstance(error, BaseException) else error)
+
+def journal_completed(service, account, region, phase):
+    """
+    :return: True if the phase of the unit was completed by this run or the run being resumed
+    """
+    return _journal is not None and _journal.is_completed(service, account, region, phase)
+
+def error_code(error):
+    """
+    :param error: exception or message
+    :return: Error code of a ClientError, the exception name otherwise, None for a message
+    """
+    if isinstance(error, botocore.exceptions.ClientError):
+        return error.response.get('Error', {}).get('Code')
+    if isinstance(error, BaseException):
+        return type(error).__name__
+    return None
+
+class EventLog(object):
+    """
+    Structured events of a run written as JSON lines by a background thread
+    Callers only put the event on a queue, the writer thread batches them to the file and
+    formats them for the console, so neither is on the path of the worker threads
+    """
+
+    def __init__(self, path=None, console=False, buffer_size=1000, flush_interval=1.0):
+        """
+        :param path: Path of the JSONL file events are appended to, None to only use the console
+        :param console: Print a human-readable line for every event
+        :param buffer_size: Number of events written to the file at most in one batch
+        :param flush_interval: Seconds between flushes of the file while events keep coming
+        """
+        self.path = path
+        self.console = console
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue()
+        # Time of the previous event of every (service, account, region) unit, to time its phases
+        self._unit_times = dict()
+        self._lock = threading.Lock()
+        self._file = open(path, 'a') if path else None
+        self._thread = threading.Thread(target=self._run, name='event-log')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def emit(self, service, account=None, region=None, phase=None, outcome=None, duration=None, error=None, **fields):
+        """
+        Queues an event, the duration defaults to the time since the previous event of the same unit
+        :param error: exception or message of a failed phase
+        """
+        now = time.time()
+        if account is not None:
+            with self._lock:
+                previous = self._unit_times.get((service, account, region))
+                self._unit_times[(service, account, region)] = now
+            if duration is None and previous is not None:
+                duration = now - previous
+
+        event = OrderedDict([
+            ('time', now),
+            ('service', service),
+            ('account', account),
+            ('region', region),
+            ('phase', phase),
+            ('outcome', outcome),
+            ('duration', round(duration, 3) if duration is not None else None),
+            ('error_code', error_code(error)),
+            ('error', (repr(error) if isinstance(error, BaseException) else error) if error else None)
+        ])
+        event.update(fields)
+        self._queue.put(event)
+
+    def _format(self, event):
+        line = '{} {} {} {} {}'.format(
+            time.strftime('%H:%M:%S', time.localtime(event['time'])),
+            event['service'],
+            event['account'] or '-',
+            event['region'] or '-',
+            ' '.join(str(part) for part in (event['phase'], event['outcome']) if part)
+        )
+        if event['duration'] is not None:
+            line += ' ({:.1f}s)'.format(event['duration'])
+        if event['error']:
+            line += ': {}'.format(event['error'])
+        return line
+
+    def _run(self):
+        last_flush = time.time()
+        stopping = False
+        while not stopping:
+            try:
+                batch = [self._queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                batch = []
+
+            while len(batch) < self.buffer_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            if None in batch:
+                stopping = True
+                batch = [event for event in batch if event is not None]
+
+            for event in batch:
+                if self._file:
+                    self._file.write(json.dumps(event) + '\n')
+                if self.console:
+                    print(self._format(event))
+
+            if self._file and (stopping or time.time() - last_flush >= self.flush_interval):
+                self._file.flush()
+                last_flush = time.time()
+
+    def close(self):
+        """
+        Writes the queued events and closes the file
+        """
+        self._queue.put(None)
+        self._thread.join()
+        if self._file:
+            self._file.close()
+
+_event_log = None
+
+def open_event_log(path=None, console=False):
+    """
+    Opens the event log used by log_event, it is closed when the process exits
+    :param path: Path of the JSONL file
+    :param console: Print a human-readable line for every event
+    :return: EventLog
+    """
+    global _event_log
+    _event_log = EventLog(path, console)
+    atexit.register(close_event_log)
+    return _event_log
+
+def close_event_log():
+    global _event_log
+    if _event_log is not None:
+        _event_log.close()
+        _event_log = None
+
+def log_event(service, account=None, region=None, phase=None, outcome=None, duration=None, error=None, **fields):
+    """
+    Emits a structured event, does nothing if no event log is open
+    """
+    if _event_log is not None:
+        _event_log.emit(service, account, region, phase, outcome, duration, error, **fields)
+
+def snapshot_units(units, probe, workers=10):
+    """
+    Reads the actual state of every (account, region) unit concurrently, without changing anything
+    :param units: list of (AwsAccountId, AWS_Region)
+    :param probe: function of (AwsAccountId, AWS_Region) returning the state of the unit
+    :param workers: Number of units probed at the same time
+    :return: dict of (AwsAccountId, AWS_Region): state, or the exception raised by the probe
+    """
+    snapshot = dict()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = dict((executor.submit(probe, account, region), (account, region)) for account, region in units)
+        for future in as_completed(futures):
+            try:
+                snapshot[futures[future]] = future.result()
+            except Exception as e:
+                snapshot[futures[future]] = e
+
+    return snapshot
+
+def print_plan(plan):
+    """
+    Prints the actions needed to converge every (account, region) unit
+    :param plan: OrderedDict of (AwsAccountId, AWS_Region): list of actions, empty if the unit is up to date
+    """
+    changes = [(unit, actions) for unit, actions in plan.items() if actions]
+
+    print("---------------------------------------------------------------")
+    print("Plan: {} account/region units to change, {} up to date".format(len(changes), len(plan) - len(changes)))
+    print("---------------------------------------------------------------")
+    for (account, region), actions in changes:
+        print("{} {}: \n\t{}".format(account, region, ', '.join(actions)))
+    print("---------------------------------------------------------------")
+
+class RegionResult(object):
+    """
+    Outcome of a region processed by run_regions
+    """
+
+    def __init__(self, region, value=None, error=None, elapsed=0.0):
+        self.region = region
+        self.value = value
+        self.error = error
+        self.elapsed = elapsed
+
+    @property
+    def ok(self):
+        return self.error is None
+
+def run_regions(regions, process_region, workers=10):
+    """
+    Processes independent regions concurrently
+    :param regions: list of AWS Regions
+    :param process_region: function of an AWS Region, a ClientError it raises fails only that region
+    :param workers: Number of regions processed at the same time
+    :return: OrderedDict of AWS_Region: RegionResult, in the order of regions
+    """
+    results = OrderedDict((region, None) for region in regions)
+
+    def timed(region):
+        start_time = time.time()
+        try:
+            return RegionResult(region, value=process_region(region), elapsed=time.time() - start_time)
+        except botocore.exceptions.ClientError as e:
+            return RegionResult(region, error=e, elapsed=time.time() - start_time)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = dict((executor.submit(timed, region), region) for region in regions)
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+
+    return results
+
+def print_region_results(results):
+    """
+    Prints the outcome and duration of every region processed by run_regions
+    """
+    print("---------------------------------------------------------------")
+    print("Regions")
+    print("---------------------------------------------------------------")
+    for region, result in results.items():
+        if result.ok:
+            print("{}: done in {:.1f}s".format(region, result.elapsed))
+        else:
+            print("{}: failed after {:.1f}s, {}".format(region, result.elapsed, result.error.response['Error']['Message']))
+    print("---------------------------------------------------------------")
+
 def parse_template(template):
-    cf = boto3.client('cloudformation')
+    cf = get_client(None, 'cloudformation')
     with open(template) as template_fileobj:
         template_data = template_fileobj.read()
     cf.validate_template(TemplateBody=template_data)
@@ -28,7 +1755,7 @@ def parse_parameters(parameters):
 
 
 def stack_exists(stack_name, region):
-    cf = boto3.client('cloudformation', region_name=region)
+    cf = get_client(None, 'cloudformation', region)
     stacks = cf.list_stacks()['StackSummaries']
     for stack in stacks:
         if stack['StackStatus'] == 'DELETE_COMPLETE':
@@ -38,7 +1765,7 @@ def stack_exists(stack_name, region):
     return False
 
 def stackset_exists(stackset_name):
-    cf = boto3.client('cloudformation')
+    cf = get_client(None, 'cloudformation')
     stacksets = cf.list_stack_sets()['Summaries']
     for stackset in stacksets:
         if stackset['Status'] == 'DELETED':